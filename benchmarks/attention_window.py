@@ -0,0 +1,120 @@
+"""
+窗口注意力（model_conf.attention_window）的性能与质量测试
+- 性能：不同输入长度下完整注意力与窗口注意力每一步解码的耗时
+- 质量：相同随机种子（Prenet 的 dropout 在预测时也会开启）下窗口注意力与完整注意力输出的 mel 误差、
+  每一步注意力峰值位置相同的比例，以及完整注意力的权重落在窗口内的比例（窗口覆盖率，越接近1说明窗口越不会截断注意力）
+为了让两种注意力的解码步数相同，测试时关闭 gate 停止，每条都解码 音素数 * frames_per_phoneme 帧
+不指定 model_path 时模型参数随机初始化，注意力不是单调的，质量指标没有意义，只能用于比较速度；
+质量需要用训练好的模型测试
+在项目根目录下运行：python -m benchmarks.attention_window
+"""
+import argparse
+import contextlib
+import functools
+import io
+import math
+import os
+import time
+
+import torch
+import yaml
+
+from src.models.model import Tacotron2
+from src.utils.utils import add_arguments, dict_to_object, print_arguments
+
+
+def run(model, text_in, window, seed):
+    """返回 mel 谱、注意力权重以及耗时"""
+    model.decoder.attention_window = window
+    with torch.random.fork_rng(), torch.no_grad(), contextlib.redirect_stdout(io.StringIO()):
+        torch.manual_seed(seed)
+        start = time.perf_counter()
+        outputs = model.inference(text_in)
+        seconds = time.perf_counter() - start
+    return outputs[1], outputs[3], seconds
+
+
+def window_coverage(alignments, window):
+    """完整注意力每一步的权重落在以上一步峰值确定的窗口内的比例 [T_out - 1]"""
+    T = alignments.size(-1)
+    if T <= window:
+        return torch.ones(alignments.size(1) - 1)
+    alignments = alignments[0]
+    start = (alignments[:-1].argmax(dim=1) - window // 4).clamp(min=0, max=T - window)
+    index = start.unsqueeze(1) + torch.arange(window)
+    return alignments[1:].gather(1, index).sum(dim=1)
+
+
+def time_attention(attention, text_len, window, calls=50):
+    """只测注意力层一次调用的耗时（毫秒），返回 (完整注意力, 窗口注意力)"""
+    memory = torch.randn(1, text_len, attention.memory_layer.linear_layer.in_features)
+    query = torch.randn(1, attention.query_layer.linear_layer.in_features)
+    weights = torch.softmax(torch.randn(1, text_len), dim=1)
+    weights_cum = torch.rand(1, text_len)
+    with torch.no_grad():
+        processed_memory = attention.memory_layer(memory)
+        weights_cat = torch.stack((weights, weights_cum), dim=1)
+        results = []
+        for fn in (lambda: attention(query, memory, processed_memory, weights_cat, None),
+                   lambda: attention.forward_windowed(query, memory, processed_memory, weights, weights_cum,
+                                                      None, window)):
+            fn()
+            start = time.perf_counter()
+            for _ in range(calls):
+                fn()
+            results.append((time.perf_counter() - start) / calls * 1000)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    add_arg('configs',            str,   'configs/Tacotron2.yml',  '配置文件')
+    add_arg('model_path',         str,   '',                       '模型文件夹或 model.pt 路径，为空时随机初始化')
+    add_arg('text_lens',          str,   '50,200,500',             '输入音素序列长度，用逗号分隔')
+    add_arg('window',             int,   40,                       '注意力窗口大小')
+    add_arg('frames_per_phoneme', float, 2.0,                      '每个音素解码的mel帧数')
+    add_arg('threads',            int,   0,                        'torch线程数，0表示使用默认值')
+    add_arg('repeat',             int,   3,                        '每项测试重复次数')
+    args = parser.parse_args()
+    print_arguments(args=args)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    with open(args.configs, 'r', encoding='utf-8') as f:
+        configs = dict_to_object(yaml.load(f.read(), Loader=yaml.FullLoader))
+    configs.model_conf.gate_threshold = 1.1
+    configs.model_conf.stop_max_frames_per_phoneme = 0
+    configs.model_conf.stop_end_cum_weight = 0
+    configs.model_conf.stop_stall_steps = 0
+    torch.manual_seed(0)
+    model = Tacotron2(configs.model_conf)
+    if args.model_path:
+        model_path = args.model_path
+        if os.path.isdir(model_path):
+            model_path = os.path.join(model_path, 'model.pt')
+        model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    model.eval()
+
+    print(f'{"text_len":>9} {"steps":>6} {"full ms/step":>13} {"window ms/step":>15} {"speedup":>8} '
+          f'{"full attn ms":>13} {"window attn ms":>15} {"mel L1":>8} {"peak match":>11} {"coverage":>9} '
+          f'{"min cover":>10}')
+    for text_len in [int(n) for n in args.text_lens.split(',')]:
+        steps = math.ceil(text_len * args.frames_per_phoneme / configs.model_conf.n_frames_per_step)
+        model.decoder.max_decoder_steps = steps
+        text_in = torch.randint(1, configs.model_conf.n_symbols, (1, text_len))
+        t_full = min(run(model, text_in, 0, 0)[2] for _ in range(args.repeat))
+        t_window = min(run(model, text_in, args.window, 0)[2] for _ in range(args.repeat))
+        mel_full, align_full, _ = run(model, text_in, 0, 0)
+        mel_window, align_window, _ = run(model, text_in, args.window, 0)
+        mel_l1 = (mel_full - mel_window).abs().mean()
+        peak_match = (align_full.argmax(-1) == align_window.argmax(-1)).float().mean()
+        coverage = window_coverage(align_full, args.window)
+        attn_full, attn_window = time_attention(model.decoder.attention_layer, text_len, args.window)
+        print(f'{text_len:>9} {steps:>6} {t_full / steps * 1000:>13.2f} {t_window / steps * 1000:>15.2f} '
+              f'{t_full / t_window:>7.2f}x {attn_full:>13.3f} {attn_window:>15.3f} {mel_l1:>8.4f} '
+              f'{peak_match:>11.2%} {coverage.mean():>9.2%} {coverage.min():>10.2%}')
+
+
+if __name__ == '__main__':
+    main()
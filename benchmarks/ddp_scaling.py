@@ -0,0 +1,106 @@
+"""
+分布式数据并行CPU训练的扩展性测试
+在本机启动 1 到 N 个进程（gloo 后端），每个进程使用相同大小的随机 batch 做前向+反向传播+梯度同步+参数更新，
+统计每一步的耗时、每秒训练的样本数、相对单进程的加速比以及扩展效率（加速比 / 进程数）
+每个进程的线程数默认为 可用核数 // 进程数，与 TacoTronTrainer 的分布式训练相同
+在项目根目录下运行：python -m benchmarks.ddp_scaling
+"""
+import argparse
+import functools
+import os
+import socket
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import yaml
+from torch.nn.parallel import DistributedDataParallel
+
+from src.models.loss_function import Tacotron2Loss
+from src.models.model import Tacotron2
+from src.utils.utils import add_arguments, dict_to_object, print_arguments
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_rank(rank, world_size, port, args, threads, result_queue):
+    """一个训练进程，rank 0 把平均每一步的耗时放入 result_queue"""
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(threads)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    with open(args.configs, 'r', encoding='utf-8') as f:
+        configs = dict_to_object(yaml.load(f.read(), Loader=yaml.FullLoader))
+    model_conf = configs.model_conf
+    torch.manual_seed(0)
+    model = Tacotron2(model_conf).train()
+    if args.compile_decoder:
+        model.decoder.compile_teacher_forcing()
+    ddp_model = DistributedDataParallel(model)
+    criterion = Tacotron2Loss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    generator = torch.Generator().manual_seed(rank)
+    n_frames = args.mel_len // model_conf.n_frames_per_step * model_conf.n_frames_per_step
+    text = torch.randint(0, model_conf.n_symbols, (args.batch_size, args.text_len), generator=generator)
+    text_lengths = torch.full((args.batch_size,), args.text_len, dtype=torch.long)
+    mels = torch.randn(args.batch_size, model_conf.n_mel_channels, n_frames, generator=generator)
+    mel_lengths = torch.full((args.batch_size,), n_frames, dtype=torch.long)
+    gates = torch.zeros(args.batch_size, n_frames)
+    gates[:, -1] = 1
+
+    times = []
+    for i in range(args.warmup + args.repeat):
+        dist.barrier()
+        start = time.perf_counter()
+        outputs = ddp_model(text, text_lengths, mels, mel_lengths)
+        loss = criterion(outputs, [mels, gates])
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+        optimizer.zero_grad()
+        if i >= args.warmup:
+            times.append(time.perf_counter() - start)
+    if rank == 0:
+        result_queue.put(sum(times) / len(times))
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    add_arg('configs',          str,  'configs/Tacotron2.yml',  '配置文件')
+    add_arg('world_sizes',      str,  '1,2,4,8',                '测试的进程数，用逗号分隔')
+    add_arg('threads_per_rank', int,  0,                        '每个进程的torch线程数，0表示 可用核数 // 进程数')
+    add_arg('batch_size',       int,  8,                        '每个进程的batch大小')
+    add_arg('text_len',         int,  80,                       '输入音素序列长度')
+    add_arg('mel_len',          int,  300,                      'mel帧数')
+    add_arg('compile_decoder',  bool, True,                     '是否用TorchScript编译decoder训练循环')
+    add_arg('repeat',           int,  5,                        '每项测试的步数')
+    add_arg('warmup',           int,  2,                        '预热步数')
+    args = parser.parse_args()
+    print_arguments(args=args)
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    ctx = mp.get_context('spawn')
+    base = None
+    print(f'{"ranks":>6} {"threads":>8} {"s/step":>8} {"samples/s":>10} {"speedup":>8} {"efficiency":>11}')
+    for world_size in [int(w) for w in args.world_sizes.split(',')]:
+        threads = args.threads_per_rank or max(cores // world_size, 1)
+        result_queue = ctx.SimpleQueue()
+        mp.start_processes(run_rank, args=(world_size, free_port(), args, threads, result_queue),
+                           nprocs=world_size, start_method='spawn')
+        step_seconds = result_queue.get()
+        throughput = world_size * args.batch_size / step_seconds
+        base = base or throughput
+        print(f'{world_size:>6} {threads:>8} {step_seconds:>8.3f} {throughput:>10.2f} '
+              f'{throughput / base:>7.2f}x {throughput / base / world_size:>10.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+decoder 训练循环激活值重计算的显存/内存与速度测试
+对不同的 decoder_checkpoint_steps（K，每段的解码步数）统计一次训练（前向+反向传播+参数更新）的峰值内存与耗时，
+K=0 为不重计算，分别测试未编译与 TorchScript 编译的循环作为对照
+使用GPU时峰值为 torch.cuda.max_memory_allocated；使用CPU时每项测试在单独的进程中运行，峰值为训练期间进程 RSS 峰值的增加量
+在项目根目录下运行：python -m benchmarks.decoder_checkpoint
+"""
+import argparse
+import functools
+import resource
+import time
+
+import torch
+import torch.multiprocessing as mp
+import yaml
+
+from src.models.loss_function import Tacotron2Loss
+from src.models.model import Tacotron2
+from src.utils.utils import add_arguments, dict_to_object, print_arguments
+
+
+def run_case(args, chunk_steps, compiled, result_queue):
+    """一项测试，把（峰值内存 MB，最短的一次训练耗时 秒）放入 result_queue"""
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if args.use_gpu else 'cpu')
+    with open(args.configs, 'r', encoding='utf-8') as f:
+        configs = dict_to_object(yaml.load(f.read(), Loader=yaml.FullLoader))
+    model_conf = configs.model_conf
+    torch.manual_seed(0)
+    model = Tacotron2(model_conf).to(device).train()
+    if compiled:
+        model.decoder.compile_teacher_forcing()
+    model.decoder.checkpoint_teacher_forcing(chunk_steps)
+    criterion = Tacotron2Loss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    n_frames = args.mel_len // model_conf.n_frames_per_step * model_conf.n_frames_per_step
+    text = torch.randint(0, model_conf.n_symbols, (args.batch_size, args.text_len), device=device)
+    text_lengths = torch.full((args.batch_size,), args.text_len, dtype=torch.long, device=device)
+    mels = torch.randn(args.batch_size, model_conf.n_mel_channels, n_frames, device=device)
+    mel_lengths = torch.full((args.batch_size,), n_frames, dtype=torch.long, device=device)
+    gates = torch.zeros(args.batch_size, n_frames, device=device)
+    gates[:, -1] = 1
+
+    if args.use_gpu:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        # Linux 上 ru_maxrss 的单位为 KB
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    times = []
+    for i in range(args.warmup + args.repeat):
+        start = time.perf_counter()
+        outputs = model(text, text_lengths, mels, mel_lengths)
+        loss = criterion(outputs, [mels, gates])
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if args.use_gpu:
+            torch.cuda.synchronize()
+        if i >= args.warmup:
+            times.append(time.perf_counter() - start)
+    if args.use_gpu:
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base
+    result_queue.put((peak / 2 ** 20, min(times)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    add_arg('configs',     str,  'configs/Tacotron2.yml',  '配置文件')
+    add_arg('chunk_steps', str,  '1,5,10,25,50',           '测试的每段解码步数，用逗号分隔')
+    add_arg('batch_size',  int,  16,                       'batch大小')
+    add_arg('text_len',    int,  80,                       '输入音素序列长度')
+    add_arg('mel_len',     int,  600,                      'mel帧数')
+    add_arg('use_gpu',     bool, torch.cuda.is_available(), '是否使用GPU')
+    add_arg('threads',     int,  0,                        'torch线程数，0表示使用默认值')
+    add_arg('repeat',      int,  3,                        '每项测试重复次数')
+    add_arg('warmup',      int,  1,                        '预热次数')
+    args = parser.parse_args()
+    print_arguments(args=args)
+
+    cases = [('K=0 eager', 0, False), ('K=0 script', 0, True)]
+    cases += [(f'K={k}', int(k), False) for k in args.chunk_steps.split(',')]
+    ctx = mp.get_context('spawn')
+    base = None
+    print(f'{"case":>12} {"peak(MB)":>10} {"step(s)":>8} {"memory":>8} {"time":>7}')
+    for name, chunk_steps, compiled in cases:
+        result_queue = ctx.SimpleQueue()
+        process = ctx.Process(target=run_case, args=(args, chunk_steps, compiled, result_queue))
+        process.start()
+        peak, seconds = result_queue.get()
+        process.join()
+        # 以未编译、不重计算的循环为基准
+        base = base or (peak, seconds)
+        print(f'{name:>12} {peak:>10.1f} {seconds:>8.3f} {peak / base[0]:>7.0%} {seconds / base[1]:>6.2f}x')
+
+
+if __name__ == '__main__':
+    main()
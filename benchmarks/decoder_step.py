@@ -0,0 +1,69 @@
+"""
+训练时 decoder teacher-forcing 循环的性能测试
+对比 Python 逐步调用 Decoder.decode 的原始循环与 TorchScript 编译后的循环，
+统计前向+反向传播的耗时以及平均每一步解码的耗时，模型参数随机初始化
+在项目根目录下运行：python -m benchmarks.decoder_step
+"""
+import argparse
+import copy
+import functools
+import time
+
+import torch
+import yaml
+
+from src.models.model import Tacotron2
+from src.utils.utils import add_arguments, dict_to_object, print_arguments
+
+
+def measure(model, inputs, repeat, warmup):
+    """返回最短的一次前向+反向传播耗时（秒）"""
+    times = []
+    for i in range(warmup + repeat):
+        start = time.perf_counter()
+        mel_outputs, mel_outputs_postnet, gate_outputs, _ = model(*inputs)
+        loss = mel_outputs.pow(2).mean() + mel_outputs_postnet.pow(2).mean() + gate_outputs.mean()
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    add_arg('configs',     str,  'configs/Tacotron2.yml',  '配置文件')
+    add_arg('batch_sizes', str,  '1,8,16',                 '测试的batch大小，用逗号分隔')
+    add_arg('text_len',    int,  80,                       '输入音素序列长度')
+    add_arg('mel_len',     int,  300,                      'mel帧数')
+    add_arg('threads',     int,  0,                        'torch线程数，0表示使用默认值')
+    add_arg('repeat',      int,  3,                        '每项测试重复次数')
+    add_arg('warmup',      int,  2,                        '预热次数，TorchScript 需要预热后才会优化计算图')
+    args = parser.parse_args()
+    print_arguments(args=args)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    with open(args.configs, 'r', encoding='utf-8') as f:
+        configs = dict_to_object(yaml.load(f.read(), Loader=yaml.FullLoader))
+    torch.manual_seed(0)
+    eager = Tacotron2(configs.model_conf).train()
+    scripted = copy.deepcopy(eager)
+    scripted.decoder.compile_teacher_forcing()
+
+    n_steps = args.mel_len // configs.model_conf.n_frames_per_step
+    print(f'{"batch":>6} {"eager(s)":>9} {"script(s)":>10} {"eager ms/step":>14} {"script ms/step":>15} {"speedup":>8}')
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        inputs = (torch.randint(0, configs.model_conf.n_symbols, (batch_size, args.text_len)),
+                  torch.full((batch_size,), args.text_len, dtype=torch.long),
+                  torch.randn(batch_size, configs.model_conf.n_mel_channels, n_steps * configs.model_conf.n_frames_per_step),
+                  torch.full((batch_size,), n_steps * configs.model_conf.n_frames_per_step, dtype=torch.long))
+        t_eager = measure(eager, inputs, args.repeat, args.warmup)
+        t_script = measure(scripted, inputs, args.repeat, args.warmup)
+        print(f'{batch_size:>6} {t_eager:>9.3f} {t_script:>10.3f} {t_eager / n_steps * 1000:>14.2f} '
+              f'{t_script / n_steps * 1000:>15.2f} {t_eager / t_script:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
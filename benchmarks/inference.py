@@ -0,0 +1,188 @@
+"""
+预测流程的分阶段性能测试
+按 Tacotron2Predictor.predict 的流程依次统计 文本前端、Encoder.inference、Decoder.inference、Postnet、
+mel 谱转语音、去噪、首尾静音裁剪、写文件 各阶段的耗时，遍历不同的输入长度与线程数，
+输出实时率（RTF = 合成耗时 / 语音时长）以及各阶段的 p50/p95 延迟，结果为 json，可以在不同提交之间对比
+模型由配置文件构建，参数按 seed 随机初始化，不需要训练好的模型；
+随机参数的 gate 输出没有意义，因此关闭 gate 停止，每条输入解码 音素数 * frames_per_phoneme 帧，模拟训练好的模型的输出长度
+在项目根目录下运行：python -m benchmarks.inference
+"""
+import argparse
+import contextlib
+import functools
+import io
+import json
+import math
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+import yaml
+
+from src.infer_utils.frontend import TextFrontend
+from src.infer_utils.utils import speech_enhance
+from src.infer_utils.vocoder import GriffinLimVocoder
+from src.models.model import Tacotron2
+from src.utils.utils import add_arguments, dict_to_object, print_arguments
+
+STAGES = ['frontend', 'encoder', 'decoder', 'postnet', 'inversion', 'enhance', 'trim', 'write']
+
+
+def make_sentence(frontend, n_words, rng):
+    """从发音词典中随机挑选 n_words 个只包含字母的单词组成句子"""
+    words = []
+    while len(words) < n_words:
+        word = frontend.lexicon.words[rng.integers(len(frontend.lexicon))].decode('utf-8')
+        if word.isalpha():
+            words.append(word.lower())
+    return ' '.join(words)
+
+
+def synthesize(model, frontend, vocoder, configs, sentence, output_path, args):
+    """按 predict 的流程合成一条语音，返回各阶段的耗时（秒）、解码步数以及语音时长（秒）"""
+    preprocess_conf = configs.preprocess_conf
+    times = {}
+    start = time.perf_counter()
+
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        times[stage] = now - start
+        start = now
+
+    coded_text = frontend.text_to_sequence(sentence)
+    text_in = torch.tensor(coded_text).unsqueeze(0)
+    lap('frontend')
+
+    n_frames_per_step = configs.model_conf.n_frames_per_step
+    model.decoder.max_decoder_steps = math.ceil(len(coded_text) * args.frames_per_phoneme / n_frames_per_step)
+    with torch.no_grad(), contextlib.redirect_stdout(io.StringIO()):
+        embedded_inputs = model.embedding(text_in).transpose(1, 2)
+        encoder_outputs = model.encoder.inference(embedded_inputs)
+        lap('encoder')
+        mel_outputs = model.decoder.inference(encoder_outputs)[0]
+        lap('decoder')
+        mel_outputs_postnet = mel_outputs + model.postnet(mel_outputs)
+        mel_out = mel_outputs_postnet.numpy()
+        lap('postnet')
+
+    generated_mel = mel_out * args.std_mel + args.mean_mel
+    inv_wav, _ = vocoder(librosa.db_to_power(generated_mel))
+    inv_wav = inv_wav[0].numpy()
+    inv_wav = inv_wav / max(inv_wav)
+    lap('inversion')
+    inv_wav = speech_enhance(wave_data=inv_wav,
+                             n_fft=preprocess_conf.n_fft,
+                             hop_length=preprocess_conf.hop_length,
+                             win_length=preprocess_conf.win_length,
+                             noise_frame=30)
+    lap('enhance')
+    inv_wav, _ = librosa.effects.trim(inv_wav)
+    lap('trim')
+    sf.write(output_path, inv_wav, preprocess_conf.fs)
+    lap('write')
+    audio_seconds = mel_out.shape[-1] * preprocess_conf.hop_length / preprocess_conf.fs
+    return times, model.decoder.max_decoder_steps, audio_seconds
+
+
+def percentiles(values):
+    p50, p95 = np.percentile(np.array(values) * 1000, [50, 95])
+    return {'p50_ms': round(float(p50), 3), 'p95_ms': round(float(p95), 3)}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    add_arg('configs',            str,   'configs/Tacotron2.yml',  '配置文件')
+    add_arg('word_counts',        str,   '5,20,50',                '输入文本的单词数，用逗号分隔')
+    add_arg('threads',            str,   '1,4',                    'torch线程数，用逗号分隔')
+    add_arg('frames_per_phoneme', float, 6.0,                      '每个音素解码的mel帧数')
+    add_arg('mean_mel',           float, -40.0,                    '反正则使用的 mel 均值')
+    add_arg('std_mel',            float, 15.0,                     '反正则使用的 mel 标准差')
+    add_arg('seed',               int,   0,                        '模型参数与输入文本的随机种子')
+    add_arg('repeat',             int,   5,                        '每项测试重复次数')
+    add_arg('warmup',             int,   1,                        '每项测试的预热次数')
+    add_arg('output',             str,   '',                       'json结果的保存路径，为空时只打印')
+    args = parser.parse_args()
+    print_arguments(args=args)
+
+    with open(args.configs, 'r', encoding='utf-8') as f:
+        configs = dict_to_object(yaml.load(f.read(), Loader=yaml.FullLoader))
+    # 关闭 gate 停止与提前停止，解码步数由 frames_per_phoneme 决定
+    configs.model_conf.gate_threshold = 1.1
+    configs.model_conf.stop_max_frames_per_phoneme = 0
+    configs.model_conf.stop_end_cum_weight = 0
+    configs.model_conf.stop_stall_steps = 0
+    torch.manual_seed(args.seed)
+    model = Tacotron2(configs.model_conf).eval()
+    dataset_conf = configs.dataset_conf
+    frontend = TextFrontend(lexicon_path=dataset_conf.get('lexicon_path', 'cmudict.txt'),
+                            symbol_index_path=dataset_conf.get('symbol_index_path', 'symbol_index.txt'))
+    vocoder_conf = configs.get('vocoder_conf', {})
+    vocoder = GriffinLimVocoder(configs.preprocess_conf,
+                                n_iter=vocoder_conf.get('n_iter', 32),
+                                momentum=vocoder_conf.get('momentum', 0.99),
+                                nnls_iter=vocoder_conf.get('nnls_iter', 50))
+    rng = np.random.default_rng(args.seed)
+    # 不同线程数使用相同的输入文本
+    sentences = {n_words: make_sentence(frontend, n_words, rng) for n_words in map(int, args.word_counts.split(','))}
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = os.path.join(tmp_dir, 'benchmark.wav')
+        for threads in [int(t) for t in args.threads.split(',')]:
+            torch.set_num_threads(threads)
+            for n_words, sentence in sentences.items():
+                runs = []
+                for i in range(args.warmup + args.repeat):
+                    run = synthesize(model, frontend, vocoder, configs, sentence, output_path, args)
+                    if i >= args.warmup:
+                        runs.append(run)
+                steps, audio_seconds = runs[0][1], runs[0][2]
+                totals = [sum(times.values()) for times, _, _ in runs]
+                stages = {stage: percentiles([times[stage] for times, _, _ in runs]) for stage in STAGES}
+                stages['decoder_step'] = percentiles([times['decoder'] / steps for times, _, _ in runs])
+                result = {'threads': threads,
+                          'words': n_words,
+                          'phonemes': len(frontend.text_to_sequence(sentence)),
+                          'decoder_steps': steps,
+                          'audio_seconds': round(audio_seconds, 3),
+                          'rtf_p50': round(float(np.percentile(totals, 50)) / audio_seconds, 4),
+                          'rtf_p95': round(float(np.percentile(totals, 95)) / audio_seconds, 4),
+                          'total': percentiles(totals),
+                          'stages': stages}
+                results.append(result)
+                print(f'threads={threads} words={n_words} steps={steps} audio={audio_seconds:.2f}s '
+                      f'rtf_p50={result["rtf_p50"]:.3f} ' +
+                      ' '.join(f'{stage}={stages[stage]["p50_ms"]:.1f}ms' for stage in STAGES))
+
+    report = {'git_revision': git_revision(),
+              'torch': torch.__version__,
+              'platform': platform.platform(),
+              'processor': platform.processor(),
+              'args': vars(args),
+              'results': results}
+    report_json = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+
+if __name__ == '__main__':
+    main()
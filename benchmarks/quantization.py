@@ -0,0 +1,95 @@
+"""
+动态 int8 量化的预测性能测试
+对比 fp32 模型与 quantize_dynamic_model 量化后的模型在CPU上 Tacotron2.inference 的耗时，
+以及相同随机种子（Prenet 的 dropout 在预测时也会开启）下两者输出 mel 谱的误差
+为了让两个模型的解码步数相同，测试时关闭 gate 停止，每条都解码 steps 步
+不指定 model_path 时模型参数随机初始化，此时的误差只能说明量化的数值误差，不代表合成质量
+在项目根目录下运行：python -m benchmarks.quantization
+"""
+import argparse
+import copy
+import functools
+import os
+import time
+
+import torch
+import yaml
+
+from src.models.model import Tacotron2, quantize_dynamic_model
+from src.utils.utils import add_arguments, dict_to_object, print_arguments
+
+
+def run(model, text_in, text_lengths, seed):
+    with torch.random.fork_rng(), torch.no_grad():
+        torch.manual_seed(seed)
+        return model.inference(text_in, text_lengths)[1]
+
+
+def measure(model, text_in, text_lengths, repeat):
+    """返回最短的一次预测耗时（秒）"""
+    run(model, text_in, text_lengths, 0)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(model, text_in, text_lengths, 0)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    add_arg('configs',     str,  'configs/Tacotron2.yml',  '配置文件')
+    add_arg('model_path',  str,  '',                       '模型文件夹或 model.pt 路径，为空时随机初始化')
+    add_arg('batch_sizes', str,  '1,8',                    '测试的batch大小，用逗号分隔')
+    add_arg('threads',     str,  '1,4',                    'torch线程数，用逗号分隔')
+    add_arg('text_len',    int,  80,                       '输入音素序列长度')
+    add_arg('steps',       int,  200,                      '解码步数')
+    add_arg('repeat',      int,  3,                        '每项测试重复次数')
+    args = parser.parse_args()
+    print_arguments(args=args)
+
+    with open(args.configs, 'r', encoding='utf-8') as f:
+        configs = dict_to_object(yaml.load(f.read(), Loader=yaml.FullLoader))
+    configs.model_conf.max_decoder_steps = args.steps
+    configs.model_conf.gate_threshold = 1.1
+    configs.model_conf.stop_max_frames_per_phoneme = 0
+    configs.model_conf.stop_end_cum_weight = 0
+    configs.model_conf.stop_stall_steps = 0
+    torch.manual_seed(0)
+    fp32 = Tacotron2(configs.model_conf)
+    if args.model_path:
+        model_path = args.model_path
+        if os.path.isdir(model_path):
+            model_path = os.path.join(model_path, 'model.pt')
+        fp32.load_state_dict(torch.load(model_path, map_location='cpu'))
+    fp32.eval()
+    int8 = quantize_dynamic_model(copy.deepcopy(fp32))
+
+    size = {}
+    for name, model in (('fp32', fp32), ('int8', int8)):
+        path = f'/tmp/_quantization_benchmark_{name}.pt'
+        torch.save(model.state_dict(), path)
+        size[name] = os.path.getsize(path) / 1024 / 1024
+        os.remove(path)
+    print(f'模型大小: fp32 {size["fp32"]:.1f}MB, int8 {size["int8"]:.1f}MB')
+
+    print(f'{"threads":>8} {"batch":>6} {"fp32(s)":>8} {"int8(s)":>8} {"fp32 ms/step":>13} {"int8 ms/step":>13} '
+          f'{"speedup":>8} {"mel L1":>8} {"rel L1":>7} {"max err":>8}')
+    for threads in [int(t) for t in args.threads.split(',')]:
+        torch.set_num_threads(threads)
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            text_in = torch.randint(1, configs.model_conf.n_symbols, (batch_size, args.text_len))
+            text_lengths = torch.full((batch_size,), args.text_len, dtype=torch.long)
+            t_fp32 = measure(fp32, text_in, text_lengths, args.repeat)
+            t_int8 = measure(int8, text_in, text_lengths, args.repeat)
+            mel_fp32 = run(fp32, text_in, text_lengths, 0)
+            mel_int8 = run(int8, text_in, text_lengths, 0)
+            err = (mel_fp32 - mel_int8).abs()
+            print(f'{threads:>8} {batch_size:>6} {t_fp32:>8.3f} {t_int8:>8.3f} {t_fp32 / args.steps * 1000:>13.2f} '
+                  f'{t_int8 / args.steps * 1000:>13.2f} {t_fp32 / t_int8:>7.2f}x {err.mean():>8.4f} '
+                  f'{err.mean() / mel_fp32.abs().mean():>7.2%} {err.max():>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+平滑法语音增强（speech_enhance method=3）的性能测试
+对比逐帧循环的旧实现、向量化实现与分块流式实现的耗时、峰值内存以及输出误差
+在项目根目录下运行：python -m benchmarks.speech_enhance
+"""
+import argparse
+import functools
+import time
+import tracemalloc
+
+import librosa
+import numpy as np
+
+from src.infer_utils.utils import speech_enhance, speech_enhance_stream
+from src.utils.utils import add_arguments, print_arguments
+
+
+def sub_spec3_loop(wav_data, n_fft, hop_length, win_length, noise_frame, alpha=4, beta=0.0001, gamma=1):
+    """向量化之前的 _sub_spec3 实现，作为对照"""
+    spec_raw = librosa.stft(wav_data, n_fft=n_fft, hop_length=hop_length, win_length=win_length)  # D x T
+    D, T = np.shape(spec_raw)
+    mag_raw = np.abs(spec_raw)
+    phase_raw = np.angle(spec_raw)
+    assert noise_frame < T
+    mag_noise = np.mean(np.abs(spec_raw[:, :noise_frame]), axis=1, keepdims=True)
+    power_noise = mag_noise ** 2
+    power_noise = np.tile(power_noise, [1, T])
+
+    mag_smoothed = np.copy(mag_raw)
+    k = 1
+    for t in range(k, T - k):
+        mag_smoothed[:, t] = np.mean(mag_raw[:, t - k:t + k + 1], axis=1)
+    power_smoothed = mag_smoothed ** 2
+
+    power_enhanced = np.power(power_smoothed, gamma) - alpha * np.power(power_noise, gamma)
+    power_enhanced = np.power(power_enhanced, 1 / gamma)
+    mask = (power_enhanced >= beta * power_noise) - 0
+    power_enhanced = mask * power_enhanced + beta * (1 - mask) * power_noise
+    mag_enhanced = np.sqrt(power_enhanced)
+
+    max_residual_error = np.max(np.abs(spec_raw[:, :noise_frame]) - mag_noise, axis=1)
+    mag_enhanced_new = np.copy(mag_enhanced)
+    k = 1
+    for t in range(k, T - k):
+        index = np.where(mag_enhanced[:, t] < max_residual_error)[0]
+        temp = np.min(mag_enhanced[:, t - k:t + k + 1], axis=1)
+        mag_enhanced_new[index, t] = temp[index]
+
+    spec_enhanced = mag_enhanced_new * np.exp(1j * phase_raw)
+    enhanced_wav = librosa.istft(spec_enhanced, hop_length=hop_length, win_length=win_length)
+    return enhanced_wav
+
+
+def measure(fn, repeat):
+    """返回输出、最短耗时（秒）与峰值内存（MB）"""
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, min(times), peak / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    add_arg('durations',    str,  '1,5,20,60',  '测试语音的时长（秒），用逗号分隔')
+    add_arg('fs',           int,  22050,        '采样率')
+    add_arg('n_fft',        int,  4096,         '傅里叶变换参数')
+    add_arg('hop_length',   int,  275,          '傅里叶变换参数')
+    add_arg('win_length',   int,  1102,         '傅里叶变换参数')
+    add_arg('block_frames', int,  256,          '流式处理每块的帧数')
+    add_arg('repeat',       int,  3,            '每项测试重复次数')
+    args = parser.parse_args()
+    print_arguments(args=args)
+
+    rng = np.random.default_rng(0)
+    kwargs = dict(n_fft=args.n_fft, hop_length=args.hop_length, win_length=args.win_length)
+    print(f'{"seconds":>8} {"loop(s)":>9} {"vector(s)":>10} {"stream(s)":>10} {"speedup":>8} '
+          f'{"loop(MB)":>9} {"vector(MB)":>11} {"stream(MB)":>11} {"max_err":>9}')
+    for duration in [float(d) for d in args.durations.split(',')]:
+        n = int(duration * args.fs)
+        wav = (0.1 * rng.standard_normal(n) * np.sin(np.arange(n) / 800)).astype(np.float32)
+        ref, t_loop, m_loop = measure(lambda: sub_spec3_loop(wav, noise_frame=30, **kwargs), args.repeat)
+        vec, t_vec, m_vec = measure(lambda: speech_enhance(wave_data=wav, noise_frame=30, **kwargs), args.repeat)
+        stream, t_stream, m_stream = measure(
+            lambda: np.concatenate(list(speech_enhance_stream(wave_data=wav, noise_frame=30,
+                                                              block_frames=args.block_frames, **kwargs))),
+            args.repeat)
+        max_err = max(np.abs(vec - ref).max(), np.abs(stream - ref).max())
+        print(f'{duration:>8.1f} {t_loop:>9.3f} {t_vec:>10.3f} {t_stream:>10.3f} {t_loop / t_vec:>7.1f}x '
+              f'{m_loop:>9.1f} {m_vec:>11.1f} {m_stream:>11.1f} {max_err:>9.2e}')
+
+
+if __name__ == '__main__':
+    main()
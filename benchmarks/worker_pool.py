@@ -0,0 +1,67 @@
+"""
+多进程合成池的吞吐量测试
+同一批随机短句分别用单进程逐条合成以及不同进程数的 PredictorPool 合成，
+统计每秒合成的句子数、每秒合成的语音时长（秒）以及相对单进程的加速比
+需要训练好的模型，随机参数的 gate 不会停止，每条句子都会解码到 max_decoder_steps
+在项目根目录下运行：python -m benchmarks.worker_pool --model_path=models/Tacotron2/best_model
+"""
+import argparse
+import functools
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.inference import make_sentence
+from src.predictor import Tacotron2Predictor
+from src.predictor_pool import PredictorPool
+from src.utils.utils import add_arguments, print_arguments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    add_arg('configs',            str,  'configs/Tacotron2.yml',        '配置文件')
+    add_arg('model_path',         str,  'models/Tacotron2/best_model',  '预测模型文件路径')
+    add_arg('workers',            str,  '1,2,4,8',                      '测试的进程数，用逗号分隔')
+    add_arg('threads_per_worker', int,  1,                              '每个进程的torch线程数')
+    add_arg('serial_threads',     int,  0,                              '单进程合成的torch线程数，0表示使用默认值')
+    add_arg('num_sentences',      int,  64,                             '合成的句子数')
+    add_arg('max_words',          int,  12,                             '每条句子最多的单词数')
+    add_arg('enhance',            bool, False,                          '是否去噪')
+    add_arg('seed',               int,  0,                              '输入文本的随机种子')
+    args = parser.parse_args()
+    print_arguments(args=args)
+    if args.serial_threads > 0:
+        torch.set_num_threads(args.serial_threads)
+
+    predictor = Tacotron2Predictor(configs=args.configs, model_path=args.model_path, use_gpu=False)
+    # 不使用缓存，每次都真正合成
+    predictor.cache = None
+    rng = np.random.default_rng(args.seed)
+    sentences = [make_sentence(predictor.frontend, int(rng.integers(2, args.max_words + 1)), rng)
+                 for _ in range(args.num_sentences)]
+    coded_texts = [predictor.frontend.text_to_sequence(sentence) for sentence in sentences]
+    fs = predictor.configs.preprocess_conf.fs
+
+    def report(name, seconds, wavs):
+        audio_seconds = sum(len(wav) for wav in wavs) / fs
+        print(f'{name:>12} {seconds:>8.2f}s {len(wavs) / seconds:>10.2f} utt/s '
+              f'{audio_seconds / seconds:>10.2f} audio_s/s {serial_seconds / seconds:>7.2f}x')
+
+    start = time.perf_counter()
+    wavs = [predictor.synthesize_sequences([coded_text], enhancement=args.enhance)[0] for coded_text in coded_texts]
+    serial_seconds = time.perf_counter() - start
+    report('serial', serial_seconds, wavs)
+
+    for num_workers in [int(w) for w in args.workers.split(',')]:
+        with PredictorPool(predictor, num_workers=num_workers, threads_per_worker=args.threads_per_worker) as pool:
+            # 预热，每个进程至少合成一次
+            pool.synthesize(coded_texts[:num_workers], enhancement=args.enhance)
+            start = time.perf_counter()
+            wavs = pool.synthesize(coded_texts, enhancement=args.enhance)
+            report(f'workers={num_workers}', time.perf_counter() - start, wavs)
+
+
+if __name__ == '__main__':
+    main()
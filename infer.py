@@ -13,13 +13,15 @@ def main():
     add_arg('configs',    str,  'configs/Tacotron2.yml',       "配置文件")
     add_arg('use_gpu',    bool, False,                         "是否使用GPU预测")
     add_arg('model_path', str,  'models/Tacotron2/best_model', "预测模型文件路径")
+    add_arg('quantize',   bool, False,                         "是否使用动态 int8 量化模型，只支持CPU预测")
     add_arg('enhance',    bool, True,                          "对生成的语音是否去噪")
     args = parser.parse_args()
     print_arguments(args=args)
 
     predictor = Tacotron2Predictor(configs=args.configs,
                                    model_path=args.model_path,
-                                   use_gpu=args.use_gpu)
+                                   use_gpu=args.use_gpu,
+                                   quantize=args.quantize)
     text = 'Hello World'
     out_path = './1.wav'
     predictor.predict(sentence=text, output_path=out_path, enhancement=args.enhance)
@@ -1,12 +1,15 @@
 import argparse
+import functools
 import glob
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import librosa
 from tqdm import tqdm
 
 from src.utils.utils import print_arguments
+from src.data_utils.mel_store import PackedMelWriter
 from src.data_utils.utils import pinyin_2_phoneme
 
 
@@ -24,28 +27,83 @@ def wav2feature(wav_file, args):
     return log_fbank
 
 
-def processing_wavs(wav_files, args):
-    feats = []
-    ids = []
-    for file in tqdm(wav_files, desc='featurizer'):
-        id_wav = os.path.split(file)[-1][:-4]
-        fea = wav2feature(file, args)
-        feats.append(fea)
-        ids.append(id_wav)
+def feature_stats(fea):
+    """单个特征每一维的统计量 (帧数, 均值, 离差平方和)，fea的维度 D*T"""
+    mean = np.mean(fea, axis=1, dtype=np.float64)
+    m2 = np.sum(np.square(fea - mean[:, None]), axis=1, dtype=np.float64)
+    return fea.shape[1], mean, m2
+
+
+def merge_stats(stats_a, stats_b):
+    """用 Chan 等人的并行算法合并两组 (帧数, 均值, 离差平方和)"""
+    n_a, mean_a, m2_a = stats_a
+    n_b, mean_b, m2_b = stats_b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + np.square(delta) * (n_a * n_b / n)
+    return n, mean, m2
+
+
+def _extract_worker(wav_file, args, raw_dir):
+    """子进程中提取特征、保存未正则的特征，只把统计量返回给主进程"""
+    id_wav = os.path.split(wav_file)[-1][:-4]
+    fea = wav2feature(wav_file, args)
+    np.save(os.path.join(raw_dir, id_wav + '.npy'), fea)
+    return id_wav, feature_stats(fea)
+
+
+def _normalize_worker(id_wav, raw_dir, mel_save_path, fea_mean, fea_std):
+    raw_name = os.path.join(raw_dir, id_wav + '.npy')
+    feat = np.load(raw_name)
+    norm_fea = ((feat - fea_mean) / fea_std).astype(feat.dtype)
+    np.save(os.path.join(mel_save_path, id_wav + '.npy'), norm_fea)
+    os.remove(raw_name)
+
+
+def processing_wavs(wav_files, args, data_list='wav_files'):
+    """
+    多进程提取特征，子进程提取完一条语音就写入磁盘并返回统计量，
+    主进程合并统计量得到均值和方差后，再逐条读取特征做正则，内存占用与数据集大小无关
+    :param data_list: 音频文件列表的来源，例如 glob 的路径，只用于报错信息
+    """
+    if not wav_files:
+        raise ValueError(f'数据列表 {data_list} 中没有音频文件，无法计算特征的均值和方差')
+    mel_save_path = os.path.join(args.output_dir, 'mel_features')
+    raw_dir = os.path.join(mel_save_path, '.raw')
+    os.makedirs(raw_dir, exist_ok=True)
 
     # 计算特征的均值和方差
-    fea_array = np.concatenate(feats, axis=1)  # fea的维度 D*T
-    fea_mean = np.mean(fea_array, axis=1, keepdims=True)
-    fea_std = np.std(fea_array, axis=1, keepdims=True)
-
-    mel_save_path = os.path.join(args.output_dir, 'mel_features')
-    os.makedirs(mel_save_path, exist_ok=True)
+    ids = []
+    stats = None
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        worker = functools.partial(_extract_worker, args=args, raw_dir=raw_dir)
+        for id_wav, fea_stats in tqdm(executor.map(worker, wav_files, chunksize=16),
+                                      total=len(wav_files), desc='featurizer'):
+            ids.append(id_wav)
+            stats = fea_stats if stats is None else merge_stats(stats, fea_stats)
+    if stats is None:
+        raise ValueError(f'数据列表 {data_list} 中没有提取到任何特征，无法计算特征的均值和方差')
+    n, mean, m2 = stats
+    fea_mean = mean[:, None].astype(np.float32)
+    fea_std = np.sqrt(m2 / n)[:, None].astype(np.float32)
 
     # 对所有的特征进行正则, 并保存
-    for feat, id_wav in zip(feats, ids):
-        norm_fea = (feat - fea_mean) / fea_std
-        fea_name = os.path.join(mel_save_path, id_wav + '.npy')
-        np.save(fea_name, norm_fea)
+    if args.mel_format == 'packed':
+        # 打包的特征只有一个文件，由主进程依次写入
+        with PackedMelWriter(mel_save_path) as writer:
+            for id_wav in tqdm(ids, desc='normalize'):
+                raw_name = os.path.join(raw_dir, id_wav + '.npy')
+                feat = np.load(raw_name)
+                writer.append(id_wav, (feat - fea_mean) / fea_std)
+                os.remove(raw_name)
+    else:
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            worker = functools.partial(_normalize_worker, raw_dir=raw_dir, mel_save_path=mel_save_path,
+                                       fea_mean=fea_mean, fea_std=fea_std)
+            for _ in tqdm(executor.map(worker, ids, chunksize=16), total=len(ids), desc='normalize'):
+                pass
+    os.rmdir(raw_dir)
 
     static_name = os.path.join(mel_save_path, 'static.npy')
     np.save(static_name, np.array([fea_mean, fea_std], dtype=object))
@@ -91,9 +149,13 @@ if __name__ == "__main__":
     parser.add_argument('--n_mels', type=int, default=80)
     parser.add_argument('--fmin', type=float, default=0.0)
     parser.add_argument('--fmax', type=float, default=fs / 2)
+    parser.add_argument('--mel_format', type=str, default='packed', choices=['packed', 'npy'],
+                        help='packed: one memory-mapped file plus index, npy: one .npy file per utterance')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='number of feature extraction processes')
     args = parser.parse_args()
     print_arguments(args=args)
 
-    waves = glob.glob(r"D:\Ziyad\Voice DataSets\LJSpeech-1.1\wavs\*.wav")
-    processing_wavs(waves, args)
+    wav_pattern = r"D:\Ziyad\Voice DataSets\LJSpeech-1.1\wavs\*.wav"
+    waves = glob.glob(wav_pattern)
+    processing_wavs(waves, args, data_list=wav_pattern)
     # trans_prosody(args)
@@ -0,0 +1,46 @@
+import argparse
+import asyncio
+import functools
+import warnings
+
+from src.predictor import Tacotron2Predictor
+from src.server import SynthesisServer
+from src.utils.utils import add_arguments, print_arguments
+warnings.filterwarnings('ignore')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arg = functools.partial(add_arguments, argparser=parser)
+    add_arg('configs',        str,  'configs/Tacotron2.yml',       "配置文件")
+    add_arg('use_gpu',        bool, False,                         "是否使用GPU预测")
+    add_arg('model_path',     str,  'models/Tacotron2/best_model', "预测模型文件路径")
+    add_arg('quantize',       bool, False,                         "是否使用动态 int8 量化模型，只支持CPU预测")
+    add_arg('enhance',        bool, True,                          "对生成的语音是否去噪")
+    add_arg('host',           str,  '127.0.0.1',                   "服务监听地址")
+    add_arg('port',           int,  8000,                          "服务监听端口")
+    add_arg('max_batch_size', int,  8,                             "每个 batch 最多合成的请求数")
+    add_arg('max_wait_ms',    int,  20,                            "请求最多等待组 batch 的时间（毫秒）")
+    add_arg('max_queue_size', int,  256,                           "最多等待合成的请求数")
+    args = parser.parse_args()
+    print_arguments(args=args)
+
+    predictor = Tacotron2Predictor(configs=args.configs,
+                                   model_path=args.model_path,
+                                   use_gpu=args.use_gpu,
+                                   quantize=args.quantize)
+    server = SynthesisServer(predictor,
+                             host=args.host,
+                             port=args.port,
+                             enhancement=args.enhance,
+                             max_batch_size=args.max_batch_size,
+                             max_wait_ms=args.max_wait_ms,
+                             max_queue_size=args.max_queue_size)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -2,22 +2,45 @@ import os
 
 import torch
 import numpy as np
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
 
+from src.data_utils.mel_store import PackedMelReader, has_packed_mels
+
 
 class Tacotron2Dataset(Dataset):
-    def __init__(self, train_script_path, mel_feat_dir):
+    def __init__(self, train_script_path, mel_feat_dir, mel_format='auto'):
+        """
+        :param train_script_path: 训练数据列表路径
+        :param mel_feat_dir: 梅尔谱文件夹路径
+        :param mel_format: 特征格式，packed 为打包的特征，npy 为每条语音一个 .npy 文件，
+                           auto 表示有打包的特征时使用 packed，否则使用 npy
+        """
         files = np.loadtxt(train_script_path, dtype='str', delimiter='|')
         self.file_ids = files[:, 0].tolist()
         self.index_phone = files[:, 1].tolist()
         self.mel_feat_dir = mel_feat_dir
+        if mel_format == 'auto':
+            mel_format = 'packed' if has_packed_mels(mel_feat_dir) else 'npy'
+        if mel_format not in ('packed', 'npy'):
+            raise ValueError(f'不支持特征格式：{mel_format}')
+        self.packed_mels = PackedMelReader(mel_feat_dir) if mel_format == 'packed' else None
 
     def get_mel(self, file_id):
         """读取特征"""
+        if self.packed_mels is not None:
+            return self.packed_mels.get(file_id)
         file_fea = os.path.join(self.mel_feat_dir, file_id + '.npy')
         melspec = torch.from_numpy(np.load(file_fea))
         return melspec
 
+    def get_mel_lengths(self):
+        """每条数据的 mel 帧数，只读取索引或 .npy 文件头，不读取特征"""
+        if self.packed_mels is not None:
+            return [self.packed_mels.frames(file_id) for file_id in self.file_ids]
+        return [np.load(os.path.join(self.mel_feat_dir, file_id + '.npy'), mmap_mode='r').shape[1]
+                for file_id in self.file_ids]
+
     def get_text(self, str_phones):
         """读取文本编码序列"""
         phone_ids = [int(id) for id in str_phones.split()]
@@ -46,35 +69,74 @@ class TextMelCollate:
         self.n_frames_per_step = n_frames_per_step
 
     def __call__(self, batch):
-        # Right zero-pad all one-hot text sequences to max input length
+        # 按文本长度从长到短排序后一次性补零
         input_lengths, ids_sorted_decreasing = torch.sort(
             torch.LongTensor([len(x[0]) for x in batch]),
             dim=0, descending=True)
-        max_input_len = input_lengths[0]
+        ids_sorted_decreasing = ids_sorted_decreasing.tolist()
 
-        text_padded = torch.LongTensor(len(batch), max_input_len)
-        text_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            text = batch[ids_sorted_decreasing[i]][0]
-            text_padded[i, :text.size(0)] = text
+        # Right zero-pad all one-hot text sequences to max input length
+        text_padded = pad_sequence([batch[i][0].long() for i in ids_sorted_decreasing], batch_first=True)
 
         # Right zero-pad mel-spec
-        num_mels = batch[0][1].size(0)
-        max_target_len = max([x[1].size(1) for x in batch])
+        mels = [batch[i][1] for i in ids_sorted_decreasing]
+        output_lengths = torch.LongTensor([mel.size(1) for mel in mels])
+        num_mels = mels[0].size(0)
+        max_target_len = int(output_lengths.max())
         if max_target_len % self.n_frames_per_step != 0:  # 保证特征的帧长是n_frames_per_step的整数倍
             max_target_len += self.n_frames_per_step - max_target_len % self.n_frames_per_step
             assert max_target_len % self.n_frames_per_step == 0
 
-        # include mel padded and gate padded
-        mel_padded = torch.FloatTensor(len(batch), num_mels, max_target_len)
-        mel_padded.zero_()
-        gate_padded = torch.FloatTensor(len(batch), max_target_len)  # 构建gete 目标 判断生成什么时候结束
-        gate_padded.zero_()
-        output_lengths = torch.LongTensor(len(batch))
-        for i in range(len(ids_sorted_decreasing)):
-            mel = batch[ids_sorted_decreasing[i]][1]
-            mel_padded[i, :, :mel.size(1)] = mel
-            gate_padded[i, mel.size(1) - 1:] = 1
-            output_lengths[i] = mel.size(1)
+        # mel 是 [D, T] 排列的，直接拷贝到补零后的 [B, D, T] 中，每条只拷贝一次，
+        # 比 pad_sequence 先转置再补零少一次整 batch 的拷贝
+        mel_padded = torch.zeros(len(batch), num_mels, max_target_len)
+        for mel_dst, mel in zip(mel_padded, mels):
+            mel_dst[:, :mel.size(1)] = mel
+
+        # 构建gete 目标 判断生成什么时候结束, 每条 mel 的最后一帧及之后为1
+        gate_padded = (torch.arange(max_target_len) >= (output_lengths - 1).unsqueeze(1)).float()
 
         return text_padded, input_lengths, mel_padded, gate_padded, output_lengths
+
+
+class DevicePrefetcher:
+    """
+    提前一个 batch 把数据拷贝到训练设备上
+    使用 CUDA 时在单独的 stream 上做 non_blocking 拷贝，与当前 batch 的计算重叠，
+    DataLoader 需要开启 pin_memory；使用 CPU 训练时直接返回 DataLoader 的数据
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def _to_device(self, batch):
+        if self.stream is None:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return [x.to(self.device, non_blocking=True) for x in batch]
+
+    def _wait(self, batch):
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            for x in batch:
+                # 告诉缓存分配器这块显存在当前 stream 上还在使用
+                x.record_stream(current_stream)
+        return batch
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = next(loader_iter, None)
+        if next_batch is None:
+            return
+        next_batch = self._to_device(next_batch)
+        for batch in loader_iter:
+            current_batch = self._wait(next_batch)
+            next_batch = self._to_device(batch)
+            yield current_batch
+        yield self._wait(next_batch)
+
+    def __len__(self):
+        return len(self.loader)
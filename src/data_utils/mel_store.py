@@ -0,0 +1,97 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+# 打包后的特征文件与索引文件名，均保存在 mel_manifest_dir 中
+PACKED_MEL_FILE = 'mels.bin'
+PACKED_INDEX_FILE = 'mels.json'
+
+
+def has_packed_mels(mel_feat_dir):
+    """判断特征文件夹中是否有打包好的特征"""
+    return os.path.exists(os.path.join(mel_feat_dir, PACKED_INDEX_FILE))
+
+
+class PackedMelWriter:
+    """
+    把所有特征依次写入一个连续的 float32 文件，并记录每条特征的起始位置和帧数
+    每条特征按 D*T 的行优先顺序保存，读取时可以直接 reshape，不需要拷贝
+    """
+
+    def __init__(self, mel_feat_dir):
+        os.makedirs(mel_feat_dir, exist_ok=True)
+        self.mel_feat_dir = mel_feat_dir
+        self.f = open(os.path.join(mel_feat_dir, PACKED_MEL_FILE), 'wb')
+        self.n_mels = None
+        self.ids, self.offsets, self.frames = [], [], []
+        self.offset = 0
+
+    def append(self, file_id, mel):
+        """
+        :param file_id: 特征的id，与训练数据列表中的id对应
+        :param mel: D*T 的特征
+        """
+        mel = np.ascontiguousarray(mel, dtype=np.float32)
+        if self.n_mels is None:
+            self.n_mels = mel.shape[0]
+        assert mel.shape[0] == self.n_mels, f'{file_id} 的特征维度与其他特征不一致'
+        mel.tofile(self.f)
+        self.ids.append(file_id)
+        self.offsets.append(self.offset)
+        self.frames.append(mel.shape[1])
+        self.offset += mel.size
+
+    def close(self):
+        self.f.close()
+        index = {'n_mels': self.n_mels, 'dtype': 'float32',
+                 'ids': self.ids, 'offsets': self.offsets, 'frames': self.frames}
+        index_path = os.path.join(self.mel_feat_dir, PACKED_INDEX_FILE)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PackedMelReader:
+    """
+    读取打包好的特征，特征文件以 np.memmap 方式打开，每条特征是 memmap 上的一个切片
+    memmap 在第一次读取时才打开，这样 DataLoader 的每个子进程都会有自己的映射
+    """
+
+    def __init__(self, mel_feat_dir):
+        self.mel_feat_dir = mel_feat_dir
+        with open(os.path.join(mel_feat_dir, PACKED_INDEX_FILE), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.n_mels = index['n_mels']
+        self.dtype = np.dtype(index['dtype'])
+        self.index = {file_id: (offset, frames)
+                      for file_id, offset, frames in zip(index['ids'], index['offsets'], index['frames'])}
+        self._mels = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mels'] = None
+        return state
+
+    def __contains__(self, file_id):
+        return file_id in self.index
+
+    def frames(self, file_id):
+        """特征的帧数，不需要读取特征"""
+        return self.index[file_id][1]
+
+    def get(self, file_id):
+        """返回 D*T 的特征，与 memmap 共享内存"""
+        if self._mels is None:
+            # 'c' 为写时复制模式，读取时不拷贝，得到的数组可写，torch.from_numpy 不会告警
+            self._mels = np.memmap(os.path.join(self.mel_feat_dir, PACKED_MEL_FILE), dtype=self.dtype, mode='c')
+        offset, frames = self.index[file_id]
+        mel = self._mels[offset:offset + self.n_mels * frames].reshape(self.n_mels, frames)
+        return torch.from_numpy(mel)
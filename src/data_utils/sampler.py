@@ -0,0 +1,119 @@
+import random
+
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """
+    按 mel 长度分桶的 batch 采样器
+    先按长度排序并切分成若干个桶，桶内打乱后按帧数预算组 batch：
+    batch 内补零后的总帧数（条数 * 最长帧数）不超过 max_frames，
+    这样同一个 batch 的长度接近，补零帧少，batch 的条数随长度自动变化
+    分布式训练时每个进程使用相同的 seed 组出相同的 batch，再按 rank 间隔选取，各进程的 batch 数相同
+    """
+
+    def __init__(self, lengths, max_frames, bucket_size=None, max_batch_size=None,
+                 pad_multiple=1, shuffle=True, drop_last=False, seed=0, num_replicas=1, rank=0):
+        """
+        :param lengths: 每条数据的 mel 帧数
+        :param max_frames: 每个 batch 补零后的最大总帧数
+        :param bucket_size: 每个桶的数据条数，为 None 时取数据总数的 1/20
+        :param max_batch_size: 每个 batch 最多的数据条数，为 None 时不限制
+        :param pad_multiple: 补零后的帧数是它的整数倍，与 n_frames_per_step 相同
+        :param shuffle: 是否打乱桶内的数据和 batch 的顺序
+        :param drop_last: 最后一个 batch 不满帧数预算的一半时是否丢弃
+        :param seed: 随机种子，每个 epoch 的顺序由 seed 和 set_epoch 设置的 epoch 决定
+        :param num_replicas: 分布式训练的进程数
+        :param rank: 当前进程的序号
+        """
+        self.lengths = list(lengths)
+        self.max_frames = max_frames
+        self.bucket_size = bucket_size or max(len(self.lengths) // 20, 1)
+        self.max_batch_size = max_batch_size
+        self.pad_multiple = pad_multiple
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        too_long = [length for length in self.lengths if self._padded(length) > max_frames]
+        assert not too_long, f'有 {len(too_long)} 条数据的帧数超过了 max_frames={max_frames}'
+        self.epoch = 0
+        self._batches = self._build_batches()
+
+    def _padded(self, length):
+        return -(-length // self.pad_multiple) * self.pad_multiple
+
+    def _build_batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        # 长度相同的数据随机排列，使每个 epoch 的分桶结果不同
+        keys = [rng.random() for _ in self.lengths] if self.shuffle else [0] * len(self.lengths)
+        indices = sorted(range(len(self.lengths)), key=lambda i: (self.lengths[i], keys[i]))
+        batches = []
+        # 每个桶最后一个没有装满的 batch 并入下一个桶
+        batch, max_len = [], 0
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            if self.shuffle:
+                rng.shuffle(bucket)
+            for index in bucket:
+                new_max_len = max(max_len, self._padded(self.lengths[index]))
+                if batch and (new_max_len * (len(batch) + 1) > self.max_frames
+                              or (self.max_batch_size and len(batch) >= self.max_batch_size)):
+                    batches.append(batch)
+                    batch, new_max_len = [], self._padded(self.lengths[index])
+                batch.append(index)
+                max_len = new_max_len
+        if batch and not (self.drop_last and max_len * len(batch) < self.max_frames / 2):
+            batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        if self.num_replicas > 1:
+            # 丢掉最后不够每个进程分一个的 batch，否则各进程的步数不同，梯度同步会一直等待
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+            batches = batches[self.rank::self.num_replicas]
+        return batches
+
+    def set_epoch(self, epoch):
+        """设置当前 epoch，重新分桶组 batch"""
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = self._build_batches()
+
+    def padding_efficiency(self):
+        """有效帧数占补零后总帧数的比例"""
+        valid, padded = 0, 0
+        for batch in self._batches:
+            valid += sum(self.lengths[i] for i in batch)
+            padded += len(batch) * max(self._padded(self.lengths[i]) for i in batch)
+        return valid / max(padded, 1)
+
+    def __iter__(self):
+        return iter(self._batches)
+
+    def __len__(self):
+        return len(self._batches)
+
+
+class ResumableBatchSampler(Sampler):
+    """
+    包装一个 batch 采样器，恢复训练时跳过当前 epoch 已经训练过的 batch，不会读取这些 batch 的数据
+    被包装的采样器每个 epoch 的顺序只由 seed 与 set_epoch 决定，跳过之后剩下的 batch 与中断前完全相同
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.start = 0
+
+    def skip(self, num_batches):
+        """下一次遍历时跳过前 num_batches 个 batch，只生效一次"""
+        self.start = num_batches
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        for i, batch in enumerate(self.batch_sampler):
+            if i >= start:
+                yield batch
+
+    def __len__(self):
+        return len(self.batch_sampler) - self.start
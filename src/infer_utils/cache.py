@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from src.infer_utils.frontend import _file_hash
+from src.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def model_fingerprint(model_path, configs, static_path, quantized=False, decode_settings=None):
+    """
+    模型权重、mel 统计信息以及影响合成结果的配置共同的 sha1
+    任何一项改变后缓存的 key 都会改变，旧的缓存自然失效
+    :param decode_settings: Decoder 实际使用的解码参数，例如提前停止的条件，配置文件中没有的项使用代码中的默认值，
+                            只哈希配置文件时默认值改变不会让缓存失效
+    """
+    sha1 = hashlib.sha1(_file_hash(model_path, static_path).encode())
+    if quantized:
+        sha1.update(b'|int8')
+    # model_conf 中的 attention_window、gate_threshold、max_decoder_steps 等参数都会改变解码得到的 mel
+    for name in ('preprocess_conf', 'vocoder_conf', 'model_conf'):
+        sha1.update(json.dumps(configs.get(name, {}), sort_keys=True, default=str).encode())
+    if decode_settings is not None:
+        sha1.update(json.dumps(decode_settings, sort_keys=True, default=str).encode())
+    return sha1.hexdigest()
+
+
+class SynthesisCache:
+    """
+    以内容为 key 的合成结果缓存，key 为 模型指纹 + 音素编码序列 + 是否去噪 + 随机种子 的 sha1
+    - 内存层：按字节数限制大小的 LRU
+    - 磁盘层：每条语音一个 .npy 文件，总大小超过上限时删除最久没有使用的文件
+    内存层没有命中时查询磁盘层，磁盘层命中的结果会放回内存层
+    """
+
+    def __init__(self, fingerprint, cache_dir=None, max_memory_mb=256, max_disk_mb=1024):
+        """
+        :param fingerprint: model_fingerprint 计算得到的模型指纹
+        :param cache_dir: 磁盘缓存文件夹，为 None 时只使用内存缓存
+        :param max_memory_mb: 内存缓存的最大大小（MB）
+        :param max_disk_mb: 磁盘缓存的最大大小（MB）
+        """
+        self.fingerprint = fingerprint
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        # 服务端在线程池中合成，读写需要加锁
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # 按修改时间恢复磁盘层的使用顺序
+            entries = []
+            for name in os.listdir(cache_dir):
+                if name.endswith('.npy'):
+                    stat = os.stat(os.path.join(cache_dir, name))
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    def key(self, coded_text, enhancement, seed=None):
+        """计算一条音素编码序列的缓存 key"""
+        sha1 = hashlib.sha1(self.fingerprint.encode())
+        sha1.update(np.asarray(coded_text, dtype=np.int64).tobytes())
+        sha1.update(f'|{bool(enhancement)}|{seed}'.encode())
+        return sha1.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def get(self, key):
+        """返回缓存的语音，没有命中时返回 None"""
+        with self._lock:
+            wav = self._memory.get(key)
+            if wav is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return wav
+            if key in self._disk:
+                try:
+                    wav = np.load(self._path(key))
+                    os.utime(self._path(key))
+                except (OSError, ValueError):
+                    # 文件被其他进程删除或者不完整
+                    self._disk_bytes -= self._disk.pop(key)
+                else:
+                    self._disk.move_to_end(key)
+                    self._put_memory(key, wav)
+                    self.disk_hits += 1
+                    return wav
+            self.misses += 1
+            return None
+
+    def put(self, key, wav):
+        """保存一条语音到内存层和磁盘层"""
+        wav = np.ascontiguousarray(wav, dtype=np.float32)
+        with self._lock:
+            self._put_memory(key, wav)
+            if self.cache_dir is not None and key not in self._disk:
+                path = self._path(key)
+                tmp_path = f'{path}.tmp{os.getpid()}'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, wav)
+                os.replace(tmp_path, path)
+                size = os.path.getsize(path)
+                self._disk[key] = size
+                self._disk_bytes += size
+                self._evict_disk()
+
+    def _put_memory(self, key, wav):
+        if wav.nbytes > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key).nbytes
+        self._memory[key] = wav
+        self._memory_bytes += wav.nbytes
+        while self._memory_bytes > self.max_memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= old.nbytes
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """命中与未命中计数以及各层的当前大小"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else None,
+                'memory_items': len(self._memory),
+                'memory_mb': round(self._memory_bytes / 1024 / 1024, 2),
+                'disk_items': len(self._disk),
+                'disk_mb': round(self._disk_bytes / 1024 / 1024, 2)}
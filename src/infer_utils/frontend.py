@@ -0,0 +1,151 @@
+import hashlib
+import os
+import re
+
+import numpy as np
+
+import text
+from src.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# 句子以 .!? 结尾，分句以 ,;: 结尾，标点保留在前一段的末尾
+_SENTENCE_RE = re.compile(r'[^.!?]+[.!?]*')
+_CLAUSE_RE = re.compile(r'[^,;:]+[,;:]*')
+
+
+def _file_hash(*paths):
+    """计算若干文件内容的 sha1，用于判断编译缓存是否失效"""
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class CompiledLexicon:
+    """
+    编译后的发音词典
+    将 cmudict.txt 与 symbol_index.txt 编译为三个 .npy 文件:
+        words.npy:   按字节序排序的单词, 定长 bytes 数组
+        offsets.npy: 每个单词的音素编码在 ids.npy 中的起止位置, 长度为单词数 + 1
+        ids.npy:     所有单词的音素编码拼接而成的数组
+    编译结果保存在 cache_dir/lexicon_<sha1> 目录下, 源文件变化后 sha1 改变会自动重新编译。
+    加载时使用 mmap 方式打开, 查询单词时对 words 做二分查找, 不需要解析任何文本文件。
+    """
+
+    def __init__(self, lexicon_path, symbol_index_path, cache_dir=None):
+        """
+        :param lexicon_path: cmudict.txt 的路径
+        :param symbol_index_path: symbol_index.txt 的路径
+        :param cache_dir: 编译结果的缓存文件夹, 为 None 时使用 lexicon_path 所在文件夹下的 .frontend_cache
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(lexicon_path)), '.frontend_cache')
+        digest = _file_hash(lexicon_path, symbol_index_path)
+        compiled_dir = os.path.join(cache_dir, f'lexicon_{digest}')
+        if not os.path.exists(os.path.join(compiled_dir, 'ids.npy')):
+            self.compile(lexicon_path, symbol_index_path, compiled_dir)
+        self.words = np.load(os.path.join(compiled_dir, 'words.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(compiled_dir, 'offsets.npy'), mmap_mode='r')
+        self.ids = np.load(os.path.join(compiled_dir, 'ids.npy'), mmap_mode='r')
+
+    @staticmethod
+    def compile(lexicon_path, symbol_index_path, compiled_dir):
+        """解析文本格式的词典与音素表, 保存为可 mmap 的 .npy 文件"""
+        logger.info(f'编译发音词典：{lexicon_path} -> {compiled_dir}')
+        symbol_index = {}
+        with open(symbol_index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                x = line.split()
+                symbol_index[x[0]] = int(x[1])
+        set_words = {}
+        with open(lexicon_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                words = line.split()
+                if len(words) > 1:
+                    set_words[words[0].encode('utf-8')] = [symbol_index[p] for p in words[1:]]
+
+        keys = sorted(set_words.keys())
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(set_words[k]) for k in keys])
+        ids = np.fromiter((i for k in keys for i in set_words[k]), dtype=np.int16, count=int(offsets[-1]))
+
+        # 先写入临时文件夹再改名, 避免多个进程同时编译时读到不完整的文件
+        tmp_dir = f'{compiled_dir}.tmp{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, 'words.npy'), np.array(keys, dtype=bytes))
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_dir, 'ids.npy'), ids)
+        try:
+            os.replace(tmp_dir, compiled_dir)
+        except OSError:
+            # 其他进程已经编译完成
+            for name in os.listdir(tmp_dir):
+                os.remove(os.path.join(tmp_dir, name))
+            os.rmdir(tmp_dir)
+
+    def lookup(self, word):
+        """查询单词的音素编码，词典中没有时返回 None"""
+        key = word.encode('utf-8')
+        i = int(np.searchsorted(self.words, key))
+        if i < len(self.words) and self.words[i] == key:
+            return self.ids[self.offsets[i]:self.offsets[i + 1]]
+        return None
+
+    def __contains__(self, word):
+        return self.lookup(word) is not None
+
+    def __len__(self):
+        return len(self.words)
+
+
+class TextFrontend:
+    """
+    预测用的文本前端
+    发音词典、音素表只在初始化时加载一次, 之后 text_to_sequence 不再读取任何文件
+    """
+
+    def __init__(self, lexicon_path='cmudict.txt', symbol_index_path='symbol_index.txt', cache_dir=None):
+        self.lexicon = CompiledLexicon(lexicon_path, symbol_index_path, cache_dir=cache_dir)
+
+    def text_to_sequence(self, sentence):
+        """将文本转换为音素编码序列，词典中没有的单词直接跳过"""
+        ind = []
+        for word in text.preprocess_sent(sentence):
+            phonemes = self.lexicon.lookup(word)
+            if phonemes is None:
+                continue
+            ind.extend(phonemes.tolist())
+        return ind
+
+    def split(self, sentence, max_phonemes=150):
+        """
+        将长文本切分为若干段音素编码序列，每段不超过 max_phonemes 个音素
+        先按句子切分，句子过长时把相邻的分句合并到不超过 max_phonemes，单个分句仍然过长时按单词切分
+        :param sentence: 待切分的文本
+        :param max_phonemes: 每段最多的音素个数
+        :return: (音素编码序列, 切分位置) 的列表，切分位置为 'sentence'、'clause' 或 'word'
+        """
+        chunks = []
+        for sent in _SENTENCE_RE.findall(sentence):
+            current = []
+            for clause in _CLAUSE_RE.findall(sent):
+                words = [phonemes.tolist() for phonemes in map(self.lexicon.lookup, text.preprocess_sent(clause))
+                         if phonemes is not None]
+                clause_len = sum(len(w) for w in words)
+                if current and len(current) + clause_len > max_phonemes:
+                    chunks.append((current, 'clause'))
+                    current = []
+                if clause_len <= max_phonemes:
+                    current.extend(i for w in words for i in w)
+                    continue
+                for w in words:
+                    if current and len(current) + len(w) > max_phonemes:
+                        chunks.append((current, 'word'))
+                        current = []
+                    current.extend(w)
+            if current:
+                chunks.append((current, 'sentence'))
+        return chunks
@@ -3,6 +3,8 @@ from typing import Union
 
 import librosa
 import numpy as np
+import scipy.signal
+from numpy.lib.stride_tricks import sliding_window_view
 from xpinyin import Pinyin
 
 from src.data_utils.utils import pinyin_2_phoneme
@@ -46,14 +48,7 @@ def speech_enhance(*,
     Returns:
         enhanced_wav: np.ndarray
     """
-    if isinstance(wave_data, str):
-        if not os.path.exists(wave_data):
-            raise FileNotFoundError(f'Input wav file path is incorrect')
-        noisy_wav, _ = librosa.load(wave_data, sr=None)
-    elif isinstance(wave_data, np.ndarray):
-        noisy_wav = wave_data
-    else:
-        raise ValueError(f'Wave_data only support `[str, np.ndarray]`')
+    noisy_wav = _load_wave(wave_data)
 
     if method == 1:
         enhanced_wav = _sub_spec1(noisy_wav, n_fft, hop_length, win_length, noise_frame)
@@ -110,21 +105,118 @@ def _sub_spec2(wav_data, n_fft, hop_length, win_length, noise_frame, alpha, beta
     return enhanced_wav
 
 
-def _sub_spec3(wav_data, n_fft, hop_length, win_length, noise_frame, alpha, beta, gamma):
-    spec_raw = librosa.stft(wav_data, n_fft=n_fft, hop_length=hop_length, win_length=win_length)  # D x T
-    D, T = np.shape(spec_raw)
-    mag_raw = np.abs(spec_raw)
-    phase_raw = np.angle(spec_raw)
-    assert noise_frame < T
-    mag_noise = np.mean(np.abs(spec_raw[:, :noise_frame]), axis=1, keepdims=True)
+def speech_enhance_stream(*,
+                          wave_data: Union[str, np.ndarray],
+                          n_fft: int,
+                          hop_length: int,
+                          win_length: int,
+                          noise_frame: int = 30,
+                          alpha: int = 4,
+                          beta: float = 0.0001,
+                          gamma: int = 1,
+                          block_frames: int = 256):
+    """
+    分块的平滑法语音增强（method=3），每次只对 block_frames 帧 STFT 做处理，内存占用与语音长度无关
+    拼接所有输出块即为 speech_enhance(method=3) 的结果（STFT 补零方式与 librosa>=0.10 相同）
+    Args:
+        wave_data: 语音文件路径，或已经读取完毕的numpy格式
+        n_fft: 傅里叶变换参数
+        hop_length: 傅里叶变换参数
+        win_length: 傅里叶变换参数
+        noise_frame: 前多少帧当作噪音信号
+        alpha: 过减法参数
+        beta: 过减法参数
+        gamma: 过减法参数
+        block_frames: 每块处理的 STFT 帧数
+
+    Yields:
+        enhanced_wav: np.ndarray，按时间顺序输出的增强后语音片段
+    """
+    wav = _load_wave(wave_data)
+    n_frames = 1 + len(wav) // hop_length
+    assert noise_frame < n_frames
+    assert block_frames > 0
+    k = 1
+    pad = n_fft // 2
+    out_len = hop_length * (n_frames - 1)
+    window = librosa.util.pad_center(scipy.signal.get_window('hann', win_length, fftbins=True), size=n_fft)
+    win_sq = window ** 2
+
+    def stft_frames(start, stop):
+        """计算第 start 到 stop-1 帧的 STFT，两端按 center=True 的方式补零"""
+        seg_start = start * hop_length - pad
+        seg_stop = (stop - 1) * hop_length + n_fft - pad
+        segment = np.zeros(seg_stop - seg_start, dtype=wav.dtype)
+        lo, hi = max(seg_start, 0), min(seg_stop, len(wav))
+        segment[lo - seg_start:hi - seg_start] = wav[lo:hi]
+        return librosa.stft(segment, n_fft=n_fft, hop_length=hop_length, win_length=win_length, center=False)
+
+    # 噪声估计只需要前 noise_frame 帧
+    mag_noise_raw = np.abs(stft_frames(0, noise_frame))
+    mag_noise = np.mean(mag_noise_raw, axis=1, keepdims=True)
     power_noise = mag_noise ** 2
-    power_noise = np.tile(power_noise, [1, T])
+    max_residual_error = np.max(mag_noise_raw - mag_noise, axis=1)
+
+    # 重叠相加缓存，起点为补零后信号中第 frame_start * hop_length 个采样点
+    tail_y, tail_sum = np.zeros(0), np.zeros(0)
+    emitted = pad
+    for frame_start in range(0, n_frames, block_frames):
+        frame_stop = min(frame_start + block_frames, n_frames)
+        # 平滑与最小值替换各需要左右 k 帧上下文
+        ctx_start, ctx_stop = max(frame_start - 2 * k, 0), min(frame_stop + 2 * k, n_frames)
+        spec_raw = stft_frames(ctx_start, ctx_stop)
+        mag_enhanced = _sub_spec3_mag(np.abs(spec_raw), power_noise, max_residual_error, alpha, beta, gamma, k)
+        spec_raw = spec_raw[:, frame_start - ctx_start:frame_stop - ctx_start]
+        mag_enhanced = mag_enhanced[:, frame_start - ctx_start:frame_stop - ctx_start]
+        spec_enhanced = mag_enhanced * np.exp(1j * np.angle(spec_raw))
+
+        frames = window[:, None] * np.fft.irfft(spec_enhanced, n=n_fft, axis=0)
+        size = (frame_stop - frame_start - 1) * hop_length + n_fft
+        y = np.zeros(size, dtype=frames.dtype)
+        y_sum = np.zeros(size, dtype=frames.dtype)
+        y[:len(tail_y)] += tail_y
+        y_sum[:len(tail_sum)] += tail_sum
+        for i in range(frames.shape[1]):
+            y[i * hop_length:i * hop_length + n_fft] += frames[:, i]
+            y_sum[i * hop_length:i * hop_length + n_fft] += win_sq
+
+        # 之后的帧不会再影响 frame_stop * hop_length 之前的采样点
+        done = size if frame_stop == n_frames else (frame_stop - frame_start) * hop_length
+        tail_y, tail_sum = y[done:], y_sum[done:]
+        chunk, chunk_sum = y[:done], y_sum[:done]
+        nonzero = chunk_sum > librosa.util.tiny(chunk_sum)
+        chunk[nonzero] /= chunk_sum[nonzero]
+
+        # 去掉 center=True 时两端补的 n_fft // 2 个点
+        offset = frame_start * hop_length
+        lo, hi = max(emitted, offset), min(offset + done, pad + out_len)
+        if hi > lo:
+            yield chunk[lo - offset:hi - offset]
+            emitted = hi
+
+
+def _load_wave(wave_data):
+    if isinstance(wave_data, str):
+        if not os.path.exists(wave_data):
+            raise FileNotFoundError(f'Input wav file path is incorrect')
+        noisy_wav, _ = librosa.load(wave_data, sr=None)
+    elif isinstance(wave_data, np.ndarray):
+        noisy_wav = wave_data
+    else:
+        raise ValueError(f'Wave_data only support `[str, np.ndarray]`')
+    return noisy_wav
 
+
+def _sub_spec3_mag(mag_raw, power_noise, max_residual_error, alpha, beta, gamma, k):
+    """
+    平滑法的幅度谱处理，沿帧方向用滑动窗口求均值与最小值，首尾 k 帧不做处理
+    mag_raw: D x T 的幅度谱
+    """
+    T = mag_raw.shape[1]
     # 平滑
     mag_smoothed = np.copy(mag_raw)
-    k = 1
-    for t in range(k, T - k):
-        mag_smoothed[:, t] = np.mean(mag_raw[:, t - k:t + k + 1], axis=1)
+    if T > 2 * k:
+        mag_smoothed[:, k:T - k] = sliding_window_view(mag_raw, 2 * k + 1, axis=1).mean(axis=-1)
     power_smoothed = mag_smoothed ** 2
 
     # 过减法去噪
@@ -134,15 +226,28 @@ def _sub_spec3(wav_data, n_fft, hop_length, win_length, noise_frame, alpha, beta
     power_enhanced = mask * power_enhanced + beta * (1 - mask) * power_noise
     mag_enhanced = np.sqrt(power_enhanced)
 
+    # 小于最大噪声残差的点用邻近帧的最小值替代
+    mag_enhanced_new = np.copy(mag_enhanced)
+    if T > 2 * k:
+        mag_min = sliding_window_view(mag_enhanced, 2 * k + 1, axis=1).min(axis=-1)
+        center = mag_enhanced[:, k:T - k]
+        mag_enhanced_new[:, k:T - k] = np.where(center < max_residual_error[:, None], mag_min, center)
+    return mag_enhanced_new
+
+
+def _sub_spec3(wav_data, n_fft, hop_length, win_length, noise_frame, alpha, beta, gamma):
+    spec_raw = librosa.stft(wav_data, n_fft=n_fft, hop_length=hop_length, win_length=win_length)  # D x T
+    D, T = np.shape(spec_raw)
+    mag_raw = np.abs(spec_raw)
+    phase_raw = np.angle(spec_raw)
+    assert noise_frame < T
+    mag_noise = np.mean(np.abs(spec_raw[:, :noise_frame]), axis=1, keepdims=True)
+    power_noise = mag_noise ** 2
+
     # 计算最大噪声残差
     max_residual_error = np.max(np.abs(spec_raw[:, :noise_frame]) - mag_noise, axis=1)
-    mag_enhanced_new = np.copy(mag_enhanced)
-    k = 1
-    for t in range(k, T - k):
-        index = np.where(mag_enhanced[:, t] < max_residual_error)[0]
-        temp = np.min(mag_enhanced[:, t - k:t + k + 1], axis=1)
-        mag_enhanced_new[index, t] = temp[index]
-        
+    mag_enhanced_new = _sub_spec3_mag(mag_raw, power_noise, max_residual_error, alpha, beta, gamma, k=1)
+
     spec_enhanced = mag_enhanced_new * np.exp(1j * phase_raw)
     enhanced_wav = librosa.istft(spec_enhanced, hop_length=hop_length, win_length=win_length)
     return enhanced_wav
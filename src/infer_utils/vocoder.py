@@ -0,0 +1,124 @@
+import functools
+
+import librosa
+import numpy as np
+import torch
+
+
+@functools.lru_cache(maxsize=None)
+def _mel_basis(fs, n_fft, n_mels, fmin, fmax, device):
+    """梅尔滤波器组、它的伪逆以及非负最小二乘梯度的 Lipschitz 常数 ||M||_2^2，同一组预处理参数只计算一次"""
+    mel_basis = librosa.filters.mel(sr=fs, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax)
+    mel_basis = torch.from_numpy(mel_basis).float()
+    mel_inverse = torch.linalg.pinv(mel_basis)
+    lipschitz = torch.linalg.matrix_norm(mel_basis.double(), ord=2).item() ** 2
+    return mel_basis.to(device), mel_inverse.to(device), lipschitz
+
+
+@functools.lru_cache(maxsize=None)
+def _hann_window(win_length, device):
+    return torch.hann_window(win_length, periodic=True, device=device)
+
+
+class GriffinLimVocoder:
+    """
+    基于 torch.stft/istft 的 Griffin-Lim 声码器
+    - 与 librosa.feature.inverse.mel_to_stft 一样用非负最小二乘把 power mel 谱映射回线性幅度谱，
+      以缓存的伪逆解为初值，在 torch 中做少量加速投影梯度迭代，不再调用 scipy
+    - 一次处理一个 batch 的 mel 谱
+    - momentum > 0 时为 fast Griffin-Lim（Perraudin 等人提出的带动量的版本），momentum=0 即原始 Griffin-Lim
+    """
+
+    def __init__(self, preprocess_conf, n_iter=32, momentum=0.99, nnls_iter=50, device='cpu'):
+        """
+        :param preprocess_conf: 配置文件中的 preprocess_conf
+        :param n_iter: Griffin-Lim 迭代次数
+        :param momentum: fast Griffin-Lim 的动量
+        :param nnls_iter: mel 谱求逆的非负最小二乘迭代次数，0 表示只使用截断为非负的伪逆解
+        :param device: 计算所用的设备
+        """
+        self.n_fft = preprocess_conf.n_fft
+        self.hop_length = preprocess_conf.hop_length
+        self.win_length = preprocess_conf.win_length
+        self.n_iter = n_iter
+        self.momentum = momentum
+        self.nnls_iter = nnls_iter
+        self.device = torch.device(device)
+        self.mel_basis, self.mel_inverse, self.lipschitz = _mel_basis(preprocess_conf.fs, preprocess_conf.n_fft,
+                                                      preprocess_conf.n_mel_channels,
+                                                      float(preprocess_conf.fmin), float(preprocess_conf.fmax),
+                                                      self.device)
+        self.window = _hann_window(self.win_length, self.device)
+
+    def mel_to_magnitude(self, mel_power):
+        """
+        power mel 谱 [B, n_mels, T] -> 线性幅度谱 [B, n_fft // 2 + 1, T]
+        求 min ||M x - mel_power||^2, x >= 0 的解：截断为非负的伪逆解只是初值，与 librosa 的 nnls 结果相差较大，
+        之后做 nnls_iter 次 FISTA（带 Nesterov 动量的投影梯度）迭代，步长为 1 / ||M||_2^2
+        """
+        power = torch.matmul(self.mel_inverse, mel_power).clamp_(min=0)
+        if self.nnls_iter > 0:
+            mel_basis_t = self.mel_basis.t()
+            target = torch.matmul(mel_basis_t, mel_power)
+            point, t = power, 1.0
+            for _ in range(self.nnls_iter):
+                grad = torch.matmul(mel_basis_t, torch.matmul(self.mel_basis, point)) - target
+                new_power = (point - grad / self.lipschitz).clamp_(min=0)
+                new_t = (1 + (1 + 4 * t * t) ** 0.5) / 2
+                point = new_power + ((t - 1) / new_t) * (new_power - power)
+                power, t = new_power, new_t
+        return power.sqrt_()
+
+    def _stft(self, wav):
+        return torch.stft(wav, n_fft=self.n_fft, hop_length=self.hop_length, win_length=self.win_length,
+                          window=self.window, center=True, pad_mode='constant', return_complex=True)
+
+    def _istft(self, spec, length):
+        return torch.istft(spec, n_fft=self.n_fft, hop_length=self.hop_length, win_length=self.win_length,
+                           window=self.window, center=True, length=length)
+
+    def griffin_lim(self, magnitude, generator=None):
+        """
+        由幅度谱估计相位并重建语音
+        :param magnitude: [B, n_fft // 2 + 1, T] 线性幅度谱
+        :param generator: 初始随机相位所用的 torch.Generator，为 None 时使用全局随机状态
+        :return: [B, hop_length * (T - 1)] 语音
+        """
+        length = self.hop_length * (magnitude.size(-1) - 1)
+        angles = torch.rand(magnitude.shape, generator=generator, device=magnitude.device)
+        angles = torch.polar(torch.ones_like(angles), 2 * np.pi * angles)
+        rebuilt = torch.zeros_like(angles)
+        eps = 1e-16
+        for _ in range(self.n_iter):
+            tprev = rebuilt
+            inverse = self._istft(magnitude * angles, length)
+            rebuilt = self._stft(inverse)
+            angles = rebuilt - (self.momentum / (1 + self.momentum)) * tprev
+            angles = angles / (angles.abs() + eps)
+        return self._istft(magnitude * angles, length)
+
+    @torch.no_grad()
+    def __call__(self, mel_power, mel_lengths=None, generator=None):
+        """
+        :param mel_power: [B, n_mels, T] 或 [n_mels, T] 的 power mel 谱，numpy 或 torch 格式
+        :param mel_lengths: [B] 每条 mel 谱的有效帧数，为 None 时认为没有补零
+        :param generator: 初始随机相位所用的 torch.Generator
+        :return: 语音 [B, N] 以及每条语音的有效采样点数 [B]
+        """
+        if isinstance(mel_power, np.ndarray):
+            mel_power = torch.from_numpy(mel_power)
+        mel_power = mel_power.to(self.device, torch.float32)
+        if mel_power.dim() == 2:
+            mel_power = mel_power.unsqueeze(0)
+        B, _, T = mel_power.shape
+        if mel_lengths is None:
+            mel_lengths = torch.full((B,), T, dtype=torch.long)
+        mel_lengths = torch.as_tensor(mel_lengths, dtype=torch.long, device=self.device)
+
+        magnitude = self.mel_to_magnitude(mel_power)
+        # 补零帧的幅度置0，避免在迭代中把能量泄露到有效帧
+        frame_mask = torch.arange(T, device=self.device) < mel_lengths.unsqueeze(1)
+        magnitude = magnitude * frame_mask.unsqueeze(1)
+        wav = self.griffin_lim(magnitude, generator=generator)
+        wav_lengths = self.hop_length * (mel_lengths - 1).clamp(min=0)
+        return wav, wav_lengths
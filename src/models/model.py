@@ -1,11 +1,14 @@
 from math import sqrt
+from typing import List
 
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 from src.models.layers import LinearNorm, ConvNorm
+from src.utils.metrics import metrics
 
 # The resulting mask indicates which positions within each sequence are considered valid (within the given lengths) and which positions are considered invalid (beyond the given lengths).
 # if len = [2,3,5] mask --> [[t,t,f,f,f],[t,t,t,f,f],[t,t,t,t,t]]
@@ -105,6 +108,71 @@ class Attention(nn.Module):
 
         return attention_context, attention_weights
 
+    def forward_windowed(self, attention_hidden_state, memory, processed_memory,
+                         attention_weights, attention_weights_cum, mask, window):
+        """
+        只在上一步注意力峰值附近的 window 个位置上计算注意力, 用于预测
+        对齐是单调的, 窗口从峰值前 window // 4 个位置开始; location 卷积只计算窗口内的输出,
+        输入多取卷积核一半宽度的边界, 窗口内的 location 特征与完整注意力完全相同
+        每一步 location 卷积、energies、softmax 与 context 的计算量只与 window 有关, 与文本长度无关
+        PARAMS
+        ------
+        attention_weights: 上一步的注意力权重 [B, T]
+        attention_weights_cum: 累积的注意力权重 [B, T]
+        window: 窗口大小, 需小于 T
+
+        RETURNS
+        -------
+        attention_context: [B, encoder_embedding_dim]
+        attention_weights: [B, T] 窗口外为0
+        """
+        B, T = attention_weights.shape
+        conv = self.location_layer.location_conv.conv
+        half = (conv.kernel_size[0] - 1) // 2
+        start = (attention_weights.argmax(dim=1) - window // 4).clamp(min=0, max=T - window)  # [B]
+        processed_query = self.query_layer(attention_hidden_state.unsqueeze(1))  # [B,1,128]
+        if B == 1:
+            # 只有一条数据时直接切片, 比 gather 少很多小算子
+            start = int(start)
+            low, high = start - half, start + window + half
+            attention_weights_cat = torch.stack((attention_weights, attention_weights_cum), dim=1)
+            attention_weights_cat = F.pad(attention_weights_cat[:, :, max(low, 0):min(high, T)],
+                                          (max(-low, 0), max(high - T, 0)))
+            processed_attention_weights = self.location_layer.location_dense(
+                F.conv1d(attention_weights_cat, conv.weight, conv.bias).transpose(1, 2))  # [1,W,128]
+            energies = self.v(torch.tanh(
+                processed_query + processed_attention_weights
+                + processed_memory[:, start:start + window])).squeeze(-1)  # [1,W]
+            if mask is not None:
+                energies.masked_fill_(mask[:, start:start + window], self.score_mask_value)
+            window_weights = torch.softmax(energies, dim=1)
+            attention_context = torch.bmm(window_weights.unsqueeze(1),
+                                          memory[:, start:start + window]).squeeze(1)
+            attention_weights = attention_weights.new_zeros(B, T)
+            attention_weights[:, start:start + window] = window_weights
+            return attention_context, attention_weights
+
+        # 窗口加上卷积的边界, 超出 [0, T) 的位置相当于卷积的补零
+        index = start.unsqueeze(1) + torch.arange(-half, window + half, device=start.device)  # [B,W+2*half]
+        valid = ((index >= 0) & (index < T)).unsqueeze(1)
+        index = index.clamp(0, T - 1)
+        attention_weights_cat = torch.stack(
+            (attention_weights.gather(1, index), attention_weights_cum.gather(1, index)), dim=1) * valid
+        processed_attention_weights = self.location_layer.location_dense(
+            F.conv1d(attention_weights_cat, conv.weight, conv.bias).transpose(1, 2))  # [B,W,128]
+
+        index = index[:, half:half + window]  # [B,W]
+        rows = torch.arange(B, device=index.device).unsqueeze(1)
+        energies = self.v(torch.tanh(
+            processed_query + processed_attention_weights + processed_memory[rows, index])).squeeze(-1)  # [B,W]
+        if mask is not None:
+            energies.masked_fill_(mask.gather(1, index), self.score_mask_value)
+
+        window_weights = torch.softmax(energies, dim=1)
+        attention_context = torch.bmm(window_weights.unsqueeze(1), memory[rows, index]).squeeze(1)
+        attention_weights = attention_weights.new_zeros(B, T).scatter_(1, index, window_weights)
+        return attention_context, attention_weights
+
 # the Prenet module applies a series of linear transformations with ReLU activation and dropout to the input tensor. 
 # It helps extract relevant features from the input before passing it to the main network, providing a non-linear transformation and regularization.
 class Prenet(nn.Module):
@@ -131,10 +199,10 @@ class Postnet(nn.Module):
     def __init__(self, config):
         super(Postnet, self).__init__()
         self.convolutions = nn.ModuleList()
-        'The first convolutional layer is defined using ConvNorm and nn.BatchNorm1d. 
-        'It takes the mel-spectrogram channels as input (config.n_mel_channels) and applies a 1-dimensional 
-        'convolution with config.postnet_embedding_dim output channels and a kernel size of config.postnet_kernel_size. 
-        'The output of this convolution is then passed through batch normalization.'
+        # The first convolutional layer is defined using ConvNorm and nn.BatchNorm1d.
+        # It takes the mel-spectrogram channels as input (config.n_mel_channels) and applies a 1-dimensional
+        # convolution with config.postnet_embedding_dim output channels and a kernel size of config.postnet_kernel_size.
+        # The output of this convolution is then passed through batch normalization.
         self.convolutions.append(
             nn.Sequential(
                 ConvNorm(config.n_mel_channels, config.postnet_embedding_dim,
@@ -156,9 +224,9 @@ class Postnet(nn.Module):
                              dilation=1, w_init_gain='tanh'),
                     nn.BatchNorm1d(config.postnet_embedding_dim))
             )
-"The last convolutional layer applies a 1-dimensional convolution with config.postnet_embedding_dim input channels and config.n_mel_channels output channels.
-"The kernel size and padding are determined by config.postnet_kernel_size.
-"The activation function used here is linear, and batch normalization is applied."
+        # The last convolutional layer applies a 1-dimensional convolution with config.postnet_embedding_dim input channels and config.n_mel_channels output channels.
+        # The kernel size and padding are determined by config.postnet_kernel_size.
+        # The activation function used here is linear, and batch normalization is applied.
         self.convolutions.append(
             nn.Sequential(
                 ConvNorm(config.postnet_embedding_dim, config.n_mel_channels,
@@ -167,13 +235,27 @@ class Postnet(nn.Module):
                          dilation=1, w_init_gain='linear'),
                 nn.BatchNorm1d(config.n_mel_channels))
         )
+    @property
+    def receptive_field(self):
+        """单侧感受野的帧数: 输出的第 t 帧只依赖输入的 [t - receptive_field, t + receptive_field] 帧"""
+        return sum((conv[0].conv.kernel_size[0] - 1) // 2 * conv[0].conv.dilation[0]
+                   for conv in self.convolutions)
+
 #  forward is applay the multi conv layers takes an input tensor x and processes it through the convolutional layers.
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        """
+        mask: [B,1,T] 有效帧为1、补零帧为0, 每层卷积后把补零帧重新置0,
+              使 batch 推理的结果与逐条推理一致
+        """
         for i in range(len(self.convolutions) - 1):
 #             For each convolutional layer except the last one, the input tensor x is passed through the convolution, followed by the tanh activation function and dropout (F.dropout).
             x = F.dropout(torch.tanh(self.convolutions[i](x)), 0.5, self.training)
+            if mask is not None:
+                x = x * mask
 #     For the last convolutional layer, only the convolution and dropout are applied, without the tanh activation.
         x = F.dropout(self.convolutions[-1](x), 0.5, self.training)
+        if mask is not None:
+            x = x * mask
 
         return x
 
@@ -221,20 +303,101 @@ class Encoder(nn.Module):
 
         return outputs
 
-    def inference(self, x):
-        """测试时只输入1条数据，不用pack padding 的步骤"""
+    def inference(self, x, input_lengths=None):
+        """
+        测试时只输入1条数据时不用pack padding 的步骤;
+        输入一个 batch 时需要给出 input_lengths, 补零部分在每层卷积后都重新置0,
+        并且不要求 batch 按长度排序
+        """
+        mask = None
+        if input_lengths is not None:
+            mask = get_mask_from_lengths(input_lengths).unsqueeze(1).to(x.dtype)  # [B,1,T]
+            x = x * mask
         for conv in self.convolutions:
             x = F.dropout(F.relu(conv(x)), 0.5, self.training)
+            if mask is not None:
+                x = x * mask
 
         x = x.transpose(1, 2)  # [B,T,C]
 
-        self.lstm.flatten_parameters()
-        outputs, _ = self.lstm(x)
+        # 动态量化后的 LSTM 没有 flatten_parameters
+        if isinstance(self.lstm, nn.LSTM):
+            self.lstm.flatten_parameters()
+        if input_lengths is None:
+            outputs, _ = self.lstm(x)
+        else:
+            x = nn.utils.rnn.pack_padded_sequence(
+                x, input_lengths.cpu().numpy(), batch_first=True, enforce_sorted=False)
+            outputs, _ = self.lstm(x)
+            outputs, _ = nn.utils.rnn.pad_packed_sequence(
+                outputs, batch_first=True)
 
         return outputs
 
 
 # 解码部分        
+# 预测时解码停止的原因, 下标即 Decoder.inference 中使用的停止编码, 0 表示还在解码
+STOP_REASONS = ['running', 'gate', 'attention_end', 'attention_stall', 'max_frames_ratio', 'max_steps']
+
+
+class AlignmentStopController:
+    """
+    根据注意力状态提前结束解码, 避免 gate 一直不触发时解码到 max_decoder_steps
+    - attention_end: 最后 end_tokens 个音素上的累积注意力权重达到 end_cum_weight
+    - attention_stall: 注意力峰值连续 stall_steps 步没有前进
+    - max_frames_ratio: 解码帧数超过 音素数 * max_frames_per_phoneme
+    各条件为0时不使用, 状态按原 batch 的下标保存, 已经结束的样本从解码状态中剔除后仍然可以用 active 索引
+    """
+
+    def __init__(self, memory_lengths, n_frames_per_step, max_frames_per_phoneme=0,
+                 end_tokens=2, end_cum_weight=0, stall_steps=0):
+        """
+        :param memory_lengths: [B] 每条输入的音素个数
+        :param n_frames_per_step: 每步解码的帧数
+        :param max_frames_per_phoneme: 每个音素最多解码的帧数
+        :param end_tokens: 判断注意力到达末尾时使用的最后几个音素
+        :param end_cum_weight: 最后 end_tokens 个音素的累积注意力权重的阈值
+        :param stall_steps: 注意力峰值没有前进的最多步数
+        """
+        self.lengths = memory_lengths
+        self.end_tokens = end_tokens
+        self.end_cum_weight = end_cum_weight
+        self.stall_steps = stall_steps
+        self.max_steps = None
+        if max_frames_per_phoneme > 0:
+            self.max_steps = torch.ceil(memory_lengths * max_frames_per_phoneme / n_frames_per_step).long()
+        self.peak = torch.full_like(memory_lengths, -1)
+        self.stall = torch.zeros_like(memory_lengths)
+        self.steps = 0
+
+    def step(self, attention_weights_cum, attention_weights, active):
+        """
+        解码一步之后调用
+        :param attention_weights_cum: [B_active, T] 累积的注意力权重
+        :param attention_weights: [B_active, T] 这一步的注意力权重
+        :param active: [B_active] 还在解码的样本在原 batch 中的下标
+        :return: [B_active] 停止编码, 0 表示继续解码, 其他值为 STOP_REASONS 中的下标
+        """
+        self.steps += 1
+        lengths = self.lengths[active]
+        codes = torch.zeros_like(active)
+        if self.end_cum_weight > 0:
+            positions = torch.arange(attention_weights_cum.size(1), device=active.device).unsqueeze(0)
+            last = (positions >= (lengths - self.end_tokens).unsqueeze(1)) & (positions < lengths.unsqueeze(1))
+            end_weight = (attention_weights_cum * last).sum(dim=1)
+            codes.masked_fill_(end_weight >= self.end_cum_weight, STOP_REASONS.index('attention_end'))
+        if self.stall_steps > 0:
+            peak, prev_peak = attention_weights.argmax(dim=1), self.peak[active]
+            stall = torch.where(peak > prev_peak, torch.zeros_like(peak), self.stall[active] + 1)
+            self.stall[active] = stall
+            self.peak[active] = torch.maximum(peak, prev_peak)
+            codes.masked_fill_((codes == 0) & (stall >= self.stall_steps), STOP_REASONS.index('attention_stall'))
+        if self.max_steps is not None:
+            codes.masked_fill_((codes == 0) & (self.steps >= self.max_steps[active]),
+                               STOP_REASONS.index('max_frames_ratio'))
+        return codes
+
+
 class Decoder(nn.Module):
     def __init__(self, config):
         super(Decoder, self).__init__()
@@ -262,6 +425,17 @@ class Decoder(nn.Module):
         # 测试过程中 gate端 输入多少认为解码结束
         self.gate_threshold = config.gate_threshold
 
+        # 测试过程中只在上一步注意力峰值附近的窗口内计算注意力, 0 表示使用完整的注意力
+        self.attention_window = config.get('attention_window', 0)
+
+        # 测试过程中根据注意力状态提前停止解码的条件, 见 AlignmentStopController
+        self.stop_max_frames_per_phoneme = config.get('stop_max_frames_per_phoneme', 0)
+        self.stop_end_tokens = config.get('stop_end_tokens', 2)
+        self.stop_end_cum_weight = config.get('stop_end_cum_weight', 0)
+        self.stop_stall_steps = config.get('stop_stall_steps', 0)
+        # 最近一次 inference 每条句子停止解码的原因
+        self.stop_reasons = []
+
         self.p_attention_dropout = config.p_attention_dropout
         self.p_decoder_dropout = config.p_decoder_dropout
 
@@ -295,6 +469,25 @@ class Decoder(nn.Module):
             config.decoder_rnn_dim + config.encoder_embedding_dim, 1,
             bias=True, w_init_gain='sigmoid')
 
+        # 编译后的 teacher-forcing 循环, 不注册为子模块, 不会出现在 state_dict 中
+        self.__dict__['compiled_loop'] = None
+
+        # 训练时每多少步解码为一段做激活值重计算, 0 表示不重计算, 见 checkpoint_teacher_forcing
+        self.checkpoint_steps = 0
+        # 分段重计算使用的未编译的循环, 同样不注册为子模块
+        self.__dict__['eager_loop'] = None
+
+    def compile_teacher_forcing(self):
+        """ 用 TorchScript 编译训练时的解码循环, 编译后的模块与 Decoder 共享参数 """
+        self.__dict__['compiled_loop'] = torch.jit.script(TeacherForcingLoop(self))
+
+    def checkpoint_teacher_forcing(self, chunk_steps):
+        """ 训练时把 teacher-forcing 循环每 chunk_steps 步分为一段, 前向时只保存每段开始时的解码状态,
+            段内 LSTMCell 的状态、location 特征、注意力等中间激活值在反向传播时重新计算;
+            chunk_steps 越小占用的显存越少, 但每段都要多做一次前向计算, 0 表示关闭
+        """
+        self.checkpoint_steps = chunk_steps
+
     def get_go_frame(self, memory):
         """ 
         构造一个全0的矢量作为 decoder 第一帧的输出
@@ -304,6 +497,18 @@ class Decoder(nn.Module):
             B, self.n_mel_channels * self.n_frames_per_step).zero_())
         return decoder_input
 
+    def build_stop_controller(self, memory, memory_lengths=None):
+        """创建预测时的提前停止控制器, 没有设置任何条件时返回 None"""
+        if not (self.stop_max_frames_per_phoneme > 0 or self.stop_end_cum_weight > 0 or self.stop_stall_steps > 0):
+            return None
+        if memory_lengths is None:
+            memory_lengths = torch.full((memory.size(0),), memory.size(1), dtype=torch.long, device=memory.device)
+        return AlignmentStopController(memory_lengths, self.n_frames_per_step,
+                                       max_frames_per_phoneme=self.stop_max_frames_per_phoneme,
+                                       end_tokens=self.stop_end_tokens,
+                                       end_cum_weight=self.stop_end_cum_weight,
+                                       stall_steps=self.stop_stall_steps)
+
     def initialize_decoder_states(self, memory, mask):
 
         B = memory.size(0)
@@ -330,6 +535,40 @@ class Decoder(nn.Module):
         self.processed_memory = self.attention_layer.memory_layer(memory)
         self.mask = mask
 
+        # 不计算梯度时每一步的拼接结果写入复用的缓冲区, 计算梯度时拼接结果需要保存用于反向传播, 不能复用
+        self.state_buffers = None
+        if not torch.is_grad_enabled():
+            self.state_buffers = (
+                memory.new_empty(B, self.prenet_dim + self.encoder_embedding_dim),
+                memory.new_empty(B, 2, MAX_TIME),
+                memory.new_empty(B, self.attention_rnn_dim + self.encoder_embedding_dim),
+                memory.new_empty(B, self.decoder_rnn_dim + self.encoder_embedding_dim))
+
+    def cat_state(self, index, tensors, dim=-1):
+        """ 拼接解码状态, 有缓冲区时写入第 index 个缓冲区, 剔除结束的样本后使用缓冲区的前 B 行 """
+        if self.state_buffers is None:
+            return torch.cat(tensors, dim)
+        return torch.cat(tensors, dim, out=self.state_buffers[index][:tensors[0].size(0)])
+
+    def new_output_buffers(self, memory, max_steps):
+        """ 预先分配 max_steps 步的 mel、gate 与 alignment 输出, 每一步的输出直接写入对应位置
+        RETURNS
+        -------
+        mel_outputs: (B, max_steps, n_mel_channels * n_frames_per_step)
+        gate_outputs: (B, max_steps)
+        alignments: (B, max_steps, T_in)
+        """
+        B, MAX_TIME = memory.size(0), memory.size(1)
+        return (memory.new_empty(B, max_steps, self.n_mel_channels * self.n_frames_per_step),
+                memory.new_empty(B, max_steps),
+                memory.new_empty(B, max_steps, MAX_TIME))
+
+    def parse_output_buffers(self, mel_outputs, gate_outputs, alignments, n_steps):
+        """ 截取输出缓冲区的前 n_steps 步, 返回与 parse_decoder_outputs 相同形状的输出, 不复制数据 """
+        mel_outputs = mel_outputs[:, :n_steps].reshape(
+            mel_outputs.size(0), -1, self.n_mel_channels).transpose(1, 2)
+        return mel_outputs, gate_outputs[:, :n_steps], alignments[:, :n_steps]
+
     def parse_decoder_inputs(self, decoder_inputs):
         """ Prepares decoder inputs, i.e. mel outputs
         PARAMS
@@ -393,30 +632,35 @@ class Decoder(nn.Module):
         gate_output: gate output energies
         attention_weights:
         """
-        cell_input = torch.cat((decoder_input, self.attention_context), -1)
+        cell_input = self.cat_state(0, (decoder_input, self.attention_context))
         self.attention_hidden, self.attention_cell = self.attention_rnn(
             cell_input, (self.attention_hidden, self.attention_cell))
         self.attention_hidden = F.dropout(
             self.attention_hidden, self.p_attention_dropout, self.training)
 
-        attention_weights_cat = torch.cat(
-            (self.attention_weights.unsqueeze(1),
-             self.attention_weights_cum.unsqueeze(1)), dim=1)
-        self.attention_context, self.attention_weights = self.attention_layer(
-            self.attention_hidden, self.memory, self.processed_memory,
-            attention_weights_cat, self.mask)
+        if self.attention_window and not self.training and self.memory.size(1) > self.attention_window:
+            self.attention_context, self.attention_weights = self.attention_layer.forward_windowed(
+                self.attention_hidden, self.memory, self.processed_memory,
+                self.attention_weights, self.attention_weights_cum, self.mask, self.attention_window)
+        else:
+            attention_weights_cat = self.cat_state(
+                1, (self.attention_weights.unsqueeze(1),
+                    self.attention_weights_cum.unsqueeze(1)), dim=1)
+            self.attention_context, self.attention_weights = self.attention_layer(
+                self.attention_hidden, self.memory, self.processed_memory,
+                attention_weights_cat, self.mask)
 
         self.attention_weights_cum += self.attention_weights
 
-        decoder_input = torch.cat(
-            (self.attention_hidden, self.attention_context), -1)
+        decoder_input = self.cat_state(
+            2, (self.attention_hidden, self.attention_context))
         self.decoder_hidden, self.decoder_cell = self.decoder_rnn(
             decoder_input, (self.decoder_hidden, self.decoder_cell))
         self.decoder_hidden = F.dropout(
             self.decoder_hidden, self.p_decoder_dropout, self.training)
 
-        decoder_hidden_attention_context = torch.cat(
-            (self.decoder_hidden, self.attention_context), dim=1)
+        decoder_hidden_attention_context = self.cat_state(
+            3, (self.decoder_hidden, self.attention_context), dim=1)
         decoder_output = self.linear_projection(
             decoder_hidden_attention_context)
 
@@ -447,11 +691,35 @@ class Decoder(nn.Module):
         decoder_inputs = torch.cat((decoder_input, decoder_inputs), dim=0)
         decoder_inputs = self.prenet(decoder_inputs)
 
+        if self.checkpoint_steps > 0 and self.training and torch.is_grad_enabled():
+            mel_outputs, gate_outputs, alignments = self.checkpointed_teacher_forcing(
+                decoder_inputs, memory, ~get_mask_from_lengths(memory_lengths))
+            return self.parse_decoder_outputs(mel_outputs, gate_outputs, alignments)
+
+        if self.compiled_loop is not None:
+            # 整个 teacher-forcing 循环在 TorchScript 中执行
+            self.compiled_loop.train(self.training)
+            mel_outputs, gate_outputs, alignments = self.compiled_loop(
+                decoder_inputs, memory, ~get_mask_from_lengths(memory_lengths))
+            return self.parse_decoder_outputs(mel_outputs, gate_outputs, alignments)
+
         self.initialize_decoder_states(
             memory, mask=~get_mask_from_lengths(memory_lengths))
 
+        n_steps = decoder_inputs.size(0) - 1
+        if not torch.is_grad_enabled():
+            # 验证时输出直接写入按目标长度预先分配的缓冲区;
+            # 训练时每一步的输出需要保留在计算图中, 原地写入同一个缓冲区会让反向传播反复复制整个缓冲区, 仍然使用 torch.stack
+            mel_outputs, gate_outputs, alignments = self.new_output_buffers(memory, n_steps)
+            for step in range(n_steps):
+                mel_output, gate_output, attention_weights = self.decode(decoder_inputs[step])
+                mel_outputs[:, step] = mel_output
+                gate_outputs[:, step] = gate_output.squeeze(1)
+                alignments[:, step] = attention_weights
+            return self.parse_output_buffers(mel_outputs, gate_outputs, alignments, n_steps)
+
         mel_outputs, gate_outputs, alignments = [], [], []
-        while len(mel_outputs) < decoder_inputs.size(0) - 1:
+        while len(mel_outputs) < n_steps:
             decoder_input = decoder_inputs[len(mel_outputs)]
             mel_output, gate_output, attention_weights = self.decode(
                 decoder_input)
@@ -464,42 +732,290 @@ class Decoder(nn.Module):
 
         return mel_outputs, gate_outputs, alignments
 
-    def inference(self, memory):
+    def checkpointed_teacher_forcing(self, decoder_inputs, memory, mask):
+        """ 分段做激活值重计算的 teacher-forcing 循环, 每段调用一次 TeacherForcingLoop.run;
+            重计算时恢复前向时的随机数状态, 两次计算的 dropout 相同, 梯度与不重计算时一致;
+            重计算通过 saved tensor hooks 取回激活值, TorchScript 编译后的循环在重计算时会报错, 因此始终使用未编译的循环
+        PARAMS
+        ------
+        decoder_inputs: prenet 处理后的 decoder 输入 (T_out + 1, B, prenet_dim), 第一帧为 go frame
+        memory: Encoder outputs
+        mask: 补零位置为 True 的 mask
+
+        RETURNS
+        -------
+        每一步的 mel_outputs, gate_outputs, alignments 列表
+        """
+        if self.eager_loop is None:
+            self.__dict__['eager_loop'] = TeacherForcingLoop(self)
+        loop = self.eager_loop
+        loop.train(self.training)
+        processed_memory = loop.attention_layer.memory_layer(memory)
+        states = loop.initial_states(memory)
+        n_steps = decoder_inputs.size(0) - 1
+        mel_outputs, gate_outputs, alignments = [], [], []
+        for start in range(0, n_steps, self.checkpoint_steps):
+            chunk_inputs = decoder_inputs[start:min(start + self.checkpoint_steps, n_steps)]
+            chunk_mels, chunk_gates, chunk_alignments, states = checkpoint(
+                loop.run, chunk_inputs, memory, processed_memory, mask, states, use_reentrant=False)
+            mel_outputs += chunk_mels
+            gate_outputs += chunk_gates
+            alignments += chunk_alignments
+        return mel_outputs, gate_outputs, alignments
+
+    def select_decoder_states(self, index):
+        """ 只保留 index 对应的样本的解码状态, 用于 batch 推理时剔除已经结束的句子
+        PARAMS
+        ------
+        index: LongTensor, 需要保留的样本在当前 batch 中的下标
+        """
+        self.attention_hidden = self.attention_hidden.index_select(0, index)
+        self.attention_cell = self.attention_cell.index_select(0, index)
+        self.decoder_hidden = self.decoder_hidden.index_select(0, index)
+        self.decoder_cell = self.decoder_cell.index_select(0, index)
+        self.attention_weights = self.attention_weights.index_select(0, index)
+        self.attention_weights_cum = self.attention_weights_cum.index_select(0, index)
+        self.attention_context = self.attention_context.index_select(0, index)
+        self.memory = self.memory.index_select(0, index)
+        self.processed_memory = self.processed_memory.index_select(0, index)
+        if self.mask is not None:
+            self.mask = self.mask.index_select(0, index)
+
+    def inference(self, memory, memory_lengths=None):
         """ Decoder inference
         PARAMS
         ------
         memory: Encoder outputs
+        memory_lengths: Encoder output lengths for attention masking, None 表示 batch 内没有补零
 
         RETURNS
         -------
         mel_outputs: mel outputs from the decoder
         gate_outputs: gate outputs from the decoder
         alignments: sequence of attention weights from the decoder
+        mel_lengths: 每条句子的 mel 帧数
+        每条句子停止解码的原因保存在 self.stop_reasons 中
         """
+        B = memory.size(0)
         decoder_input = self.get_go_frame(memory)
 
+        mask = None
+        if memory_lengths is not None:
+            mask = ~get_mask_from_lengths(memory_lengths)
+        self.initialize_decoder_states(memory, mask=mask)
+
+        # active 为还没有结束解码的样本在原 batch 中的下标, 结束的样本从解码状态中剔除
+        active = torch.arange(B, device=memory.device)
+        decoder_steps = torch.zeros(B, dtype=torch.long, device=memory.device)
+        stop_codes = torch.zeros(B, dtype=torch.long, device=memory.device)
+        controller = self.build_stop_controller(memory, memory_lengths)
+
+        # 输出缓冲区按解码步数的上限分配, 提前停止的条件给出了更小的上限时使用更小的值
+        max_steps = self.max_decoder_steps
+        if controller is not None and controller.max_steps is not None:
+            max_steps = min(max_steps, int(controller.max_steps.max()))
+        mel_outputs, gate_outputs, alignments = self.new_output_buffers(memory, max_steps)
+        step = 0
+        while True:
+            decoder_input = self.prenet(decoder_input)
+            mel_output, gate_output, alignment = self.decode(decoder_input)
+
+            if active.size(0) == B:
+                mel_outputs[:, step] = mel_output
+                gate_outputs[:, step] = gate_output.squeeze(1)
+                alignments[:, step] = alignment
+            else:
+                mel_outputs[:, step].index_copy_(0, active, mel_output)
+                gate_outputs[:, step].index_copy_(0, active, gate_output.squeeze(1))
+                alignments[:, step].index_copy_(0, active, alignment)
+            step += 1
+
+            finished = (torch.sigmoid(gate_output) > self.gate_threshold).squeeze(1)
+            codes = finished.long() * STOP_REASONS.index('gate')
+            if controller is not None:
+                # gate 优先, 其次是注意力状态
+                codes = torch.where(finished, codes, controller.step(self.attention_weights_cum, alignment, active))
+                finished = codes > 0
+            stop_codes[active] = codes
+            decoder_steps[active[finished]] = step
+            if step == max_steps and not finished.all():
+                print("Warning! Reached max decoder steps")
+                stop_codes[active[~finished]] = STOP_REASONS.index('max_steps')
+                decoder_steps[active[~finished]] = step
+                break
+
+            decoder_input = mel_output
+            if finished.all():
+                break
+            elif finished.any():
+                keep = torch.nonzero(~finished).squeeze(1)
+                self.select_decoder_states(keep)
+                active = active.index_select(0, keep)
+                decoder_input = decoder_input.index_select(0, keep)
+
+        # 已经结束的样本之后的位置没有写入, mel 与 alignment 补0, gate 补一个很大的值表示已经停止
+        finished_mask = torch.arange(step, device=memory.device) >= decoder_steps.unsqueeze(1)  # [B, step]
+        mel_outputs[:, :step].masked_fill_(finished_mask.unsqueeze(2), 0.0)
+        gate_outputs[:, :step].masked_fill_(finished_mask, 1e3)
+        alignments[:, :step].masked_fill_(finished_mask.unsqueeze(2), 0.0)
+        mel_outputs, gate_outputs, alignments = self.parse_output_buffers(
+            mel_outputs, gate_outputs, alignments, step)
+        mel_lengths = decoder_steps * self.n_frames_per_step
+        self.stop_reasons = [STOP_REASONS[code] for code in stop_codes.tolist()]
+        if metrics.enabled:
+            self.record_decode_stats(decoder_steps.tolist(), self.stop_reasons)
+
+        return mel_outputs, gate_outputs, alignments, mel_lengths
+
+    def record_decode_stats(self, decoder_steps, stop_reasons):
+        """记录每条句子的解码步数、帧数以及各种停止原因的句子数"""
+        for steps in decoder_steps:
+            metrics.observe('decoder_steps', steps)
+        metrics.inc('decoder_frames_total', sum(decoder_steps) * self.n_frames_per_step)
+        for reason in STOP_REASONS[1:]:
+            metrics.inc('decoder_terminations_total', stop_reasons.count(reason), reason=reason)
+
+
+    def inference_stream(self, memory):
+        """ 逐步解码的 Decoder inference, 只支持一条数据, 停止条件与 inference 相同
+        PARAMS
+        ------
+        memory: Encoder outputs [1, T_in, C]
+
+        YIELDS
+        -------
+        mel_output: 每一步解码出的 mel 帧 [1, n_mel_channels, n_frames_per_step]
+        """
+        decoder_input = self.get_go_frame(memory)
         self.initialize_decoder_states(memory, mask=None)
+        controller = self.build_stop_controller(memory)
+        active = torch.zeros(1, dtype=torch.long, device=memory.device)
 
-        mel_outputs, gate_outputs, alignments = [], [], []
+        steps = 0
         while True:
             decoder_input = self.prenet(decoder_input)
             mel_output, gate_output, alignment = self.decode(decoder_input)
+            steps += 1
+            yield mel_output.view(1, self.n_frames_per_step, self.n_mel_channels).transpose(1, 2)
 
-            mel_outputs += [mel_output.squeeze(1)]
-            gate_outputs += [gate_output]
-            alignments += [alignment]
-
+            code = 0
             if torch.sigmoid(gate_output) > self.gate_threshold:
-                break
-            elif len(mel_outputs) == self.max_decoder_steps:
+                code = STOP_REASONS.index('gate')
+            elif controller is not None:
+                code = int(controller.step(self.attention_weights_cum, alignment, active))
+            if code == 0 and steps == self.max_decoder_steps:
                 print("Warning! Reached max decoder steps")
+                code = STOP_REASONS.index('max_steps')
+            if code > 0:
+                self.stop_reasons = [STOP_REASONS[code]]
+                if metrics.enabled:
+                    self.record_decode_stats([steps], self.stop_reasons)
                 break
 
             decoder_input = mel_output
 
-        mel_outputs, gate_outputs, alignments = self.parse_decoder_outputs(
-            mel_outputs, gate_outputs, alignments)
 
+class TeacherForcingLoop(nn.Module):
+    """ Decoder.decode 的无状态版本, 解码状态作为参数显式传递, 可以被 TorchScript 编译,
+        整个 teacher-forcing 循环都在编译后的代码中执行
+    """
+
+    def __init__(self, decoder):
+        super(TeacherForcingLoop, self).__init__()
+        self.attention_rnn_dim = decoder.attention_rnn_dim
+        self.decoder_rnn_dim = decoder.decoder_rnn_dim
+        self.encoder_embedding_dim = decoder.encoder_embedding_dim
+        self.p_attention_dropout = decoder.p_attention_dropout
+        self.p_decoder_dropout = decoder.p_decoder_dropout
+        self.attention_rnn = decoder.attention_rnn
+        self.attention_layer = decoder.attention_layer
+        self.decoder_rnn = decoder.decoder_rnn
+        self.linear_projection = decoder.linear_projection
+        self.gate_layer = decoder.gate_layer
+
+    def step(self, decoder_input: torch.Tensor, memory: torch.Tensor, processed_memory: torch.Tensor,
+             mask: torch.Tensor, attention_hidden: torch.Tensor, attention_cell: torch.Tensor,
+             decoder_hidden: torch.Tensor, decoder_cell: torch.Tensor, attention_weights: torch.Tensor,
+             attention_weights_cum: torch.Tensor, attention_context: torch.Tensor):
+        """ 与 Decoder.decode 的计算相同 """
+        cell_input = torch.cat((decoder_input, attention_context), -1)
+        attention_hidden, attention_cell = self.attention_rnn(
+            cell_input, (attention_hidden, attention_cell))
+        attention_hidden = F.dropout(
+            attention_hidden, self.p_attention_dropout, self.training)
+
+        attention_weights_cat = torch.cat(
+            (attention_weights.unsqueeze(1), attention_weights_cum.unsqueeze(1)), dim=1)
+        alignment = self.attention_layer.get_alignment_energies(
+            attention_hidden, processed_memory, attention_weights_cat)
+        alignment = alignment.masked_fill(mask, self.attention_layer.score_mask_value)
+        attention_weights = torch.softmax(alignment, dim=1)
+        attention_context = torch.bmm(attention_weights.unsqueeze(1), memory).squeeze(1)
+        attention_weights_cum = attention_weights_cum + attention_weights
+
+        decoder_input = torch.cat((attention_hidden, attention_context), -1)
+        decoder_hidden, decoder_cell = self.decoder_rnn(
+            decoder_input, (decoder_hidden, decoder_cell))
+        decoder_hidden = F.dropout(
+            decoder_hidden, self.p_decoder_dropout, self.training)
+
+        decoder_hidden_attention_context = torch.cat((decoder_hidden, attention_context), dim=1)
+        decoder_output = self.linear_projection(decoder_hidden_attention_context)
+        gate_prediction = self.gate_layer(decoder_hidden_attention_context)
+        return (decoder_output, gate_prediction, attention_hidden, attention_cell, decoder_hidden,
+                decoder_cell, attention_weights, attention_weights_cum, attention_context)
+
+    @torch.jit.export
+    def initial_states(self, memory: torch.Tensor) -> List[torch.Tensor]:
+        """ 全零的解码状态: attention_hidden, attention_cell, decoder_hidden, decoder_cell,
+            attention_weights, attention_weights_cum, attention_context
+        """
+        B = memory.size(0)
+        MAX_TIME = memory.size(1)
+        return [memory.new_zeros(B, self.attention_rnn_dim), memory.new_zeros(B, self.attention_rnn_dim),
+                memory.new_zeros(B, self.decoder_rnn_dim), memory.new_zeros(B, self.decoder_rnn_dim),
+                memory.new_zeros(B, MAX_TIME), memory.new_zeros(B, MAX_TIME),
+                memory.new_zeros(B, self.encoder_embedding_dim)]
+
+    @torch.jit.export
+    def run(self, decoder_inputs: torch.Tensor, memory: torch.Tensor, processed_memory: torch.Tensor,
+            mask: torch.Tensor, states: List[torch.Tensor]):
+        """ 从解码状态 states 开始, 依次以 decoder_inputs 的每一帧为输入解码一步,
+            返回每一步的 mel_outputs, gate_outputs, alignments 列表以及最后的解码状态
+        """
+        (attention_hidden, attention_cell, decoder_hidden, decoder_cell,
+         attention_weights, attention_weights_cum, attention_context) = (
+            states[0], states[1], states[2], states[3], states[4], states[5], states[6])
+        mel_outputs: List[torch.Tensor] = []
+        gate_outputs: List[torch.Tensor] = []
+        alignments: List[torch.Tensor] = []
+        for i in range(decoder_inputs.size(0)):
+            (mel_output, gate_output, attention_hidden, attention_cell, decoder_hidden, decoder_cell,
+             attention_weights, attention_weights_cum, attention_context) = self.step(
+                decoder_inputs[i], memory, processed_memory, mask, attention_hidden, attention_cell,
+                decoder_hidden, decoder_cell, attention_weights, attention_weights_cum, attention_context)
+            mel_outputs.append(mel_output)
+            gate_outputs.append(gate_output.squeeze(1))
+            alignments.append(attention_weights)
+        return mel_outputs, gate_outputs, alignments, [
+            attention_hidden, attention_cell, decoder_hidden, decoder_cell,
+            attention_weights, attention_weights_cum, attention_context]
+
+    def forward(self, decoder_inputs: torch.Tensor, memory: torch.Tensor, mask: torch.Tensor):
+        """
+        PARAMS
+        ------
+        decoder_inputs: prenet 处理后的 decoder 输入 (T_out + 1, B, prenet_dim), 第一帧为 go frame
+        memory: Encoder outputs
+        mask: 补零位置为 True 的 mask
+
+        RETURNS
+        -------
+        与 Decoder.forward 中的循环相同的 mel_outputs, gate_outputs, alignments 列表
+        """
+        processed_memory = self.attention_layer.memory_layer(memory)
+        mel_outputs, gate_outputs, alignments, _ = self.run(
+            decoder_inputs[:-1], memory, processed_memory, mask, self.initial_states(memory))
         return mel_outputs, gate_outputs, alignments
 
 
@@ -556,15 +1072,67 @@ class Tacotron2(nn.Module):
 
         return self.parse_output([mel_outputs, mel_outputs_postnet, gate_outputs, alignments], output_lengths)
 
-    def inference(self, inputs):
-        embedded_inputs = self.embedding(inputs).transpose(1, 2)
-        encoder_outputs = self.encoder.inference(embedded_inputs)
-        mel_outputs, gate_outputs, alignments = self.decoder.inference(
-            encoder_outputs)
+    def inference(self, inputs, input_lengths=None):
+        """
+        inputs: [B,T_in] 补零后的音素序列
+        input_lengths: [B] 每条音素序列的长度, 只有一条数据时可以为 None
+        返回的 mel_lengths 为每条句子的 mel 帧数, 超过长度的部分已经置0
+        """
+        with metrics.timer('encoder'):
+            embedded_inputs = self.embedding(inputs).transpose(1, 2)
+            encoder_outputs = self.encoder.inference(embedded_inputs, input_lengths)
+        with metrics.timer('decoder'):
+            mel_outputs, gate_outputs, alignments, mel_lengths = self.decoder.inference(
+                encoder_outputs, memory_lengths=input_lengths)
+
+        with metrics.timer('postnet'):
+            mask = None
+            if inputs.size(0) > 1:
+                mask = (torch.arange(mel_outputs.size(-1), device=mel_lengths.device)
+                        < mel_lengths.unsqueeze(1)).unsqueeze(1).to(mel_outputs.dtype)  # [B,1,T_out]
+            mel_outputs_postnet = self.postnet(mel_outputs, mask=mask)
+            mel_outputs_postnet = mel_outputs + mel_outputs_postnet
+
+        outputs = [mel_outputs, mel_outputs_postnet, gate_outputs, alignments, mel_lengths]
 
-        mel_outputs_postnet = self.postnet(mel_outputs)
-        mel_outputs_postnet = mel_outputs + mel_outputs_postnet
+        return outputs
 
-        outputs = [mel_outputs, mel_outputs_postnet, gate_outputs, alignments]
+    def inference_stream(self, inputs, chunk_frames=32):
+        """
+        边解码边输出经过 postnet 的 mel 谱, 只支持一条数据
+        postnet 只在滑动窗口上计算, 窗口右侧多等 receptive_field 帧, 因此输出与 inference 的结果一致
+        inputs: [1,T_in] 音素序列
+        chunk_frames: 每次至少输出的 mel 帧数
+        YIELDS: [1, n_mel_channels, N] 的 mel 片段, 依次拼接即为完整的 mel_outputs_postnet
+        """
+        embedded_inputs = self.embedding(inputs).transpose(1, 2)
+        encoder_outputs = self.encoder.inference(embedded_inputs)
 
-        return outputs
+        context = self.postnet.receptive_field
+        # mel_cache 中保存从第 cache_start 帧开始的 decoder 输出, emitted 为已经输出的帧数
+        mel_cache, cache_start, emitted = None, 0, 0
+        for mel_output in self.decoder.inference_stream(encoder_outputs):
+            mel_cache = mel_output if mel_cache is None else torch.cat((mel_cache, mel_output), dim=-1)
+            ready = cache_start + mel_cache.size(-1) - context
+            if ready - emitted >= chunk_frames:
+                yield self._postnet_window(mel_cache, cache_start, emitted, ready)
+                emitted = ready
+                # 只保留下一个窗口需要的左侧上下文
+                drop = max(emitted - context - cache_start, 0)
+                mel_cache, cache_start = mel_cache[:, :, drop:], cache_start + drop
+        end = cache_start + mel_cache.size(-1)
+        if end > emitted:
+            yield self._postnet_window(mel_cache, cache_start, emitted, end)
+
+    def _postnet_window(self, mel_cache, cache_start, start, stop):
+        """在缓存的 decoder 输出上计算 postnet, 返回第 start 到 stop-1 帧"""
+        mel_outputs_postnet = mel_cache + self.postnet(mel_cache)
+        return mel_outputs_postnet[:, :, start - cache_start:stop - cache_start]
+
+
+def quantize_dynamic_model(model):
+    """
+    对模型中的 LSTM、LSTMCell 与 Linear 层做动态 int8 量化，权重保存为 int8，激活值在运行时按 batch 动态量化
+    只能用于CPU预测，卷积层和 Embedding 保持 fp32
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.LSTMCell, nn.Linear}, dtype=torch.qint8)
@@ -1,14 +1,20 @@
+import atexit
+import contextlib
 import os
-import text
 import librosa
 import numpy as np
 import torch
 import yaml
 import soundfile as sf
 
+from src.infer_utils.cache import SynthesisCache, model_fingerprint
+from src.infer_utils.frontend import TextFrontend, _file_hash
 from src.infer_utils.utils import generate_text_code, speech_enhance
-from src.models.model import Tacotron2
+from src.infer_utils.vocoder import GriffinLimVocoder
+from src.models.model import Tacotron2, quantize_dynamic_model
+from src.predictor_pool import PredictorPool
 from src.utils.logger import setup_logger
+from src.utils.metrics import JsonLinesSink, PrometheusTextSink, cuda_synchronized_timer, metrics
 from src.utils.utils import dict_to_object, print_arguments
 
 logger = setup_logger(__name__)
@@ -18,17 +24,22 @@ class Tacotron2Predictor:
     def __init__(self,
                  configs=None,
                  model_path=None,
-                 use_gpu=True):
+                 use_gpu=True,
+                 quantize=False,
+                 state_dict=None):
         """
         TTS预测工具
-        :param configs: 配置文件路径
+        :param configs: 配置文件路径，或者已经读取的配置字典
         :param model_path: 导出的预测模型文件夹路径
         :param use_gpu: 是否使用GPU预测
+        :param quantize: 是否对 LSTM 和 Linear 层做动态 int8 量化，只支持CPU预测
+        :param state_dict: 已经加载的模型参数，例如 PredictorPool 放在共享内存中的参数，直接使用而不复制，为 None 时从 model_path 读取
         """
-        if not isinstance(configs, str) or not os.path.exists(configs):
+        if isinstance(configs, str) and os.path.exists(configs):
+            with open(configs, 'r', encoding='utf-8') as f:
+                configs = yaml.load(f.read(), Loader=yaml.FullLoader)
+        elif not isinstance(configs, dict):
             raise ValueError('configs文件不存在')
-        with open(configs, 'r', encoding='utf-8') as f:
-            configs = yaml.load(f.read(), Loader=yaml.FullLoader)
         print_arguments(configs=configs)
 
         self.configs = dict_to_object(configs)
@@ -38,18 +49,30 @@ class Tacotron2Predictor:
             self.device = torch.device("cuda")
         else:
             self.device = torch.device("cpu")
-        self.__init_model(model_path)
+        assert not (quantize and use_gpu), '动态 int8 量化只支持CPU预测'
+        self.quantize = quantize
+        # synthesize_many 第一次调用时创建的多进程合成池
+        self.pool = None
+        self.__init_model(model_path, state_dict)
 
-    def __init_model(self, model_path):
+    def __init_model(self, model_path, state_dict=None):
         """加载预训练模型"""
         if os.path.isdir(model_path):
             model_path = os.path.join(model_path, 'model.pt')
         assert os.path.exists(model_path), f"{model_path} 模型不存在！"
-        self.model = Tacotron2(self.configs.model_conf)
-        model_state_dict = torch.load(model_path, map_location='cpu')
-        self.model.load_state_dict(model_state_dict)
+        self.model_path = model_path
+        if self.quantize:
+            self.model = self.__load_quantized_model(model_path)
+        elif state_dict is not None:
+            self.model = Tacotron2(self.configs.model_conf)
+            # assign=True 直接使用传入的张量，共享内存中的参数不会被复制
+            self.model.load_state_dict(state_dict, assign=True)
+        else:
+            self.model = Tacotron2(self.configs.model_conf)
+            model_state_dict = torch.load(model_path, map_location='cpu')
+            self.model.load_state_dict(model_state_dict)
+            logger.info('成功恢复模型参数和优化方法参数：{}'.format(model_path))
         self.model.to(self.device)
-        logger.info('成功恢复模型参数和优化方法参数：{}'.format(model_path))
         self.model.eval()
 
         self.dic_phoneme = {}
@@ -59,6 +82,106 @@ class Tacotron2Predictor:
                 index = int(index)
                 self.dic_phoneme[word] = index
 
+        # 文本前端与 mel 统计信息常驻内存, 预测时不再解析任何文件
+        dataset_conf = self.configs.dataset_conf
+        self.frontend = TextFrontend(lexicon_path=dataset_conf.get('lexicon_path', 'cmudict.txt'),
+                                     symbol_index_path=dataset_conf.get('symbol_index_path', 'symbol_index.txt'))
+        file_static = os.path.join(dataset_conf.mel_manifest_dir, 'static.npy')
+        static_mel = np.load(file_static, allow_pickle=True)
+        self.mean_mel = np.float64(static_mel[0])
+        self.std_mel = np.float64(static_mel[1])
+
+        vocoder_conf = self.configs.get('vocoder_conf', {})
+        self.vocoder = GriffinLimVocoder(self.configs.preprocess_conf,
+                                         n_iter=vocoder_conf.get('n_iter', 32),
+                                         momentum=vocoder_conf.get('momentum', 0.99),
+                                         nnls_iter=vocoder_conf.get('nnls_iter', 50),
+                                         device=self.device)
+
+        cache_conf = self.configs.get('cache_conf', {})
+        self.seed = cache_conf.get('seed', None)
+        self.cache = None
+        if cache_conf.get('enable', False):
+            decoder = self.model.decoder
+            # 提前停止的条件决定每条语音在哪里结束，与窗口注意力一样会改变合成结果
+            decode_settings = {name: getattr(decoder, name) for name in (
+                'max_decoder_steps', 'gate_threshold', 'attention_window', 'stop_max_frames_per_phoneme',
+                'stop_end_tokens', 'stop_end_cum_weight', 'stop_stall_steps')}
+            self.cache = SynthesisCache(model_fingerprint(model_path, self.configs, file_static,
+                                                          quantized=self.quantize,
+                                                          decode_settings=decode_settings),
+                                        cache_dir=cache_conf.get('cache_dir', None) or None,
+                                        max_memory_mb=cache_conf.get('max_memory_mb', 256),
+                                        max_disk_mb=cache_conf.get('max_disk_mb', 1024))
+
+        metrics_conf = self.configs.get('metrics_conf', {})
+        if metrics_conf.get('enable', False):
+            metrics.enable(clock=cuda_synchronized_timer if self.device.type == 'cuda' else None)
+            if metrics_conf.get('jsonl_path', None):
+                metrics.add_sink(JsonLinesSink(metrics_conf.jsonl_path))
+            if metrics_conf.get('prometheus_path', None):
+                metrics.add_sink(PrometheusTextSink(metrics_conf.prometheus_path,
+                                                    interval=metrics_conf.get('prometheus_interval', 10)))
+            atexit.register(metrics.close)
+
+    def __load_quantized_model(self, model_path):
+        """
+        加载动态 int8 量化后的模型
+        量化后的参数缓存在 model.pt 同目录下的 model_int8.pt 中，并记录 model.pt 的 sha1，model.pt 改变后重新量化
+        """
+        quantized_path = os.path.join(os.path.dirname(model_path), 'model_int8.pt')
+        source_hash = _file_hash(model_path)
+        model = Tacotron2(self.configs.model_conf)
+        model.eval()
+        if os.path.exists(quantized_path):
+            # 量化后的参数包含打包的权重对象，只能以 weights_only=False 读取，该文件由本方法生成
+            checkpoint = torch.load(quantized_path, map_location='cpu', weights_only=False)
+            if checkpoint.get('source_hash') == source_hash:
+                # 先量化一个随机初始化的模型得到量化后的结构，再载入缓存的量化参数
+                model = quantize_dynamic_model(model)
+                model.load_state_dict(checkpoint['state_dict'])
+                logger.info('成功恢复量化模型参数：{}'.format(quantized_path))
+                return model
+        model.load_state_dict(torch.load(model_path, map_location='cpu'))
+        model = quantize_dynamic_model(model)
+        torch.save({'source_hash': source_hash, 'state_dict': model.state_dict()}, quantized_path + '.tmp')
+        os.replace(quantized_path + '.tmp', quantized_path)
+        logger.info('模型已量化为 int8 并保存：{}'.format(quantized_path))
+        return model
+
+    def __mels_to_wavs(self, mel_outs, mel_lengths, enhancement):
+        """
+        将模型输出的一个 batch 的正则化 mel 谱一起解码为语音
+        :param mel_outs: [B, n_mels, T] 模型输出的 mel 谱
+        :param mel_lengths: [B] 每条 mel 谱的有效帧数
+        :return: 每条语音的 np.ndarray 列表
+        """
+        with metrics.timer('inversion'):
+            # 反正则
+            generated_mel = mel_outs * self.std_mel + self.mean_mel
+
+            # 进行解码
+            inv_fbank = librosa.db_to_power(generated_mel)
+            inv_wavs, wav_lengths = self.vocoder(inv_fbank, mel_lengths)
+            inv_wavs = inv_wavs.cpu().numpy()
+        return [self.__postprocess(inv_wav[:wav_length], enhancement)
+                for inv_wav, wav_length in zip(inv_wavs, wav_lengths.tolist())]
+
+    def __postprocess(self, inv_wav, enhancement):
+        """对声码器输出的语音做幅度归一化、去噪以及首尾静音裁剪"""
+        inv_wav = inv_wav / max(inv_wav)
+        if enhancement:
+            with metrics.timer('enhance'):
+                inv_wav = speech_enhance(wave_data=inv_wav,
+                                         n_fft=self.configs.preprocess_conf.n_fft,
+                                         hop_length=self.configs.preprocess_conf.hop_length,
+                                         win_length=self.configs.preprocess_conf.win_length,
+                                         noise_frame=30)
+        with metrics.timer('trim'):
+            inv_wav, _ = librosa.effects.trim(inv_wav)
+        # 与缓存中保存的格式相同，命中与没有命中缓存时返回的数组类型一致
+        return np.ascontiguousarray(inv_wav, dtype=np.float32)
+
     def predict(self, sentence: str, output_path: str, enhancement=True):
         """
         :param sentence: 待预测文本
@@ -68,56 +191,268 @@ class Tacotron2Predictor:
         # coded_text = generate_text_code(sentence, self.dic_phoneme)
         # text_in = torch.from_numpy(coded_text)
 
-        all_words = text.get_set_words()
-        index_dictionaly = text.get_symbol_index()
+        with metrics.request('predict'):
+            with metrics.timer('frontend'):
+                coded_text = self.frontend.text_to_sequence(sentence)
+            inv_wav = self.synthesize_sequences([coded_text], enhancement=enhancement)[0]
+            with metrics.timer('write'):
+                sf.write(output_path, inv_wav, self.configs.preprocess_conf.fs)
+
+    def profile(self, sentence: str, trace_path: str, output_path=None, enhancement=True):
+        """
+        用 torch.profiler 记录一次预测的所有算子，保存为 chrome trace，trace 中按预测的各阶段分组
+        记录期间不使用合成结果缓存
+        :param sentence: 待预测文本
+        :param trace_path: trace 文件的保存路径
+        :param output_path: .wav文件输出路径，为 None 时不保存语音
+        :param enhancement: 是否进行去噪处理
+        """
+        cache, self.cache = self.cache, None
+        try:
+            with metrics.profile(trace_path) as prof:
+                with metrics.timer('frontend'):
+                    coded_text = self.frontend.text_to_sequence(sentence)
+                inv_wav = self.synthesize_sequences([coded_text], enhancement=enhancement)[0]
+        finally:
+            self.cache = cache
+        logger.info('\n' + prof.key_averages().table(sort_by='self_cpu_time_total', row_limit=20))
+        if output_path is not None:
+            sf.write(output_path, inv_wav, self.configs.preprocess_conf.fs)
+
+    @contextlib.contextmanager
+    def __rng_context(self):
+        """设置了 seed 时固定 Prenet dropout 与 Griffin-Lim 初始相位的随机数，且不影响全局的随机状态"""
+        if self.seed is None:
+            yield
+            return
+        devices = [torch.cuda.current_device()] if self.device.type == 'cuda' else []
+        with torch.random.fork_rng(devices=devices):
+            torch.manual_seed(self.seed)
+            yield
+
+    def synthesize_sequences(self, coded_texts, enhancement=True, batch_size=16):
+        """
+        多条音素编码序列一起合成，不写文件，每 batch_size 条补零后一起解码
+        :param coded_texts: 音素编码序列列表，每条不能为空
+        :param enhancement: 是否进行去噪处理
+        :param batch_size: 一次解码的序列条数
+        :return: 与 coded_texts 一一对应的语音 np.ndarray 列表
+        """
+        with metrics.request('synthesize', utterances=len(coded_texts)):
+            return self.__synthesize_sequences(coded_texts, enhancement, batch_size)
+
+    def __synthesize_sequences(self, coded_texts, enhancement, batch_size):
+        wavs = [None] * len(coded_texts)
+        # 查询缓存，相同的序列只合成一次
+        keys = None
+        if self.cache is not None:
+            keys = [self.cache.key(coded_text, enhancement, self.seed) for coded_text in coded_texts]
+            wavs = [self.cache.get(key) for key in keys]
+        missing, seen = [], set()
+        for i, coded_text in enumerate(coded_texts):
+            key = keys[i] if keys is not None else i
+            if wavs[i] is None and key not in seen:
+                seen.add(key)
+                missing.append(i)
+        # 设置了 seed 时逐条合成，使每条的输出与同一 batch 里的其他文本无关
+        if self.seed is not None:
+            batch_size = 1
+        # 按音素长度排序，使同一个 batch 内的解码长度接近
+        order = sorted(missing, key=lambda i: len(coded_texts[i]), reverse=True)
+        for start in range(0, len(order), batch_size):
+            indexes = order[start:start + batch_size]
+            seqs = [torch.as_tensor(coded_texts[i], dtype=torch.long) for i in indexes]
+            text_lengths = torch.tensor([len(seq) for seq in seqs], dtype=torch.long)
+            text_in = torch.nn.utils.rnn.pad_sequence(seqs, batch_first=True).to(self.device)
 
+            with self.__rng_context(), torch.no_grad():
+                eval_outputs = self.model.inference(text_in, text_lengths.to(self.device))
+                mel_outs = eval_outputs[1].cpu().numpy()
+                mel_lengths = eval_outputs[4].cpu().tolist()
+                inv_wavs = self.__mels_to_wavs(mel_outs, mel_lengths, enhancement)
 
+            for i, inv_wav in zip(indexes, inv_wavs):
+                wavs[i] = inv_wav
+                if self.cache is not None:
+                    self.cache.put(keys[i], inv_wav)
+            metrics.inc('utterances_total', len(indexes))
+            metrics.inc('audio_seconds_total', sum(len(w) for w in inv_wavs) / self.configs.preprocess_conf.fs)
+        metrics.inc('cache_hits_total', len(coded_texts) - len(missing))
+        if keys is not None:
+            # 同一次调用中重复的序列
+            for i, key in enumerate(keys):
+                if wavs[i] is None:
+                    wavs[i] = wavs[keys.index(key)]
+        return wavs
 
-        sentence = text.preprocess_sent(sentence)
-        ind = []
-        for word in sentence:
-            if word not in all_words:
-                continue
-            for phoneme in all_words[word]:
-                ind.append(index_dictionaly[phoneme])
-        
-        coded_text = ind
+    def synthesize_many(self, sentences, enhancement=True):
+        """
+        用多进程合成池并行合成多条文本，适合多核CPU上大量的短句，池的大小等参数见 pool_conf
+        文本前端与合成结果缓存仍在当前进程中完成，相同的文本只合成一次
+        :param sentences: 待预测文本列表
+        :param enhancement: 是否进行去噪处理
+        :return: 与 sentences 一一对应的语音 np.ndarray 列表
+        """
+        if self.pool is None:
+            pool_conf = self.configs.get('pool_conf', {})
+            self.pool = PredictorPool(self,
+                                      num_workers=pool_conf.get('num_workers', 0),
+                                      threads_per_worker=pool_conf.get('threads_per_worker', 1),
+                                      pin_cores=pool_conf.get('pin_cores', True),
+                                      group_size=pool_conf.get('group_size', 1))
+        with metrics.request('synthesize_many', utterances=len(sentences)):
+            with metrics.timer('frontend'):
+                coded_texts = [self.frontend.text_to_sequence(sentence) for sentence in sentences]
+            keys = list(range(len(coded_texts)))
+            wavs = [None] * len(coded_texts)
+            if self.cache is not None:
+                keys = [self.cache.key(coded_text, enhancement, self.seed) for coded_text in coded_texts]
+                wavs = [self.cache.get(key) for key in keys]
+            # 相同的序列只合成一次
+            missing = {}
+            for i, key in enumerate(keys):
+                if wavs[i] is None and key not in missing:
+                    missing[key] = i
+            with metrics.timer('pool'):
+                results = self.pool.synthesize([coded_texts[i] for i in missing.values()], enhancement=enhancement)
+            done = dict(zip(missing, results))
+            for i, key in enumerate(keys):
+                if wavs[i] is None:
+                    wavs[i] = done[key]
+            if self.cache is not None:
+                for key, wav in done.items():
+                    self.cache.put(key, wav)
+            metrics.inc('utterances_total', len(results))
+            metrics.inc('audio_seconds_total', sum(len(w) for w in results) / self.configs.preprocess_conf.fs)
+            metrics.inc('cache_hits_total', len(coded_texts) - len(missing))
+        return wavs
+
+    def close(self):
+        """关闭多进程合成池"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
+    def predict_batch(self, sentences, output_paths, enhancement=True, batch_size=16):
+        """
+        多条文本一起预测，每 batch_size 条文本补零后一起解码
+        :param sentences: 待预测文本列表
+        :param output_paths: 与 sentences 一一对应的 .wav文件输出路径
+        :param enhancement: 是否进行去噪处理
+        :param batch_size: 一次解码的文本条数
+        """
+        assert len(sentences) == len(output_paths), 'sentences 与 output_paths 的数量不一致'
+        with metrics.request('predict_batch'):
+            with metrics.timer('frontend'):
+                coded_texts = [self.frontend.text_to_sequence(sentence) for sentence in sentences]
+            inv_wavs = self.synthesize_sequences(coded_texts, enhancement=enhancement, batch_size=batch_size)
+            with metrics.timer('write'):
+                for output_path, inv_wav in zip(output_paths, inv_wavs):
+                    sf.write(output_path, inv_wav, self.configs.preprocess_conf.fs)
+
+    def synthesize_long(self, sentence: str, enhancement=True, batch_size=None):
+        """
+        长文本合成，按句子、分句切分为不超过 max_phonemes 个音素的若干段，每 batch_size 段一起合成，
+        依次输出每段语音以及段与段之间的静音，拼接后即为完整语音
+        切分位置后的停顿为 0 时，相邻两段做 crossfade_ms 毫秒的线性交叉淡化
+        同一时刻只保留 batch_size 段语音，内存占用与文本长度无关
+        :param sentence: 待预测的长文本
+        :param enhancement: 是否进行去噪处理
+        :param batch_size: 一次合成的段数，为 None 时使用 longform_conf.batch_size
+        :return: 依次输出 np.float32 语音片段的生成器
+        """
+        longform_conf = self.configs.get('longform_conf', {})
+        fs = self.configs.preprocess_conf.fs
+        batch_size = batch_size or longform_conf.get('batch_size', 8)
+        pauses = {'sentence': int(fs * longform_conf.get('sentence_pause_ms', 300) / 1000),
+                  'clause': int(fs * longform_conf.get('clause_pause_ms', 150) / 1000),
+                  'word': 0}
+        crossfade = int(fs * longform_conf.get('crossfade_ms', 20) / 1000)
 
-        text_in = torch.tensor(coded_text)
-        text_in = text_in.unsqueeze(0).to(self.device)
+        with metrics.timer('frontend'):
+            chunks = self.frontend.split(sentence, max_phonemes=longform_conf.get('max_phonemes', 150))
+        # 上一段末尾留作交叉淡化的部分
+        tail = None
+        for start in range(0, len(chunks), batch_size):
+            group = chunks[start:start + batch_size]
+            wavs = self.synthesize_sequences([coded_text for coded_text, _ in group],
+                                             enhancement=enhancement, batch_size=batch_size)
+            for j, ((_, boundary), wav) in enumerate(zip(group, wavs)):
+                wav = np.asarray(wav, dtype=np.float32)
+                if tail is not None:
+                    n = min(len(tail), len(wav))
+                    fade = np.linspace(0, 1, n, endpoint=False, dtype=np.float32)
+                    wav = np.concatenate([tail[:len(tail) - n], tail[len(tail) - n:] * (1 - fade) + wav[:n] * fade,
+                                          wav[n:]])
+                    tail = None
+                if start + j == len(chunks) - 1:
+                    yield wav
+                elif pauses[boundary] > 0:
+                    yield wav
+                    yield np.zeros(pauses[boundary], dtype=np.float32)
+                else:
+                    n = min(crossfade, len(wav))
+                    yield wav[:len(wav) - n]
+                    tail = wav[len(wav) - n:]
+            del wavs
 
+    def predict_long(self, sentence: str, output_path: str, enhancement=True, batch_size=None):
+        """
+        长文本合成并边合成边写入 .wav 文件
+        :param sentence: 待预测的长文本
+        :param output_path: .wav文件输出路径
+        :param enhancement: 是否进行去噪处理
+        :param batch_size: 一次合成的段数，为 None 时使用 longform_conf.batch_size
+        """
+        with metrics.request('predict_long'), \
+                sf.SoundFile(output_path, 'w', samplerate=self.configs.preprocess_conf.fs, channels=1) as f:
+            for wav in self.synthesize_long(sentence, enhancement=enhancement, batch_size=batch_size):
+                with metrics.timer('write'):
+                    f.write(wav)
+
+    def stream(self, sentence: str, chunk_frames=32, overlap_frames=8):
+        """
+        流式合成，解码的同时输出语音片段，依次拼接所有片段即为完整语音
+        每个 mel 片段会带上前一片段末尾的 overlap_frames 帧一起做 Griffin-Lim，重叠部分做线性交叉淡化
+        流式输出无法预知整句的最大幅度，幅度归一化使用到目前为止的最大值，并且不做去噪和首尾静音裁剪
+        :param sentence: 待预测文本
+        :param chunk_frames: 每个片段至少包含的 mel 帧数
+        :param overlap_frames: 相邻片段重叠的 mel 帧数
+        :return: 生成器，每次返回 float32 格式的 np.ndarray 语音片段
+        """
+        assert overlap_frames >= 2, 'overlap_frames 至少为2'
+        hop_length = self.configs.preprocess_conf.hop_length
+        coded_text = self.frontend.text_to_sequence(sentence)
+        text_in = torch.tensor(coded_text).unsqueeze(0).to(self.device)
+
+        # prev_mel 为上一片段末尾的 mel 帧，prev_tail 为上一片段还没有输出、需要做交叉淡化的语音
+        prev_mel, prev_tail, peak = None, None, 0.0
+        # 只在计算时关闭梯度，不在 yield 期间保持 no_grad：梯度开关是线程级别的状态，
+        # 否则调用方在两次 next() 之间以及放弃生成器之后执行的代码都会处于 no_grad 下
+        chunks = self.model.inference_stream(text_in, chunk_frames=chunk_frames)
         with torch.no_grad():
-            eval_outputs = self.model.inference(text_in)
-            mel_out = eval_outputs[1]
-            mel_out = mel_out.squeeze(0)
-            mel_out = mel_out.cpu().detach().numpy()
+            mel_out = next(chunks, None)
+        while mel_out is not None:
+            with torch.no_grad():
+                next_mel_out = next(chunks, None)
+            is_last = next_mel_out is None
+            mel_out = mel_out.cpu().numpy()
+            if prev_mel is not None:
+                mel_out = np.concatenate((prev_mel, mel_out), axis=-1)
+            prev_mel = mel_out[:, :, -overlap_frames:]
 
-        # 加载统计信息
-        file_static = os.path.join(self.configs.dataset_conf.mel_manifest_dir, 'static.npy')
-        static_mel = np.load(file_static, allow_pickle=True)
+            inv_fbank = librosa.db_to_power(mel_out * self.std_mel + self.mean_mel)
+            with torch.no_grad():
+                inv_wav = self.vocoder(inv_fbank)[0][0].cpu().numpy()
+            if prev_tail is not None:
+                fade = np.linspace(0.0, 1.0, len(prev_tail), endpoint=False, dtype=inv_wav.dtype)
+                inv_wav[:len(prev_tail)] = prev_tail * (1 - fade) + inv_wav[:len(prev_tail)] * fade
+            if not is_last:
+                # 末尾 overlap_frames - 1 帧的语音要与下一片段交叉淡化
+                split = len(inv_wav) - (overlap_frames - 1) * hop_length
+                inv_wav, prev_tail = inv_wav[:split], inv_wav[split:]
 
-        mean_mel = np.float64(static_mel[0])
-        std_mel = np.float64(static_mel[1])
-
-        # 反正则
-        generated_mel = mel_out * std_mel + mean_mel
-
-        # 进行解码
-        inv_fbank = librosa.db_to_power(generated_mel)
-        inv_wav = librosa.feature.inverse.mel_to_audio(inv_fbank,
-                                                       sr=self.configs.preprocess_conf.fs,
-                                                       n_fft=self.configs.preprocess_conf.n_fft,
-                                                       win_length=self.configs.preprocess_conf.win_length,
-                                                       hop_length=self.configs.preprocess_conf.hop_length,
-                                                       fmin=self.configs.preprocess_conf.fmin,
-                                                       fmax=self.configs.preprocess_conf.fmax)
-        inv_wav = inv_wav / max(inv_wav)
-        if enhancement:
-            inv_wav = speech_enhance(wave_data=inv_wav,
-                                     n_fft=self.configs.preprocess_conf.n_fft,
-                                     hop_length=self.configs.preprocess_conf.hop_length,
-                                     win_length=self.configs.preprocess_conf.win_length,
-                                     noise_frame=30)
-        inv_wav, _ = librosa.effects.trim(inv_wav)
-        sf.write(output_path, inv_wav, self.configs.preprocess_conf.fs)
+            peak = max(peak, float(np.max(np.abs(inv_wav))) if len(inv_wav) else 0.0)
+            if len(inv_wav) and peak > 0:
+                yield (inv_wav / peak).astype(np.float32)
+            mel_out = next_mel_out
@@ -0,0 +1,154 @@
+import json
+import os
+import queue
+import threading
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from src.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def _core_sets(num_workers, threads_per_worker):
+    """给每个 worker 分配 threads_per_worker 个不重叠的 CPU 核，核数不够或者系统不支持时返回 None"""
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    if num_workers * threads_per_worker > len(cores):
+        logger.warning(f'{num_workers} 个 worker 每个使用 {threads_per_worker} 个线程，超过可用的 {len(cores)} 个核，不绑定核')
+        return None
+    return [cores[i * threads_per_worker:(i + 1) * threads_per_worker] for i in range(num_workers)]
+
+
+def _worker_main(rank, configs, model_path, state_dict, cores, threads, task_queue, result_queue):
+    """worker 进程：绑定核、设置线程数，用共享内存中的参数构建预测器，循环处理任务直到收到 None"""
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    from src.predictor import Tacotron2Predictor
+    predictor = Tacotron2Predictor(configs=configs, model_path=model_path, use_gpu=False, state_dict=state_dict)
+    result_queue.put((None, rank, None))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, coded_texts, enhancement = task
+        try:
+            wavs = predictor.synthesize_sequences(coded_texts, enhancement=enhancement, batch_size=len(coded_texts))
+        except Exception:
+            result_queue.put((task_id, None, traceback.format_exc()))
+        else:
+            result_queue.put((task_id, wavs, None))
+
+
+class PredictorPool:
+    """
+    多进程合成池
+    batch 为1的 LSTM 逐步解码时 PyTorch 的多线程几乎没有加速，多核机器上改为启动多个进程，每个进程使用少量线程并绑定到各自的核上
+    - 主进程的模型参数移到共享内存中，worker 直接使用这份参数，不会各自读取 model.pt，整个池只有一份参数
+    - 文本前端与合成结果缓存在主进程中，worker 只负责合成音素编码序列
+    - 任务按音素长度从长到短放入同一个队列，空闲的 worker 依次领取，最长的句子最先开始，减少最后只有少数 worker 在工作的时间
+    worker 使用 spawn 方式启动，调用的脚本需要放在 if __name__ == '__main__' 下
+    """
+
+    def __init__(self, predictor, num_workers=0, threads_per_worker=1, pin_cores=True, group_size=1):
+        """
+        :param predictor: CPU 上、没有量化的 Tacotron2Predictor，它的模型参数会被移到共享内存
+        :param num_workers: worker 进程数，为0时为 可用核数 // threads_per_worker
+        :param threads_per_worker: 每个 worker 的 torch 线程数
+        :param pin_cores: 是否把每个 worker 绑定到不重叠的核上
+        :param group_size: 每个任务包含的序列条数，长度相近的短句可以一起解码
+        """
+        assert predictor.device.type == 'cpu' and not predictor.quantize, '多进程合成只支持没有量化的CPU模型'
+        if not num_workers:
+            available = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+            num_workers = max(available // threads_per_worker, 1)
+        self.num_workers = num_workers
+        self.group_size = group_size
+        self._lock = threading.Lock()
+        self._next_task_id = 0
+
+        predictor.model.share_memory()
+        state_dict = predictor.model.state_dict()
+        # 转为普通的 dict 传给 worker
+        configs = json.loads(json.dumps(predictor.configs))
+        # worker 不使用缓存，也不输出统计信息，二者都由主进程负责
+        configs['cache_conf'] = {'enable': False, 'seed': predictor.seed}
+        configs['metrics_conf'] = {'enable': False}
+        cores = _core_sets(num_workers, threads_per_worker) if pin_cores else None
+
+        ctx = mp.get_context('spawn')
+        self._task_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        self._workers = []
+        for rank in range(num_workers):
+            worker = ctx.Process(target=_worker_main,
+                                 args=(rank, configs, predictor.model_path, state_dict,
+                                       cores[rank] if cores else None, threads_per_worker,
+                                       self._task_queue, self._result_queue),
+                                 daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        for _ in range(num_workers):
+            self._get_result()
+        logger.info(f'已启动 {num_workers} 个合成进程，每个进程 {threads_per_worker} 个线程')
+
+    def _get_result(self):
+        """等待一个结果，期间有 worker 异常退出时报错，避免一直阻塞"""
+        while True:
+            try:
+                return self._result_queue.get(timeout=1)
+            except queue.Empty:
+                dead = [w.pid for w in self._workers if not w.is_alive()]
+                if dead:
+                    raise RuntimeError(f'合成进程 {dead} 异常退出')
+
+    def synthesize(self, coded_texts, enhancement=True):
+        """
+        并行合成多条音素编码序列
+        :param coded_texts: 音素编码序列列表，每条不能为空
+        :param enhancement: 是否进行去噪处理
+        :return: 与 coded_texts 一一对应的语音 np.ndarray 列表
+        """
+        order = sorted(range(len(coded_texts)), key=lambda i: len(coded_texts[i]), reverse=True)
+        groups = [order[start:start + self.group_size] for start in range(0, len(order), self.group_size)]
+        wavs = [None] * len(coded_texts)
+        with self._lock:
+            tasks = {}
+            for group in groups:
+                task_id = self._next_task_id
+                self._next_task_id += 1
+                tasks[task_id] = group
+                self._task_queue.put((task_id, [coded_texts[i] for i in group], enhancement))
+            errors = []
+            while tasks:
+                task_id, result, error = self._get_result()
+                group = tasks.pop(task_id)
+                if error is not None:
+                    errors.append(error)
+                    continue
+                for i, wav in zip(group, result):
+                    wavs[i] = wav
+        if errors:
+            raise RuntimeError(f'{len(errors)} 个合成任务失败：\n{errors[0]}')
+        return wavs
+
+    def close(self):
+        """通知所有 worker 退出并等待结束"""
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,277 @@
+import asyncio
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import soundfile as sf
+
+from src.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+_STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class QueueFullError(Exception):
+    """等待合成的请求数超过上限"""
+
+
+class _PendingRequest:
+    __slots__ = ('coded_text', 'future', 'arrival_time')
+
+    def __init__(self, coded_text, future):
+        self.coded_text = coded_text
+        self.future = future
+        self.arrival_time = time.perf_counter()
+
+
+class DynamicBatcher:
+    """
+    动态组 batch 的请求队列
+    等待最久的请求到达后最多再等 max_wait_ms，或者凑满 max_batch_size 条请求时开始合成；
+    组 batch 时把所有等待中的请求按音素长度排序，选出包含等待最久请求、且长度跨度最小的连续 max_batch_size 条，
+    这样同一个 batch 的解码长度接近，而等待最久的请求总会被优先合成，不会一直排不上
+    合成在单独的线程中进行，同一时刻只有一个 batch 在合成，合成期间到达的请求留在队列里等待下一个 batch
+    """
+
+    def __init__(self, synthesize_fn, max_batch_size=8, max_wait_ms=20, max_queue_size=256, stats_window=1000):
+        """
+        :param synthesize_fn: 输入音素编码序列列表，返回一一对应的语音列表的合成函数
+        :param max_batch_size: 每个 batch 最多的请求条数
+        :param max_wait_ms: 请求最多等待其他请求组 batch 的时间（毫秒）
+        :param max_queue_size: 最多等待合成的请求数，超过时拒绝新的请求
+        :param stats_window: 统计延迟分位数时使用最近多少条请求
+        """
+        self.synthesize_fn = synthesize_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self._pending = []
+        self._arrived = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._latencies = deque(maxlen=stats_window)
+        self._queue_times = deque(maxlen=stats_window)
+        self._batch_sizes = deque(maxlen=stats_window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.num_rejected = 0
+
+    async def submit(self, coded_text):
+        """提交一条音素编码序列，返回合成的语音"""
+        if len(self._pending) >= self.max_queue_size:
+            self.num_rejected += 1
+            raise QueueFullError(f'等待合成的请求数已达到上限 {self.max_queue_size}')
+        request = _PendingRequest(coded_text, asyncio.get_running_loop().create_future())
+        self._pending.append(request)
+        if self._arrived is not None:
+            self._arrived.set()
+        return await request.future
+
+    def _select_batch(self):
+        """从等待中的请求里选出一个 batch，并从队列中移除"""
+        if len(self._pending) <= self.max_batch_size:
+            batch, self._pending = self._pending, []
+            return batch
+        oldest = self._pending[0]
+        ordered = sorted(self._pending, key=lambda r: len(r.coded_text))
+        position = ordered.index(oldest)
+        first = max(0, position - self.max_batch_size + 1)
+        last = min(position, len(ordered) - self.max_batch_size)
+        start = min(range(first, last + 1),
+                    key=lambda i: len(ordered[i + self.max_batch_size - 1].coded_text) - len(ordered[i].coded_text))
+        batch = ordered[start:start + self.max_batch_size]
+        selected = set(map(id, batch))
+        self._pending = [r for r in self._pending if id(r) not in selected]
+        return batch
+
+    async def run(self):
+        """组 batch 并合成，需要在事件循环中作为常驻任务运行"""
+        loop = asyncio.get_running_loop()
+        self._arrived = asyncio.Event()
+        while True:
+            if not self._pending:
+                self._arrived.clear()
+                await self._arrived.wait()
+            deadline = self._pending[0].arrival_time + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            # 客户端已断开的请求不再合成
+            self._pending = [r for r in self._pending if not r.future.done()]
+            if not self._pending:
+                continue
+            batch = self._select_batch()
+            start_time = time.perf_counter()
+            try:
+                wavs = await loop.run_in_executor(self._executor, self.synthesize_fn,
+                                                  [r.coded_text for r in batch])
+            except Exception as e:
+                logger.exception(f'合成失败：{e}')
+                self.num_errors += len(batch)
+                for r in batch:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+                continue
+            end_time = time.perf_counter()
+            self.num_batches += 1
+            self._batch_sizes.append(len(batch))
+            for r, wav in zip(batch, wavs):
+                self.num_requests += 1
+                self._queue_times.append(start_time - r.arrival_time)
+                self._latencies.append(end_time - r.arrival_time)
+                if not r.future.done():
+                    r.future.set_result(wav)
+
+    @staticmethod
+    def _percentiles(values):
+        if not values:
+            return {'p50': None, 'p90': None, 'p99': None}
+        p50, p90, p99 = np.percentile(np.array(values) * 1000, [50, 90, 99])
+        return {'p50': round(float(p50), 2), 'p90': round(float(p90), 2), 'p99': round(float(p99), 2)}
+
+    def stats(self):
+        """队列深度、请求计数以及最近请求的延迟分位数（毫秒）"""
+        return {'queue_depth': len(self._pending),
+                'requests': self.num_requests,
+                'batches': self.num_batches,
+                'errors': self.num_errors,
+                'rejected': self.num_rejected,
+                'mean_batch_size': round(float(np.mean(self._batch_sizes)), 2) if self._batch_sizes else None,
+                'latency_ms': self._percentiles(self._latencies),
+                'queue_time_ms': self._percentiles(self._queue_times)}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class SynthesisServer:
+    """
+    基于 asyncio 的本地 HTTP 合成服务，一个进程只加载一次模型，并发请求由 DynamicBatcher 组 batch 合成
+    接口：
+        POST /synthesize  请求体为 {"text": "..."}，返回 audio/wav
+        GET  /synthesize?text=...  同上
+        GET  /metrics     返回队列深度、请求计数、延迟分位数以及缓存命中情况的 json
+        GET  /health      服务是否正常
+    """
+
+    def __init__(self, predictor, host='127.0.0.1', port=8000, enhancement=True,
+                 max_batch_size=8, max_wait_ms=20, max_queue_size=256, max_text_length=1000):
+        """
+        :param predictor: Tacotron2Predictor
+        :param host: 监听地址
+        :param port: 监听端口
+        :param enhancement: 是否对合成的语音去噪
+        :param max_batch_size: 每个 batch 最多的请求条数
+        :param max_wait_ms: 请求最多等待其他请求组 batch 的时间（毫秒）
+        :param max_queue_size: 最多等待合成的请求数
+        :param max_text_length: 每条请求文本的最大字符数
+        """
+        self.predictor = predictor
+        self.host = host
+        self.port = port
+        self.max_text_length = max_text_length
+        self.fs = predictor.configs.preprocess_conf.fs
+        self.batcher = DynamicBatcher(
+            lambda coded_texts: predictor.synthesize_sequences(coded_texts, enhancement=enhancement,
+                                                               batch_size=max_batch_size),
+            max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, max_queue_size=max_queue_size)
+
+    def _encode_wav(self, wav):
+        buffer = io.BytesIO()
+        sf.write(buffer, wav, self.fs, format='WAV', subtype='PCM_16')
+        return buffer.getvalue()
+
+    @staticmethod
+    def _json_response(status, obj):
+        return status, 'application/json', json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    async def _synthesize(self, sentence):
+        if not sentence or len(sentence) > self.max_text_length:
+            return self._json_response(400, {'error': f'text 不能为空且不能超过 {self.max_text_length} 个字符'})
+        coded_text = self.predictor.frontend.text_to_sequence(sentence)
+        if not coded_text:
+            return self._json_response(400, {'error': 'text 中没有发音词典中的单词'})
+        try:
+            wav = await self.batcher.submit(coded_text)
+        except QueueFullError as e:
+            return self._json_response(503, {'error': str(e)})
+        except Exception as e:
+            return self._json_response(500, {'error': str(e)})
+        return 200, 'audio/wav', self._encode_wav(wav)
+
+    async def _route(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/health':
+            return self._json_response(200, {'status': 'ok'})
+        if url.path == '/metrics':
+            stats = self.batcher.stats()
+            if self.predictor.cache is not None:
+                stats['cache'] = self.predictor.cache.stats()
+            return self._json_response(200, stats)
+        if url.path == '/synthesize':
+            if method == 'GET':
+                sentence = parse_qs(url.query).get('text', [''])[0]
+            elif method == 'POST':
+                try:
+                    sentence = json.loads(body.decode('utf-8'))['text']
+                except (ValueError, KeyError, TypeError):
+                    return self._json_response(400, {'error': '请求体应为 {"text": "..."} 格式的 json'})
+            else:
+                return self._json_response(405, {'error': f'不支持 {method} 方法'})
+            return await self._synthesize(str(sentence).strip())
+        return self._json_response(404, {'error': f'{url.path} 不存在'})
+
+    async def _handle(self, reader, writer):
+        """处理一个连接上的一个请求，响应后关闭连接"""
+        try:
+            try:
+                header = await reader.readuntil(b'\r\n\r\n')
+                lines = header.decode('latin-1').split('\r\n')
+                method, target, _ = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        key, value = line.split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+                content_length = int(headers.get('content-length', 0))
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                status, content_type, payload = self._json_response(400, {'error': '无法解析的 HTTP 请求'})
+            else:
+                if content_length > self.max_text_length * 8:
+                    status, content_type, payload = self._json_response(413, {'error': '请求体过大'})
+                else:
+                    body = await reader.readexactly(content_length) if content_length else b''
+                    status, content_type, payload = await self._route(method.upper(), target, body)
+            writer.write(f'HTTP/1.1 {status} {_STATUS_TEXT[status]}\r\n'
+                         f'Content-Type: {content_type}\r\n'
+                         f'Content-Length: {len(payload)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + payload)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """启动服务，一直运行直到被取消"""
+        batcher_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f'合成服务已启动：http://{self.host}:{self.port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+            self.batcher.close()
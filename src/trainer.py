@@ -1,18 +1,28 @@
+import contextlib
 import json
+import logging
 import os
+import random
 import shutil
 import time
 from datetime import timedelta
 
+import numpy as np
 import torch
+import torch.distributed as dist
 import yaml
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import BatchSampler, DataLoader, DistributedSampler
 from tqdm import tqdm
 
-from src.data_utils.dataset import Tacotron2Dataset, TextMelCollate
+from src.data_utils.dataset import Tacotron2Dataset, TextMelCollate, DevicePrefetcher
+from src.data_utils.sampler import BucketBatchSampler, ResumableBatchSampler
 from src.models.loss_function import Tacotron2Loss
 from src.optimizer.scheduler import WarmupLR, NoamHoldAnnealing, CosineWithWarmup
+from src.utils.checkpoint import AsyncCheckpointWriter, point_to
 from src.utils.logger import setup_logger
+from src.utils.metrics import JsonLinesSink
+from src.utils.train_metrics import TensorBoardSink, WindowedMeter
 from src.utils.utils import dict_to_object, print_arguments
 from src.models.model import Tacotron2
 
@@ -20,16 +30,30 @@ logger = setup_logger(__name__)
 
 
 class TacoTronTrainer:
-    """TTS Framework"""
+    """
+    TTS Framework
+    用 torchrun 启动多个进程时（环境变量 WORLD_SIZE 大于1）为数据并行的分布式训练：
+    每个进程读取数据集的不同部分，反向传播时 all-reduce 梯度，只有 rank 0 输出日志和保存模型，
+    CPU 训练使用 gloo 后端，GPU 训练使用 nccl 后端，例如单机4进程的CPU训练：
+        torchrun --nproc_per_node=4 train.py --use_gpu=False
+    """
 
     def __init__(self, configs, use_gpu=True):
         """
         :param configs: 配置文件路径或者是yaml读取到的配置参数
         :param use_gpu: 是否使用GPU训练模型
         """
+        self.world_size = int(os.environ.get('WORLD_SIZE', 1))
+        self.rank = int(os.environ.get('RANK', 0))
+        self.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        self.distributed = self.world_size > 1
+        if self.rank != 0:
+            # 只有 rank 0 输出日志，其他进程只输出警告和错误
+            logging.disable(logging.INFO)
         if use_gpu:
             assert (torch.cuda.is_available()), 'GPU不可用'
-            self.device = torch.device('cuda:0')
+            self.device = torch.device(f'cuda:{self.local_rank}')
+            torch.cuda.set_device(self.device)
         else:
             self.device = torch.device('cpu')
         # 读取配置文件
@@ -43,18 +67,73 @@ class TacoTronTrainer:
         self.configs = dict_to_object(configs)
         self.use_gpu = use_gpu
         self.model = None
+        # 训练时前向计算使用的模型，分布式训练时为 DistributedDataParallel 包装后的 self.model
+        self.train_model = None
+        # 在后台线程中写检查点，只在 rank 0 创建
+        self.checkpoint_writer = None
+        # 恢复训练时读取的 train_state.pt，在恢复后的第一个 epoch 中使用
+        self.resume_state = None
+        # 训练吞吐量统计的输出，只在 rank 0 创建
+        self.metrics_sinks = []
+        if self.distributed:
+            self.__init_distributed()
+
+    def __init_distributed(self):
+        """初始化进程组，CPU 训练时把可用的核平均分给本机的各个进程"""
+        train_conf = self.configs.train_conf
+        backend = train_conf.get('dist_backend', None) or ('nccl' if self.use_gpu else 'gloo')
+        dist.init_process_group(backend=backend)
+        if not self.use_gpu:
+            # torchrun 默认把每个进程的 OMP_NUM_THREADS 设为1，decoder 的逐步计算用不满所有的核
+            threads = train_conf.get('threads_per_rank', 0)
+            if not threads:
+                cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+                threads = max(cores // int(os.environ.get('LOCAL_WORLD_SIZE', self.world_size)), 1)
+            torch.set_num_threads(threads)
+        logger.info(f'分布式训练：{self.world_size} 个进程，后端：{backend}，'
+                    f'每个进程 {torch.get_num_threads()} 个线程')
 
     def __setup_dataloader(self):
         """获取训练数据"""
         collate_fn = TextMelCollate(self.configs.model_conf.n_frames_per_step)
         self.train_dataset = Tacotron2Dataset(self.configs.dataset_conf.train_manifest,
-                                              self.configs.dataset_conf.mel_manifest_dir)
+                                              self.configs.dataset_conf.mel_manifest_dir,
+                                              mel_format=self.configs.dataset_conf.get('mel_format', 'auto'))
+        # 多进程读取数据时保持子进程常驻并按 prefetch_factor 预读，使用GPU时把数据放到锁页内存中
+        num_workers = self.configs.train_conf.num_workers
+        # DataLoader 创建迭代器时从 generator 取子进程的种子，不消耗全局的随机数，恢复训练时随机数状态与中断前一致
+        loader_kwargs = dict(num_workers=num_workers, pin_memory=self.device.type == 'cuda',
+                             generator=torch.Generator().manual_seed(torch.initial_seed()))
+        if num_workers > 0:
+            loader_kwargs.update(persistent_workers=True,
+                                 prefetch_factor=self.configs.train_conf.get('prefetch_factor', 2))
+        # 每个 epoch 的数据顺序只由 seed 与 epoch 决定，从 epoch 中间恢复训练时可以跳过已经训练过的 batch
+        if self.configs.train_conf.get('bucket_batch', False):
+            logger.warning(f'已开启 bucket_batch，不使用 batch_size={self.configs.train_conf.batch_size}，'
+                           f'每个batch的大小由 max_frames_per_batch={self.configs.train_conf.max_frames_per_batch} 决定')
+            # 按 mel 长度分桶，每个 batch 的条数由帧数预算决定，分布式训练时各进程分到不同的 batch
+            self.train_sampler = BucketBatchSampler(self.train_dataset.get_mel_lengths(),
+                                                    max_frames=self.configs.train_conf.max_frames_per_batch,
+                                                    pad_multiple=self.configs.model_conf.n_frames_per_step,
+                                                    drop_last=True,
+                                                    seed=torch.initial_seed() % 2 ** 31,
+                                                    num_replicas=self.world_size,
+                                                    rank=self.rank)
+            self.train_batch_sampler = ResumableBatchSampler(self.train_sampler)
+        else:
+            # batch_size 为每个进程的批量大小，单进程训练时 num_replicas 为1，只负责打乱顺序
+            self.train_sampler = DistributedSampler(self.train_dataset,
+                                                    num_replicas=self.world_size,
+                                                    rank=self.rank,
+                                                    shuffle=True,
+                                                    seed=torch.initial_seed() % 2 ** 31,
+                                                    drop_last=True)
+            self.train_batch_sampler = ResumableBatchSampler(
+                BatchSampler(self.train_sampler, batch_size=self.configs.train_conf.batch_size, drop_last=True))
         self.train_loader = torch.utils.data.DataLoader(self.train_dataset,
-                                                        batch_size=self.configs.train_conf.batch_size,
+                                                        batch_sampler=self.train_batch_sampler,
                                                         collate_fn=collate_fn,
-                                                        shuffle=True,
-                                                        num_workers=self.configs.train_conf.num_workers,
-                                                        drop_last=True)
+                                                        **loader_kwargs)
 
     def __print_model_params(self):
         """打印模型参数"""
@@ -67,6 +146,14 @@ class TacoTronTrainer:
         """获取模型"""
         self.model = Tacotron2(self.configs.model_conf)
         self.model.to(self.device)
+        if is_train and self.configs.train_conf.get('compile_decoder', False):
+            # 训练时的解码循环用 TorchScript 编译，减少每一步的 Python 调度开销
+            self.model.decoder.compile_teacher_forcing()
+            logger.info('已编译 decoder 训练循环')
+        if is_train and self.configs.train_conf.get('decoder_checkpoint_steps', 0):
+            # 用重新计算换取显存，可以使用更大的 batch
+            self.model.decoder.checkpoint_teacher_forcing(self.configs.train_conf.decoder_checkpoint_steps)
+            logger.info(f'decoder 训练循环每 {self.configs.train_conf.decoder_checkpoint_steps} 步重计算一次激活值')
         if is_train:
             self.__print_model_params()
             self.criterion = Tacotron2Loss()
@@ -141,59 +228,143 @@ class TacoTronTrainer:
                 last_epoch = json_data['last_epoch'] - 1
                 if 'test_loss' in json_data.keys():
                     best_error_rate = abs(json_data['test_loss'])
+            train_state_path = os.path.join(resume_model, 'train_state.pt')
+            if os.path.exists(train_state_path):
+                # 包含 numpy 的随机数状态，只能以 weights_only=False 读取，该文件由 __save_checkpoint 生成
+                self.resume_state = torch.load(train_state_path, weights_only=False)
+                self.scheduler.load_state_dict(self.resume_state['scheduler'])
+                if self.configs.train_conf.enable_amp and 'amp_scaler' in self.resume_state:
+                    self.amp_scaler.load_state_dict(self.resume_state['amp_scaler'])
+                self.train_step = self.resume_state['train_step']
+                best_error_rate = self.resume_state['best_error_rate']
+                if len(self.resume_state['rng']) != self.world_size:
+                    logger.warning(f'检查点由 {len(self.resume_state["rng"])} 个进程训练，当前为 {self.world_size} 个进程，'
+                                   f'随机数与数据顺序无法与中断前一致')
+                if self.resume_state['epoch_step'] > 0:
+                    logger.info(f'从第 {self.resume_state["epoch"]} 个 epoch 的第 {self.resume_state["epoch_step"]} 个 batch 恢复训练')
             logger.info(f'成功恢复模型参数和优化方法参数：{resume_model}')
         return last_epoch, best_error_rate
 
-    def __save_checkpoint(self, save_model_path, epoch_id, test_loss, best_model=False):
-        """保存模型"""
-        save_model_name = f'{self.configs.use_model}'
-        if best_model:
-            model_path = os.path.join(save_model_path, save_model_name, 'best_model')
+    def __rng_state(self):
+        """所有进程当前的随机数状态，按 rank 排列"""
+        state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+        if torch.cuda.is_available():
+            state['cuda'] = torch.cuda.get_rng_state_all()
+        if not self.distributed:
+            return [state]
+        states = [None] * self.world_size
+        dist.all_gather_object(states, state)
+        return states
+
+    def __set_rng_state(self, states):
+        """恢复当前进程的随机数状态"""
+        state = states[self.rank % len(states)]
+        random.setstate(state['python'])
+        np.random.set_state(state['numpy'])
+        torch.set_rng_state(state['torch'])
+        if 'cuda' in state and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['cuda'])
+
+    def __save_checkpoint(self, save_model_path, epoch_id, test_loss, best_model=False,
+                          epoch_step=0, epoch_meter=None):
+        """
+        保存模型，所有进程都需要调用，只有 rank 0 写文件
+        epoch_step 为0时为 epoch 结束时的检查点，保存到 epoch_{epoch_id}，best_model 为 True 时同一份检查点也保存为 best_model；
+        否则为 epoch 中间每 save_steps 步保存的检查点，保存到 step_{train_step}，只保留最新的一个
+        train_state.pt 记录学习率衰减、AMP、随机数状态以及本 epoch 已经训练的 batch 数，恢复训练时从中断的位置继续
+        训练线程只把参数复制到CPU内存，写文件、把 last_model 指向最新的检查点、删除旧的模型都在后台线程中完成
+        """
+        train_state = {'epoch': epoch_id,
+                       'epoch_step': epoch_step,
+                       'train_step': self.train_step,
+                       'best_error_rate': self.best_error_rate,
+                       'epoch_meter': epoch_meter.state_dict() if epoch_meter is not None else None,
+                       'scheduler': self.scheduler.state_dict(),
+                       'rng': self.__rng_state()}
+        if self.configs.train_conf.enable_amp:
+            train_state['amp_scaler'] = self.amp_scaler.state_dict()
+        if self.rank != 0:
+            return
+        model_dir = os.path.join(save_model_path, f'{self.configs.use_model}')
+        os.makedirs(model_dir, exist_ok=True)
+        if epoch_step > 0:
+            model_path = os.path.join(model_dir, 'step_{}'.format(self.train_step))
+            # 已经完成的 epoch 数，与 epoch 结束时的检查点含义相同
+            model_state = {'last_epoch': epoch_id - 1, 'test_loss': self.best_error_rate,
+                           'epoch_step': epoch_step, 'train_step': self.train_step}
         else:
-            model_path = os.path.join(save_model_path, save_model_name, 'epoch_{}'.format(epoch_id))
-        os.makedirs(model_path, exist_ok=True)
-        torch.save(self.optimizer.state_dict(), os.path.join(model_path, 'optimizer.pt'))
-        torch.save(self.model.state_dict(), os.path.join(model_path, 'model.pt'))
-        with open(os.path.join(model_path, 'model.state'), 'w', encoding='utf-8') as f:
-            f.write('{{"last_epoch": {}, "test_loss": {}}}'.format(epoch_id, test_loss))
-        if not best_model:
-            last_model_path = os.path.join(save_model_path, save_model_name, 'last_model')
-            shutil.rmtree(last_model_path, ignore_errors=True)
-            shutil.copytree(model_path, last_model_path)
-            # 删除旧的模型
-            old_model_path = os.path.join(save_model_path, save_model_name, 'epoch_{}'.format(epoch_id - 3))
-            if os.path.exists(old_model_path):
+            model_path = os.path.join(model_dir, 'epoch_{}'.format(epoch_id))
+            model_state = {'last_epoch': epoch_id, 'test_loss': test_loss, 'train_step': self.train_step}
+        model_paths = [model_path]
+        if best_model:
+            model_paths.append(os.path.join(model_dir, 'best_model'))
+
+        def update_last_model():
+            # last_model 是指向最新检查点文件夹的符号链接，不再复制整个文件夹
+            point_to(os.path.join(model_dir, 'last_model'), model_path)
+            # 删除被取代的 step 检查点与旧的模型
+            for name in os.listdir(model_dir):
+                if name.startswith('step_') and os.path.join(model_dir, name) != model_path:
+                    shutil.rmtree(os.path.join(model_dir, name), ignore_errors=True)
+            old_model_path = os.path.join(model_dir, 'epoch_{}'.format(epoch_id - 3))
+            if epoch_step == 0 and os.path.exists(old_model_path):
                 shutil.rmtree(old_model_path)
-        logger.info('已保存模型：{}'.format(model_path))
 
-    def __train_epoch(self, epoch_id):
+        self.checkpoint_writer.save(model_paths,
+                                    tensors={'optimizer.pt': self.optimizer.state_dict(),
+                                             'model.pt': self.model.state_dict(),
+                                             'train_state.pt': train_state},
+                                    texts={'model.state': json.dumps(model_state)},
+                                    callback=update_last_model)
+
+    def __train_epoch(self, epoch_id, save_model_path):
         accum_grad = self.configs.train_conf.accum_grad
         grad_clip = self.configs.train_conf.grad_clip
-        train_times, reader_times, batch_times, batch_losses = [], [], [], []
-        start = time.time()
+        save_steps = self.configs.train_conf.get('save_steps', 0)
+        log_interval = self.configs.train_conf.log_interval
+        # window_meter 统计两次输出日志之间的数据，epoch_meter 统计整个 epoch
+        window_meter, epoch_meter = WindowedMeter(self.device), WindowedMeter(self.device)
+        # 从检查点恢复后的第一个 epoch：恢复随机数状态，跳过已经训练过的 batch
+        resume_state, self.resume_state = self.resume_state, None
+        start_batch = 0
+        if resume_state is not None:
+            self.__set_rng_state(resume_state['rng'])
+            start_batch = resume_state['epoch_step']
+            if resume_state['epoch_meter'] is not None:
+                epoch_meter.load_state_dict(resume_state['epoch_meter'])
+            self.train_batch_sampler.skip(start_batch)
+        start = time.perf_counter()
         self.model.train()
-        for batch_id, batch in enumerate(tqdm(self.train_loader, desc=f'epoch:{epoch_id}')):
-            text_padded = batch[0].to(self.device)
-            text_lengths = batch[1].to(self.device)
-            target_mel = batch[2].to(self.device)
-            target_gate = batch[3].to(self.device)
-            mel_lengths = batch[4].to(self.device)
-            reader_times.append((time.time() - start) * 1000)
-            start_step = time.time()
+        # 下一个 batch 在后台提前拷贝到训练设备上
+        train_loader = DevicePrefetcher(self.train_loader, self.device)
+        for batch_id, batch in enumerate(tqdm(train_loader, desc=f'epoch:{epoch_id}', disable=self.rank != 0),
+                                         start=start_batch):
+            text_padded, text_lengths, target_mel, target_gate, mel_lengths = batch
+            # GPU 训练时以下耗时只包含CPU端发起计算的时间，吞吐量按实际经过的时间计算，不受影响
+            start_step = time.perf_counter()
+            reader_seconds = start_step - start
 
-            # 执行模型计算，是否开启自动混合精度
-            with torch.cuda.amp.autocast(enabled=self.configs.train_conf.enable_amp):
-                outputs = self.model(text_padded, text_lengths, target_mel, mel_lengths)
-                loss = self.criterion(outputs, [target_mel, target_gate])
-            loss = loss / accum_grad
-            batch_losses.append(loss.cpu().detach().numpy())
-            # 是否开启自动混合精度
-            if self.configs.train_conf.enable_amp:
-                # loss缩放，乘以系数loss_scaling
-                scaled = self.amp_scaler.scale(loss)
-                scaled.backward()
-            else:
-                loss.backward()
+            # 分布式训练时只在更新参数的那一步同步梯度，梯度累加的其他步跳过 all-reduce
+            sync_context = contextlib.nullcontext()
+            if self.distributed and batch_id % accum_grad != 0:
+                sync_context = self.train_model.no_sync()
+            with sync_context:
+                # 执行模型计算，是否开启自动混合精度
+                with torch.cuda.amp.autocast(enabled=self.configs.train_conf.enable_amp):
+                    outputs = self.train_model(text_padded, text_lengths, target_mel, mel_lengths)
+                    loss = self.criterion(outputs, [target_mel, target_gate])
+                loss = loss / accum_grad
+                # 是否开启自动混合精度
+                if self.configs.train_conf.enable_amp:
+                    # loss缩放，乘以系数loss_scaling
+                    scaled = self.amp_scaler.scale(loss)
+                    scaled.backward()
+                else:
+                    loss.backward()
+            start_optimizer = time.perf_counter()
+            for meter in (window_meter, epoch_meter):
+                meter.add_batch(loss, mel_lengths, padded_frames=target_mel.shape[0] * target_mel.shape[-1],
+                                reader_seconds=reader_seconds, compute_seconds=start_optimizer - start_step)
             # 执行一次梯度计算
             if batch_id % accum_grad == 0:
                 # 是否开启自动混合精度
@@ -208,17 +379,49 @@ class TacoTronTrainer:
                 self.optimizer.zero_grad()
                 self.scheduler.step()
                 self.train_step += 1
-            batch_times.append((time.time() - start_step) * 1000)
+                for meter in (window_meter, epoch_meter):
+                    meter.add_optimizer_step(time.perf_counter() - start_optimizer)
+                # epoch 中间的检查点，在参数更新之后保存，此时没有累加到一半的梯度
+                # 最后一个 batch 之后紧接着保存 epoch 的检查点，不再单独保存
+                num_batches = len(self.train_batch_sampler.batch_sampler)
+                if save_steps and self.train_step % save_steps == 0 and batch_id + 1 < num_batches:
+                    self.__save_checkpoint(save_model_path=save_model_path, epoch_id=epoch_id, test_loss=None,
+                                           epoch_step=batch_id + 1, epoch_meter=epoch_meter)
 
-            train_times.append((time.time() - start) * 1000)
-            if batch_id % self.configs.train_conf.log_interval == 0:
-                logger.info(f'loss: {loss.cpu().detach().numpy():.5f}, '
-                            f'learning_rate: {self.scheduler.get_last_lr()[0]:>.8f}, '
-                            f'reader_cost: {(sum(reader_times) / len(reader_times) / 1000):.4f}, '
-                            f'batch_cost: {(sum(batch_times) / len(batch_times) / 1000):.4f}, ')
-                train_times = []
-            start = time.time()
-        return float(sum(batch_losses) / len(batch_losses))
+            # 只在输出日志时同步一次训练设备，读取这段时间的平均 loss 与吞吐量
+            if (batch_id + 1) % log_interval == 0 and self.rank == 0:
+                self.__log_metrics(window_meter.summary(), kind='step', epoch=epoch_id, batch=batch_id + 1)
+                window_meter.reset()
+            start = time.perf_counter()
+        if self.rank == 0:
+            self.__log_metrics(epoch_meter.summary(), kind='epoch', epoch=epoch_id, batch=epoch_meter.batches)
+        epoch_loss = epoch_meter.mean_loss()
+        if self.distributed:
+            # 各进程的平均 loss，所有进程据此做出相同的判断
+            epoch_loss = torch.tensor([epoch_loss], dtype=torch.float64, device=self.device)
+            dist.all_reduce(epoch_loss)
+            epoch_loss = epoch_loss.item() / self.world_size
+        return epoch_loss
+
+    def __log_metrics(self, summary, kind, epoch, batch):
+        """输出训练吞吐量统计，并写入 train_conf 中配置的 json lines 文件与 TensorBoard"""
+        record = {'kind': kind, 'time': time.time(), 'epoch': epoch, 'batch': batch, 'step': self.train_step,
+                  'learning_rate': self.scheduler.get_last_lr()[0], 'world_size': self.world_size, **summary}
+        if kind == 'step':
+            logger.info(f'loss: {summary["loss"]:.5f}, '
+                        f'learning_rate: {record["learning_rate"]:>.8f}, '
+                        f'samples/s: {summary["samples_per_second"]:.2f}, '
+                        f'frames/s: {summary["frames_per_second"]:.0f}, '
+                        f'padding: {summary["padding_ratio"]:.2%}, '
+                        f'data_stall: {summary["data_stall_fraction"]:.2%}, '
+                        f'reader_cost: {summary["reader_seconds"]:.4f}, '
+                        f'batch_cost: {summary["compute_seconds"]:.4f}, '
+                        f'optimizer_cost: {summary["optimizer_seconds"]:.4f}')
+        for sink in self.metrics_sinks:
+            try:
+                sink.write(self, record)
+            except OSError as e:
+                logger.warning(f'写入训练统计信息失败：{e}')
 
     def train(self,
               save_model_path='models/',
@@ -237,24 +440,52 @@ class TacoTronTrainer:
         self.__setup_model(is_train=True)
         self.__load_pretrained(pretrained_model=pretrained_model)
         # 加载恢复模型
-        last_epoch, best_error_rate = self.__load_checkpoint(save_model_path=save_model_path, resume_model=resume_model)
+        self.train_step = 0
+        last_epoch, self.best_error_rate = self.__load_checkpoint(save_model_path=save_model_path,
+                                                                  resume_model=resume_model)
+        self.train_model = self.model
+        if self.distributed:
+            # 构造时从 rank 0 广播模型参数，反向传播时按桶 all-reduce 梯度
+            self.train_model = DistributedDataParallel(
+                self.model, device_ids=[self.local_rank] if self.use_gpu else None)
+
+        if self.rank == 0:
+            self.checkpoint_writer = AsyncCheckpointWriter()
+            # 统计信息只由 rank 0 输出，吞吐量为单个进程的数值
+            if self.configs.train_conf.get('metrics_jsonl_path', None):
+                self.metrics_sinks.append(JsonLinesSink(self.configs.train_conf.metrics_jsonl_path))
+            if self.configs.train_conf.get('tensorboard_dir', None):
+                self.metrics_sinks.append(TensorBoardSink(self.configs.train_conf.tensorboard_dir))
 
-        test_step, self.train_step = 0, 0
+        test_step = 0
         last_epoch += 1
-        # 开始训练
-        for epoch_id in range(last_epoch, self.configs.train_conf.max_epoch):
-            epoch_id += 1
-            start_epoch = time.time()
-            epoch_loss = self.__train_epoch(epoch_id=epoch_id)
-            logger.info('=' * 70)
-            logger.info('Train result: epoch: {}, time/epoch: {}, loss: {:.5f}'.format(
-                epoch_id, str(timedelta(seconds=(time.time() - start_epoch))), epoch_loss))
-            logger.info('=' * 70)
-            test_step += 1
-            # 保存最优模型
-            if epoch_loss < best_error_rate:
-                best_error_rate = epoch_loss
+        try:
+            # 开始训练
+            for epoch_id in range(last_epoch, self.configs.train_conf.max_epoch):
+                epoch_id += 1
+                start_epoch = time.time()
+                self.train_sampler.set_epoch(epoch_id)
+                if isinstance(self.train_sampler, BucketBatchSampler):
+                    logger.info(f'batch数量：{len(self.train_sampler)}，'
+                                f'补零后有效帧占比：{self.train_sampler.padding_efficiency():.2%}')
+                epoch_loss = self.__train_epoch(epoch_id=epoch_id, save_model_path=save_model_path)
+                logger.info('=' * 70)
+                logger.info('Train result: epoch: {}, time/epoch: {}, loss: {:.5f}'.format(
+                    epoch_id, str(timedelta(seconds=(time.time() - start_epoch))), epoch_loss))
+                logger.info('=' * 70)
+                test_step += 1
+                # 是否为最优模型
+                best_model = epoch_loss < self.best_error_rate
+                if best_model:
+                    self.best_error_rate = epoch_loss
+                # 保存模型，最优模型与本轮的模型是同一份参数，只写一次，分布式训练时只由 rank 0 写文件
                 self.__save_checkpoint(save_model_path=save_model_path, epoch_id=epoch_id,
-                                       test_loss=epoch_loss, best_model=True)
-            # 保存模型
-            self.__save_checkpoint(save_model_path=save_model_path, epoch_id=epoch_id, test_loss=epoch_loss)
+                                       test_loss=epoch_loss, best_model=best_model)
+        finally:
+            if self.checkpoint_writer is not None:
+                # 等待最后的检查点写完
+                self.checkpoint_writer.close()
+            for sink in self.metrics_sinks:
+                sink.close(self)
+        if self.distributed:
+            dist.destroy_process_group()
@@ -0,0 +1,135 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from src.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def snapshot(obj):
+    """把 state_dict 中的张量复制一份到CPU内存，之后继续训练不会改变快照"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def _fsync_write(path, write_fn):
+    with open(path, 'wb') as f:
+        write_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _replace_dir(tmp_dir, target_dir):
+    """用写好的 tmp_dir 替换 target_dir，target_dir 不存在时只有一次原子的改名"""
+    if os.path.isdir(target_dir) and not os.path.islink(target_dir):
+        old_dir = f'{target_dir}.old'
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(target_dir, old_dir)
+        os.replace(tmp_dir, target_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        if os.path.islink(target_dir):
+            os.remove(target_dir)
+        os.replace(tmp_dir, target_dir)
+
+
+def point_to(link_path, target_dir):
+    """
+    把 link_path 指向 target_dir：先创建临时的相对路径符号链接再改名覆盖，读取方不会看到不完整的状态
+    系统不支持符号链接时（例如没有权限的 Windows）退回为复制整个文件夹
+    """
+    tmp_link = f'{link_path}.tmp{os.getpid()}'
+    try:
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(target_dir, os.path.dirname(link_path)), tmp_link, target_is_directory=True)
+    except (OSError, NotImplementedError):
+        tmp_dir = f'{link_path}.tmp{os.getpid()}'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.copytree(target_dir, tmp_dir)
+        _replace_dir(tmp_dir, link_path)
+        return
+    if os.path.isdir(link_path) and not os.path.islink(link_path):
+        # 以前版本保存的完整文件夹
+        shutil.rmtree(link_path)
+    os.replace(tmp_link, link_path)
+
+
+class AsyncCheckpointWriter:
+    """
+    后台线程写检查点
+    调用方在训练线程中把 state_dict 复制到CPU内存（很快），序列化与写磁盘在后台线程中进行，训练不用等待
+    每个检查点先写到临时文件夹，所有文件写完并 fsync 后再改名为目标文件夹，中途中断不会留下不完整的检查点
+    同一时刻最多有 max_pending 个检查点在排队，超过时等待前面的写完，限制快照占用的内存
+    """
+
+    def __init__(self, max_pending=1):
+        """
+        :param max_pending: 最多排队等待写入的检查点数
+        """
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self._futures = []
+
+    def _wait(self, max_pending):
+        while len(self._futures) > max_pending:
+            # 后台写入失败时在这里抛出异常
+            self._futures.pop(0).result()
+
+    def submit(self, fn, *args):
+        """在后台线程中按提交顺序执行 fn(*args)"""
+        self._wait(self.max_pending - 1)
+        self._futures.append(self._executor.submit(fn, *args))
+
+    def save(self, model_dirs, tensors, texts=None, callback=None):
+        """
+        把同一份检查点写到若干个文件夹
+        :param model_dirs: 目标文件夹列表，第一个文件夹写入文件，其余的文件夹使用硬链接（不支持时复制）
+        :param tensors: {文件名: state_dict}，保存前会复制到CPU内存
+        :param texts: {文件名: 文本内容}，在所有张量文件之后写入
+        :param callback: 所有文件夹写完后在后台线程中调用的函数，例如更新 last_model 与删除旧的检查点
+        """
+        tensors = {name: snapshot(state) for name, state in tensors.items()}
+        self.submit(self._write, model_dirs, tensors, texts or {}, callback)
+
+    @staticmethod
+    def _write(model_dirs, tensors, texts, callback):
+        first_dir = model_dirs[0]
+        tmp_dir = f'{first_dir}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, state in tensors.items():
+            _fsync_write(os.path.join(tmp_dir, name), lambda f: torch.save(state, f))
+        for name, text in texts.items():
+            _fsync_write(os.path.join(tmp_dir, name), lambda f: f.write(text.encode('utf-8')))
+        for model_dir in model_dirs[1:]:
+            link_dir = f'{model_dir}.tmp'
+            shutil.rmtree(link_dir, ignore_errors=True)
+            os.makedirs(link_dir)
+            for name in os.listdir(tmp_dir):
+                try:
+                    os.link(os.path.join(tmp_dir, name), os.path.join(link_dir, name))
+                except OSError:
+                    shutil.copy2(os.path.join(tmp_dir, name), os.path.join(link_dir, name))
+            _replace_dir(link_dir, model_dir)
+        _replace_dir(tmp_dir, first_dir)
+        for model_dir in model_dirs:
+            logger.info('已保存模型：{}'.format(model_dir))
+        if callback is not None:
+            callback()
+
+    def flush(self):
+        """等待所有检查点写完"""
+        self._wait(0)
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
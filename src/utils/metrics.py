@@ -0,0 +1,266 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+import torch
+
+from src.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# 关闭统计时 timer 返回的空上下文，可以重复使用
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def cuda_synchronized_timer():
+    """GPU 预测时使用的计时函数，先等待 GPU 上的计算完成再读取时间"""
+    torch.cuda.synchronize()
+    return time.perf_counter()
+
+
+class _StageTimer:
+    __slots__ = ('metrics', 'stage', 'start', 'record_function')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.record_function = None
+
+    def __enter__(self):
+        if self.metrics.profiling:
+            self.record_function = torch.profiler.record_function(self.stage)
+            self.record_function.__enter__()
+        self.start = self.metrics.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        seconds = self.metrics.clock() - self.start
+        if self.record_function is not None:
+            self.record_function.__exit__(exc_type, exc_val, exc_tb)
+        if self.metrics.enabled:
+            self.metrics.observe('stage_seconds', seconds, stage=self.stage)
+
+
+class Metrics:
+    """
+    预测流程的计时与计数
+    - timer(stage)：统计一个阶段的耗时，关闭时返回空的上下文，几乎没有开销
+    - inc / observe：计数器以及 count/sum/max 形式的汇总，可以带标签
+    - request(kind)：一次请求，请求期间产生的耗时与计数会汇总为一条记录，最外层的请求结束时写入各个 sink
+    - profiling：开启后每个 timer 同时生成 torch.profiler 的 record_function，便于在 trace 中区分各阶段
+    使用全局的 metrics 实例，默认关闭
+    """
+
+    def __init__(self, enabled=False, clock=time.perf_counter):
+        """
+        :param enabled: 是否开启统计
+        :param clock: 计时函数，GPU 预测时可以使用 cuda_synchronized_timer
+        """
+        self.enabled = enabled
+        self.profiling = False
+        self.clock = clock
+        self.sinks = []
+        self.counters = {}
+        self.summaries = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, clock=None):
+        self.enabled = True
+        if clock is not None:
+            self.clock = clock
+
+    def disable(self):
+        self.enabled = False
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def timer(self, stage):
+        if not (self.enabled or self.profiling):
+            return _NULL_TIMER
+        return _StageTimer(self, stage)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def _record(self):
+        return getattr(self._local, 'record', None)
+
+    def inc(self, name, value=1, **labels):
+        """计数器加 value"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        record = self._record()
+        if record is not None:
+            record_name = name + ''.join(f'.{v}' for _, v in key[1])
+            record['counters'][record_name] = record['counters'].get(record_name, 0) + value
+
+    def observe(self, name, value, **labels):
+        """记录一个观测值，例如某个阶段的耗时、一条句子的解码步数"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            summary = self.summaries.setdefault(key, [0, 0.0, float('-inf')])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+        record = self._record()
+        if record is not None:
+            if name == 'stage_seconds':
+                stages = record['stages']
+                stages[labels['stage']] = stages.get(labels['stage'], 0.0) + value
+            else:
+                record['observations'].setdefault(name, []).append(value)
+
+    @contextlib.contextmanager
+    def request(self, kind, **fields):
+        """
+        一次请求，嵌套的请求合并到最外层的请求中
+        :param kind: 请求的类型，例如 predict、predict_batch
+        :param fields: 写入记录的其他字段
+        :return: 请求的记录，可以在请求期间补充字段
+        """
+        if not self.enabled:
+            yield {}
+            return
+        record = self._record()
+        if record is not None:
+            yield record
+            return
+        record = {'kind': kind, 'time': time.time(), **fields, 'stages': {}, 'counters': {}, 'observations': {}}
+        self._local.record = record
+        start = self.clock()
+        try:
+            yield record
+        finally:
+            self._local.record = None
+            record['seconds'] = self.clock() - start
+            frames = record['counters'].get('decoder_frames_total', 0)
+            decoder_seconds = record['stages'].get('decoder', 0.0)
+            record['frames_per_second'] = frames / decoder_seconds if decoder_seconds > 0 else None
+            for sink in self.sinks:
+                try:
+                    sink.write(self, record)
+                except OSError as e:
+                    logger.warning(f'写入统计信息失败：{e}')
+
+    @contextlib.contextmanager
+    def profile(self, trace_path):
+        """
+        用 torch.profiler 记录期间的所有算子，结束后保存为 chrome trace，可以在 chrome://tracing 或 perfetto 中查看
+        :param trace_path: trace 文件的保存路径
+        """
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiling = True
+        try:
+            with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+                yield prof
+        finally:
+            self.profiling = False
+        prof.export_chrome_trace(trace_path)
+        logger.info(f'profiler trace 已保存：{trace_path}')
+
+    def snapshot(self):
+        """当前所有计数器与汇总的拷贝"""
+        with self._lock:
+            return dict(self.counters), {k: list(v) for k, v in self.summaries.items()}
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close(self)
+
+
+class JsonLinesSink:
+    """每个请求结束时追加一行 json 记录"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+
+    def write(self, metrics, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def close(self, metrics):
+        pass
+
+
+class PrometheusTextSink:
+    """
+    把累计的计数器与汇总写成 Prometheus 文本格式，供 node_exporter 的 textfile collector 采集
+    每隔 interval 秒最多重写一次文件，先写临时文件再改名，采集时不会读到不完整的文件
+    """
+
+    def __init__(self, path, interval=10, prefix='tacotron2'):
+        """
+        :param path: 输出文件路径，以 .prom 结尾
+        :param interval: 两次写文件的最小间隔（秒）
+        :param prefix: 指标名称的前缀
+        """
+        self.path = path
+        self.interval = interval
+        self.prefix = prefix
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._last_write = 0.0
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    def render(self, metrics):
+        counters, summaries = metrics.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            full_name = f'{self.prefix}_{name}'
+            lines.append(f'# TYPE {full_name} counter')
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f'{full_name}{self._labels(labels)} {value}')
+        for name in sorted({name for name, _ in summaries}):
+            full_name = f'{self.prefix}_{name}'
+            items = [(labels, summary) for (n, labels), summary in sorted(summaries.items()) if n == name]
+            lines.append(f'# TYPE {full_name} summary')
+            for labels, (count, total, _) in items:
+                lines.append(f'{full_name}_count{self._labels(labels)} {count}')
+                lines.append(f'{full_name}_sum{self._labels(labels)} {total}')
+            lines.append(f'# TYPE {full_name}_max gauge')
+            for labels, (_, _, maximum) in items:
+                lines.append(f'{full_name}_max{self._labels(labels)} {maximum}')
+        frames = counters.get(('decoder_frames_total', ()), 0)
+        decoder_seconds = summaries.get(('stage_seconds', (('stage', 'decoder'),)), [0, 0.0])[1]
+        if decoder_seconds > 0:
+            lines.append(f'# TYPE {self.prefix}_decoder_frames_per_second gauge')
+            lines.append(f'{self.prefix}_decoder_frames_per_second {frames / decoder_seconds}')
+        return '\n'.join(lines) + '\n'
+
+    def _write(self, metrics):
+        tmp_path = f'{self.path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render(metrics))
+        os.replace(tmp_path, self.path)
+        self._last_write = time.monotonic()
+
+    def write(self, metrics, record):
+        if time.monotonic() - self._last_write >= self.interval:
+            self._write(metrics)
+
+    def close(self, metrics):
+        self._write(metrics)
+
+
+# 全局实例，默认关闭
+metrics = Metrics()
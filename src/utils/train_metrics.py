@@ -0,0 +1,106 @@
+import os
+import time
+
+import torch
+
+from src.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class WindowedMeter:
+    """
+    训练吞吐量的累计器，只保存一组累加值，内存占用与训练的步数无关
+    - loss 与有效帧数在训练设备上累加，只在 summary 时同步一次，每个 batch 不需要等待设备上的计算完成
+    - batch 数、样本数、补零后的帧数以及各部分耗时在CPU上累加
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.frames = torch.zeros((), dtype=torch.int64, device=self.device)
+        self.batches = 0
+        self.samples = 0
+        self.padded_frames = 0
+        self.reader_seconds = 0.0
+        self.compute_seconds = 0.0
+        self.optimizer_seconds = 0.0
+        self.optimizer_steps = 0
+        self.start = time.perf_counter()
+
+    def add_batch(self, loss, mel_lengths, padded_frames, reader_seconds, compute_seconds):
+        """
+        :param loss: 本 batch 的 loss，0维张量
+        :param mel_lengths: 每条数据的有效 mel 帧数
+        :param padded_frames: 补零后的 mel 帧数，即 batch 大小 * 最长的帧数
+        :param reader_seconds: 等待数据的时间
+        :param compute_seconds: 前向与反向传播的时间
+        """
+        self.loss_sum += loss.detach()
+        self.frames += mel_lengths.sum()
+        self.batches += 1
+        self.samples += mel_lengths.shape[0]
+        self.padded_frames += padded_frames
+        self.reader_seconds += reader_seconds
+        self.compute_seconds += compute_seconds
+
+    def add_optimizer_step(self, seconds):
+        """:param seconds: 梯度裁剪与参数更新的时间"""
+        self.optimizer_seconds += seconds
+        self.optimizer_steps += 1
+
+    def mean_loss(self):
+        """平均 loss，会同步一次训练设备"""
+        return self.loss_sum.item() / max(self.batches, 1)
+
+    def summary(self):
+        """当前累计值的汇总，会同步一次训练设备"""
+        seconds = max(time.perf_counter() - self.start, 1e-9)
+        frames = self.frames.item()
+        busy_seconds = self.reader_seconds + self.compute_seconds + self.optimizer_seconds
+        return {'loss': self.mean_loss(),
+                'batches': self.batches,
+                'samples_per_second': self.samples / seconds,
+                'frames_per_second': frames / seconds,
+                'padding_ratio': 1 - frames / self.padded_frames if self.padded_frames else 0.0,
+                'data_stall_fraction': self.reader_seconds / busy_seconds if busy_seconds > 0 else 0.0,
+                'reader_seconds': self.reader_seconds / max(self.batches, 1),
+                'compute_seconds': self.compute_seconds / max(self.batches, 1),
+                'optimizer_seconds': self.optimizer_seconds / max(self.optimizer_steps, 1)}
+
+    def state_dict(self):
+        """恢复训练时需要的累加值"""
+        return {'loss_sum': self.loss_sum.item(), 'batches': self.batches}
+
+    def load_state_dict(self, state):
+        self.loss_sum.fill_(state['loss_sum'])
+        self.batches = state['batches']
+
+
+class TensorBoardSink:
+    """把训练统计中的数值写入 TensorBoard，需要安装 tensorboard"""
+
+    def __init__(self, log_dir, prefix='train'):
+        """
+        :param log_dir: TensorBoard 的日志文件夹
+        :param prefix: 指标名称的前缀，记录中的 kind 会加在前缀后面，例如 train_step/loss
+        """
+        try:
+            from torch.utils.tensorboard import SummaryWriter
+        except ImportError as e:
+            raise ImportError('保存 TensorBoard 日志需要安装 tensorboard：pip install tensorboard') from e
+        os.makedirs(log_dir, exist_ok=True)
+        self.writer = SummaryWriter(log_dir)
+        self.prefix = prefix
+
+    def write(self, metrics, record):
+        step = record.get('step', 0)
+        for name, value in record.items():
+            if name != 'step' and isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.writer.add_scalar(f'{self.prefix}_{record.get("kind", "step")}/{name}', value, step)
+
+    def close(self, metrics):
+        self.writer.close()
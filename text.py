@@ -102,4 +102,7 @@ def preprocess_text():
 
     write.close()
     f.close()
-preprocess_text()
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    preprocess_text()